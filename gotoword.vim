@@ -80,6 +80,8 @@ let g:gotoword_loaded = 1
 " define the highlight group
 hi GotowordLinks guibg=#33ff33 ctermbg=Cyan
 " The syntax items that use this group are defined in python files.
+" keywords found in user's documents look like links
+hi link GotowordKeywords GotowordLinks
 
 " 
 "noremap <buffer> <expr> <2-LeftMouse> Make_links()
@@ -158,12 +160,82 @@ if !exists(":HelperWordContexts")
   "   :HelperWordContexts
 endif
 
+if !exists(":HelperHighlight")
+  " toggles highlighting of the words that have a note, in all buffers
+  command -nargs=0 HelperHighlight call s:Helper_highlight()
+endif
+
+if !exists(":HelperSearch")
+  " searches the notes for words; a word ending in * matches words starting
+  " with it
+  command -nargs=+ HelperSearch call s:Helper_search(<q-args>)
+  " SYNOPSIS
+  "   :HelperSearch graphics instruct*
+endif
+
+if !exists(":HelperRule")
+  " documents with this filetype or with a path matching this glob belong to
+  " context; only the keywords of their contexts are used while they are
+  " edited
+  command -nargs=+ HelperRule call s:Helper_rule(<f-args>)
+  " SYNOPSIS
+  "   :HelperRule kivy *.kv
+  "   :HelperRule python python
+endif
+
+if !exists(":HelperDeleteRule")
+  command -nargs=+ HelperDeleteRule call s:Helper_delete_rule(<f-args>)
+  " Eg. :HelperDeleteRule kivy *.kv
+endif
+
+if !exists(":HelperRules")
+  " lists the rules defined with :HelperRule
+  command -nargs=0 HelperRules call s:Helper_rules()
+endif
+
+if !exists(":HelperStats")
+  " shows how many times each command ran, how long it took and how many
+  " SQL statements and calls to Vim it made
+  command -nargs=? -complete=file HelperStats call s:Helper_stats(<f-args>)
+  " SYNOPSIS
+  "   :HelperStats
+  "   :HelperStats ~/gotoword_stats.json      (writes them as JSON)
+  "   :HelperStats reset
+endif
+
+if !exists(":HelperTraceStart")
+  " records the functions the plugin runs, the SQL statements and the calls
+  " to Vim, with their timings, until :HelperTraceStop
+  command -nargs=0 HelperTraceStart call s:Helper_trace_start()
+endif
+
+if !exists(":HelperTraceStop")
+  " writes the trace to a file that chrome://tracing, Perfetto or speedscope
+  " open; by default, gotoword-trace-DATE.json in the current directory
+  command -nargs=? -complete=file HelperTraceStop
+        \ call s:Helper_trace_stop(<f-args>)
+endif
+
+if !exists(":HelperProfile")
+  " profiles the commands that follow with cProfile, saves the profile as a
+  " .pstats file and displays the functions that took the most time
+  command -nargs=+ -complete=file HelperProfile
+        \ call s:Helper_profile(<f-args>)
+  " SYNOPSIS
+  "   :HelperProfile start
+  "   :HelperProfile stop
+  "   :HelperProfile report
+  "   :HelperProfile report 50
+  "   :HelperProfile report gotoword-20151201-101010.pstats
+endif
+
 
 " --------------------------------
 " FUNCTIONS 
 " --------------------------------
 
 function! s:Help_buffer(...)           
+    call s:Bootstrap()
 "function! s:Help_buffer(word)           
     " TODO: rename this function to Helper
     " fct name always starts with uppercase
@@ -238,18 +310,17 @@ if type(word) == list:
     # multiple rows have been selected; do we need to remove whitespaces?
     for i, line in enumerate(word):
         word[i] = line.strip()
-if len(word) == 1:
+if type(word) == list and len(word) == 1:
     # one line of text only (one or more words)
     word = word[0]
-else:
-    pass
-    # multiple lines should be used to extract context, etc.
-    # TODO: get the context of those lines by computing the weight of the 
-    # contexts the words in lines belong to
 #logger.debug("INPUT IS: %s" % type(word), extra={'className': ''})
 
 #app.keyword = app.helper(word)
-app.helper(word)
+if type(word) == list:
+    # multiple lines are used to infer the context of the note
+    app.helper_selection(word)
+else:
+    app.helper(word)
 EOF
 
   let g:loaded_Help_buffer = 1
@@ -258,6 +329,7 @@ endfunction
 
 "function! s:Helper_save(context)             " fct has a variable number of args
 function! s:Helper_save(...)             " fct has a variable number of args
+    call s:Bootstrap()
     " SYNOPSIS
     "   Helper_save()
     "   Helper_save(context)
@@ -300,6 +372,7 @@ endfunction
 
 
 function! s:Helper_delete()
+    call s:Bootstrap()
     " TODO: should take optional positional arguments indicating the context
     " One could delete the definition for one context while keeping the others
 
@@ -312,6 +385,7 @@ endfunction
 
 
 function! s:Helper_delete_context(context)
+    call s:Bootstrap()
     " deletes a context from database
     python context = gotoword.vim.eval("a:context")
     python context = unicode(context.strip()).lower()
@@ -320,6 +394,7 @@ endfunction
 
 
 function! s:Helper_all_words()
+    call s:Bootstrap()
     " this function displays all keywords from DB in help_buffer, sorted in 
     " alphabetical order
     
@@ -330,6 +405,7 @@ endfunction
 
 
 function! s:Helper_all_contexts()
+    call s:Bootstrap()
     " this function displays all contexts from DB in help_buffer, sorted in 
     " alphabetical order
     
@@ -340,6 +416,7 @@ endfunction
 
 
 function! s:Helper_context_words(context)
+    call s:Bootstrap()
     " this function displays in help_buffer all keywords from DB that belong 
     " to context, sorted in alphabetical order
     python context = gotoword.vim.eval("a:context")
@@ -350,6 +427,7 @@ endfunction
 
 
 function! s:Helper_word_contexts()
+    call s:Bootstrap()
 "    " Displays in help buffer all contexts the current keyword belongs to,
 "    " sorted in alphabetical order
 "    " TODO: this should work for the current keyword or for the word under the
@@ -358,8 +436,111 @@ function! s:Helper_word_contexts()
 endfunction
 
 
+function! s:Helper_highlight()
+    call s:Bootstrap()
+    " turns on/off the highlighting of keywords in user's documents
+    python app.helper_highlight()
+endfunction
+
+
+function! s:Helper_search(query)
+    call s:Bootstrap()
+    " displays in help_buffer the notes that contain the words in query
+    python query = gotoword.highlight.decode(gotoword.vim.eval("a:query").strip())
+    python app.helper_search(query)
+endfunction
+
+
+function! s:Helper_rule(context, pattern)
+    call s:Bootstrap()
+    " maps a filetype or a path glob to a context
+    python context = unicode(gotoword.vim.eval("a:context").strip()).lower()
+    python pattern = unicode(gotoword.vim.eval("a:pattern").strip())
+    python app.helper_add_rule(context, pattern)
+endfunction
+
+
+function! s:Helper_delete_rule(context, pattern)
+    call s:Bootstrap()
+    python context = unicode(gotoword.vim.eval("a:context").strip()).lower()
+    python pattern = unicode(gotoword.vim.eval("a:pattern").strip())
+    python app.helper_delete_rule(context, pattern)
+endfunction
+
+
+function! s:Helper_rules()
+    call s:Bootstrap()
+    " displays the rules in help_buffer
+    python app.helper_rules()
+endfunction
+
+
+function! s:Helper_stats(...)
+    call s:Bootstrap()
+    let argument = a:0 ? expand(a:1) : ''
+    python app.helper_stats(gotoword.vim.eval("argument"))
+endfunction
+
+
+function! s:Helper_trace_start()
+    call s:Bootstrap()
+    python app.helper_trace_start()
+endfunction
+
+
+function! s:Helper_trace_stop(...)
+    call s:Bootstrap()
+    let path = a:0 ? expand(a:1) : ''
+    python app.helper_trace_stop(gotoword.vim.eval("path"))
+endfunction
+
+
+function! s:Helper_profile(action, ...)
+    call s:Bootstrap()
+    let argument = a:0 ? expand(a:1) : ''
+    python app.helper_profile(gotoword.vim.eval("a:action"),
+                \ gotoword.vim.eval("argument"))
+endfunction
+
+
+function! GotowordComplete(findstart, base)
+    call s:Bootstrap()
+    " completes the names of keywords in insert mode with CTRL-X CTRL-U, after
+    " :set completefunc=GotowordComplete
+    " only keywords of context b:gotoword_context are completed, if it is set
+    if a:findstart
+        let line = getline('.')
+        let start = col('.') - 1
+        while start > 0 && line[start - 1] =~ '\k'
+            let start -= 1
+        endwhile
+        return start
+    endif
+    python app.helper_complete(gotoword.vim.eval("a:base"),
+                \ gotoword.vim.eval("get(b:, 'gotoword_context', '')"))
+    return g:gotoword_completions
+endfunction
+
+
+function! s:Helper_poll(timer)
+    " called by a timer to highlight keywords found by the scanner thread
+    python app.highlighter.poll()
+endfunction
+let g:gotoword_poll = function('s:Helper_poll')
+
+
 " MAIN 
-" When this script is loaded into VIM, the following code is executed:
+" When this script is loaded into VIM, only the commands are defined; python,
+" django and the database are set up by the first command used, so that Vim
+" doesn't start slower when this plugin is not used.
+let s:plugin_path = expand("<sfile>:h")
+" <sfile> is the function name inside a function
+
+function! s:Bootstrap() abort
+    " abort: if python fails, the next command tries again
+    if exists("s:bootstrapped")
+      return
+    endif
 python <<EOF
 
 import vim
@@ -369,7 +550,7 @@ import logging
 # --------------------------------
 # Add our plugin to the path
 # --------------------------------
-gotoword_plugin_path = vim.eval('expand("<sfile>:h")')
+gotoword_plugin_path = vim.eval('s:plugin_path')
 # :help sfile
 #sys.path.insert(1, gotoword_plugin_path)
 
@@ -379,9 +560,19 @@ sys.path.insert(1, '/home/andrei/.vim/andrei_plugins/gotoword')
 
 
 from gotoword import settings
-settings.setup(settings.DATABASE)
+from django.conf import settings as django_settings
+if not django_settings.configured:
+    # django can be set up only once, even if a first bootstrap failed later
+    settings.setup(settings.DATABASE, storage="sqlite")
 from gotoword import gotoword_logging
-logger = gotoword_logging.set_up_logging(logging.DEBUG, 'vim')
+log_level = vim.eval("get(g:, 'gotoword_log_level', 'WARNING')")
+# a level name, like 'DEBUG', or a number
+log_level = (int(log_level) if log_level.isdigit() else
+             logging.getLevelName(log_level.upper()))
+if not isinstance(log_level, int):
+    # getLevelName() returns 'Level X' for unknown names
+    log_level = logging.WARNING
+logger = gotoword_logging.set_up_logging(log_level, 'vim')
 #gotoword_logging.logger.debug("SCRIPT STARTED", extra={'className': ""}),
 logger.debug("SCRIPT STARTED", extra={'className': ""}),
 
@@ -392,3 +583,13 @@ from gotoword import utils
 app = gotoword.App()
 app.main()
 EOF
+    let s:bootstrapped = 1
+
+    augroup gotoword_rules
+      autocmd!
+      " use the keywords of the contexts the document belongs to
+      autocmd BufEnter,FileType * python app.select_contexts()
+    augroup END
+    " the document user is editing now
+    python app.select_contexts()
+endfunction
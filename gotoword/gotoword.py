@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 ### System libraries ###
+import time
 import logging
+from collections import OrderedDict
 #import os.path
 #import threading
 #import time
@@ -23,21 +25,31 @@ except ImportError:
 from settings import (PKG_PATH, VIM_PLUGIN_PATH, DJANGO_PATH, SCRIPT,
                       HELP_BUFFER, DATABASE)
 import utils
+import highlight
+import inference
+import suggest
+import stats
+import tracing
+import profiling
 from gotoword_logging import logger_as_decorator_factory
 from gotoword_logging import strip
+from gotoword_logging import log_server_listening
 
 
 logger = logging.getLogger('vim.gotoword')
 log = logger_as_decorator_factory(logger)
+measure = stats.measure
+
+if 'vim' in globals():
+    vim = stats.CountingVim(vim)
+    # calls to Vim are counted for :HelperStats
 
 """Set TESTING - flag to indicate that a log server in functional tests file
 might be up, so this script is under test and should accept test input using
 Vim's input functions."""
-TESTING = True if logging.getLogger('vim').handlers[1].sock else False
-# socket is created just before the first log message in the entire app
-# (including gotoword.vim) is
-# created, so TESTING will be False if called before the logger starts sending
-# messages
+TESTING = log_server_listening()
+# set_up_logging() connects to the log server, so TESTING is False if it is
+# called before the logging is set up
 #logger.debug("TESTING: %s" % TESTING, extra={'className': ""})
 
 logger.debug("Following constants are defined: \n"
@@ -76,6 +88,8 @@ class App(object):
         # the current keyword which will be displayed in helper buffer
         self.keyword = None
         self.keyword_context = None
+        self.store = None
+        # in-memory index of keywords and contexts, loaded by main()
         # we are sure that 'default' context exists in DB
         self.default_context = utils.find_model_object('default',
                                                        utils.Context)
@@ -91,6 +105,17 @@ class App(object):
     #@log
     def main(self):
         """This is the main entry point of this script."""
+        # SQL statements are counted for :HelperStats
+        utils.count_queries()
+        utils.upgrade_database()
+        self.rules = utils.ContextRule.objects.values_list('context_id',
+                                                           'pattern')
+        self.rules = list(self.rules)
+        self.store = utils.load_keywords_store(DATABASE)
+        self.names = utils.NameIndex(self.store)
+        self.suggestions = suggest.SuggestIndex(self.store)
+        self.notes_cache = utils.NoteCache(store=self.store)
+        self.notes_cache.check()
         self.vim_wrapper = VimWrapper(app=self)
         self.vim_wrapper.setup_help_buffer(self.help_buffer_name)
         self.template = Template(self, self.vim_wrapper, App.help_buffer_name)
@@ -99,7 +124,12 @@ class App(object):
         toggle_modifiable = ToggleModifiableObserver(self.template)
         self.template.attach_pre(toggle_modifiable)
         self.template.attach_post(toggle_modifiable)
+        pager = PagerObserver(self.template)
+        self.template.attach_post(pager)
+        self.highlighter = highlight.Highlighter(self)
+        self.scorer = inference.ContextScorer(self.store)
 
+    @measure
     @log
     def helper(self, word):
         """
@@ -117,11 +147,12 @@ class App(object):
         # make it case-insensitive
         self.word = word.lower()
 
-        # look for keyword in DB
-        self.keyword = utils.find_model_object(self.word, utils.Keyword)
+        # another Vim may have changed the keywords since the last lookup
+        self.notes_cache.check()
+        self.keyword = self._lookup(self.word)
 
         if self.keyword:
-            contexts = self.keyword.contexts.all()
+            contexts = self.keyword.definitions
             ctx_names = [ctx.name for ctx in contexts]
             if len(contexts) == 1:
                 self.keyword.current_context = contexts[0]
@@ -144,12 +175,68 @@ class App(object):
                          (word, self.keyword),
                          extra={'className': strip(self.__class__)})
 
-            # write to buffer the small help text
+            # write to buffer the small help text, with the keywords user
+            # may have misspelled, so that he doesn't create a duplicate
             body = utils.introduction_line(word).splitlines()
-            self.template.template(body)
+            links = []
+            for name in self.suggestions.suggest(self.word):
+                link = Link(name)
+
+                def action(instance, app, link_name):
+                    pass
+
+                def target(instance, app, name=name):
+                    app.helper(name)
+
+                link.action = action
+                link.target = target
+                links.append(link)
+            if links:
+                body.extend(["", "Did you mean:"] +
+                            ["    " + suggested.name for suggested in links])
+            self.template.template(body, links=links,
+                                   syntax_group="GotowordLinks")
             #self.keyword = None
         return self.keyword
 
+    def _lookup(self, word):
+        """Finds keyword word and the contexts it has definitions in, as
+        keyword.definitions, a list of Context instances sorted by name.
+        Returns the keyword or None.
+        """
+        # look for keyword in the in-memory store first, so that words which
+        # are not keywords don't reach the DB at all
+        entry = self.store.find(word)
+        if entry is None:
+            if self.notes_cache.data_version is not None:
+                # the store is reloaded by notes_cache.check() when another
+                # process changes the database
+                return None
+            # the database can't tell if it was changed, ask it
+            keyword = self._resolve(word)
+            if keyword is not None:
+                for context in keyword.definitions or [None]:
+                    self.store.add_keyword(keyword, context)
+            return keyword
+        # notes are read by _helper only if they are not cached
+        keyword = utils.Keyword(id=entry[0], name=word)
+        keyword.notes = None
+        keyword.definitions = self.store.keyword_contexts(word)
+        return keyword
+
+    def _resolve(self, word):
+        """Fetches the keyword with all its definitions in one query.
+        The definitions are attached to the keyword as keyword.notes, an
+        ordered dict of context id -> utils.Note.
+        Returns the keyword or None.
+        """
+        keyword, notes = utils.resolve_keyword(word)
+        if keyword:
+            keyword.notes = OrderedDict((note.context.id, note)
+                                        for note in notes)
+            keyword.definitions = [note.context for note in notes]
+        return keyword
+
     @log
     def _helper(self, keyword):
         """Complements helper(), displays info for kw by feeding header and
@@ -159,12 +246,26 @@ class App(object):
                   (self.keyword.name,
                    self.keyword.current_context.name)]
 
-        content_main_ctx = self.keyword.data_set.get(
-            context=self.keyword.current_context)
-        #content_main_ctx = self.keyword.data_set.get(context=contexts[0])
-        body = content_main_ctx.info.splitlines()
-        # .splitlines() is used because vim buffer accepts at most one "\n"
-        # per vim line
+        key = (self.keyword.name, self.keyword.current_context.id)
+        body = self.notes_cache.get(key)
+        if body is None:
+            if getattr(self.keyword, 'notes', None) is None:
+                # keyword was found in the store, or it was created or
+                # updated by helper_save since it was resolved
+                resolved = self._resolve(self.keyword.name)
+                self.keyword.notes = resolved.notes if resolved else {}
+            content_main_ctx = self.keyword.notes.get(
+                self.keyword.current_context.id)
+            if content_main_ctx is None:
+                # another process deleted it since the store was loaded
+                self.template.template(utils.introduction_line(
+                    self.keyword.name).splitlines())
+                self.keyword = None
+                return
+            body = content_main_ctx.info.splitlines()
+            # .splitlines() is used because vim buffer accepts at most one
+            # "\n" per vim line
+            self.notes_cache.put(key, body)
         self.template.template(body, header=header)
 
     @log
@@ -188,6 +289,33 @@ class App(object):
             #             extra={'className': strip(self.__class__)})
             self._helper(self.keyword)
 
+    @measure
+    @log
+    def helper_selection(self, lines):
+        """Displays a note for a selection of multiple lines.
+        The context is inferred from all the keywords found in lines and the
+        note shown is that of the most frequent keyword that has a definition
+        in that context.
+        """
+        context, names = self.scorer.infer(lines)
+        if context is None:
+            self.keyword = None
+            self.template.template(["No keywords found in the selected "
+                                    "lines."])
+            return self.keyword
+        name = [name for name in names
+                if context.id in self.store.find(name)[1]][0]
+        self.word = name
+        self.notes_cache.check()
+        self.keyword = self._lookup(name)
+        self.keyword.current_context = context
+        logger.debug("keywords: %s inferred context: %s" %
+                     (names, context.name),
+                     extra={'className': strip(self.__class__)})
+        self._helper(self.keyword)
+        return self.keyword
+
+    @measure
     @log
     def helper_save(self, context, test_answer):
         """
@@ -205,7 +333,12 @@ class App(object):
             self.state = self.state.evaluate(self, self.keyword, self.context, self.test_answer)
             if self.state is None:
                 self.saving = False
+        if self.keyword:
+            # definitions resolved by helper() are stale now
+            self.keyword.notes = None
+            self.notes_cache.invalidate(self.keyword.name)
 
+    @measure
     @log
     def helper_delete(self, keyword, context=None):
         """
@@ -227,54 +360,72 @@ class App(object):
             kw_name = keyword.name
             # TODO: kw_name exists only for the print msg, but can be replaced by
             # keyword.name which is still in the namespace, right?
-            keyword.delete()
+            utils.get_storage().delete_keyword(kw_name)
+            self.store.remove_keyword(kw_name)
+            self.notes_cache.invalidate(kw_name)
             print("Keyword %s and its definition was removed from database" %
                   kw_name)
         else:
             print("Can't delete a word and its definition if it's not in the database.")
 
+    @measure
     @log
     def helper_delete_context(self, context):
         "Deletes context from database."
-        context = utils.Context.objects.get(name=context)
+        context = self.store.get_context(context)
         if context:
             ctx_name = context.name
-            context.delete()
+            ctx_id = context.id
+            utils.get_storage().delete_context(ctx_name)
+            self.store.remove_context(ctx_name)
+            # the database deletes the rules of the context, too
+            self.rules = [rule for rule in self.rules if rule[0] != ctx_id]
+            self.notes_cache.invalidate(context=ctx_id)
             #STORE.remove(context)
             #STORE.commit()
             print("Context %s was removed from database" % ctx_name)
         else:
             print("Can't delete a context if it's not in the database.")
 
+    @measure
     @log
     def helper_all_words(self):
         """
         List all keywords from database into help_buffer.
+        The list is loaded page by page, while the user scrolls down.
+        Returns the first page of names.
         """
         # select only the keyword names
-        names = [kwd.name for kwd in utils.Keyword.objects.all()]
+        names = self._helper_names(utils.iter_keyword_names())
         '''
         >>> names
         [u'canvas', u'color', u'line']
         '''
-        self.template.template(names, modifiable=False)
         return names
 
+    @measure
     @log
     def helper_all_contexts(self):
         """
         List all contexts from database into help_buffer.
+        Returns the first page of names.
         """
-        # TODO: this is the same as helper_all_words, create one that is
-        # used by both
-
         # select only the context names
-        names = [ctx.name for ctx in utils.Context.objects.all()]
-        #names.sort()
-
-        self.template.template(names, modifiable=False)
+        return self._helper_names(
+            utils.iter_names(utils.Context.objects.all()))
+
+    def _helper_names(self, pages, header=None):
+        """Displays names, sorted in alphabetical order, one page at a time.
+        Used by helper_all_words, etc.
+        pages - an iterator of lists of names, like utils.iter_names()
+        Returns the first page of names.
+        """
+        names = next(pages, [])
+        self.template.template(names, header=header, modifiable=False,
+                               pages=pages)
         return names
 
+    @measure
     @log
     def helper_context_words(self, context):
         """
@@ -284,16 +435,19 @@ class App(object):
         Returns a list of words.
         """
 
-        # locate context into DB and retrieve it as a Context object
-        context_obj = utils.Context.objects.get(name=context)
-        words = [kwd.name for kwd in context_obj.keyword_set.all()]
+        # locate context and retrieve it as a Context object
+        context_obj = self.store.get_context(context)
+        if not context_obj:
+            print("Context %s doesn't exist in the database." % context)
+            return []
+        words = utils.iter_keyword_names(context_obj.id)
 
         header = [
             "The following keywords have a meaning (definition) in '%s' "
             "context:" % context_obj.name]
-        self.template.template(words, header=header, modifiable=False)
-        return words
+        return self._helper_names(words, header=header)
 
+    @measure
     @log
     def helper_word_contexts(self):
         """
@@ -307,14 +461,11 @@ class App(object):
         if self.keyword:                     # what is the 'else' branch?
             header = ["The keyword '%s' has information belonging to the "
                       "following contexts:" % self.keyword.name]
-            contexts = self.keyword.contexts.all()
-            for ctx in contexts:
-                relation = self.keyword.data_set.get(context=ctx)
-                # choose user note if possible, else public note available for
-                # all users by default:
-                definition = (relation.info if relation.info else
-                              relation.info_public)
-                one_line_definition = definition.split("\n", 1)[0]
+            # one query for all contexts, which gets only the first line of
+            # each note: user note if possible, else public note available for
+            # all users by default
+            summaries = utils.keyword_summaries(self.keyword)
+            for ctx, one_line_definition in summaries:
                 body.extend([ctx.name, one_line_definition, "\n"])
 
                 link = Link(ctx.name)
@@ -326,8 +477,8 @@ class App(object):
                     #TODO: it should be possible to call this function only
                     # with supplied args, without the need for the calling
                     # fct. to know which args to supply with...
-                    app.keyword.current_context = app.keyword.contexts.get(
-                        name=link_name)
+                    app.keyword.current_context = app.store.get_context(
+                        link_name)
                     logger.debug('user chose current context for %s, %s' %
                                  (id(self.keyword), app.keyword.current_context.name), extra={'className': ''})
 
@@ -336,6 +487,7 @@ class App(object):
                 def target(instance, app):
                     """This is the function to be called when link is hit by
                     user. Usually, target is specific to each link."""
+                    app.notes_cache.check()
                     app._kwd_multiple_contexts()
 
                 link.target = target
@@ -348,7 +500,221 @@ class App(object):
             #vim.command('au BufWinEnter <buffer=%s>  py app._clear_highlight_links("GotowordLinks")' % self.vim_wrapper.buffer_nr)
             #vim.command('au BufWinEnter <buffer=%s>  echo "hold")' % self.vim_wrapper.buffer_nr)
 
-            return [ctx.name for ctx in contexts]
+            return [ctx.name for ctx, summary in summaries]
+
+    @measure
+    @log
+    def helper_search(self, query):
+        """Displays the notes that contain the words in query, best matches
+        first, with the keywords as links to the notes.
+        Returns the list of utils.SearchHit.
+        """
+        hits = utils.search_notes(query)
+        if hits is None:
+            print("Full-text search needs sqlite with FTS5.")
+            return []
+        header = ["Notes that contain '%s':" % query]
+        body = []
+        links = []
+        for hit in hits:
+            body.extend(["%s (%s)" % (hit.keyword, hit.context),
+                         "    " + hit.snippet, ""])
+            if hit.keyword in [link.name for link in links]:
+                continue
+            link = Link(hit.keyword)
+
+            def action(instance, app, link_name):
+                pass
+
+            def target(instance, app, name=hit.keyword):
+                app.helper(name)
+
+            link.action = action
+            link.target = target
+            links.append(link)
+        if not hits:
+            body = ["No notes found."]
+        self.template.template(body, header, links,
+                               syntax_group="GotowordLinks", modifiable=False)
+        return hits
+
+    @measure
+    def helper_complete(self, base, context=""):
+        """Completes base to the names of keywords, for Vim's completefunc.
+        context - a context name; if given, only the keywords that have a
+            definition in this context are completed.
+        The completions are stored in g:gotoword_completions.
+        """
+        ctx = self.store.get_context(context) if context else None
+        if context and ctx is None:
+            names = []
+        else:
+            names = self.names.complete(highlight.decode(base),
+                                        ctx.id if ctx else None)
+        vim.command("let g:gotoword_completions = %s" %
+                    create_vim_string_list(names))
+        return names
+
+    @measure
+    @log
+    def helper_highlight(self):
+        """Toggles highlighting of the keywords that exist in the documents
+        user is editing."""
+        enabled = self.highlighter.toggle()
+        print("Keywords highlighting is %s" % ("on" if enabled else "off"))
+
+    @measure
+    @log
+    def select_contexts(self):
+        """Narrows the keywords to those of the contexts the rules match for
+        the current buffer, together with those of the default context, or
+        to all keywords if no rule matches. Runs on BufEnter and FileType.
+        """
+        filetype, path, buftype = vim.eval('[&filetype, expand("%:p"), '
+                                           '&buftype]')
+        if buftype:
+            # help buffer, quickfix, etc. keep the keywords of the document
+            # user came from
+            return
+        scope = utils.match_contexts(self.rules, filetype, path)
+        default = self.store.context_ids.get("default")
+        if scope is not None and default is not None:
+            scope = scope.union([default])
+        if scope != self.store.scope:
+            # the keywords are filtered in memory, the database isn't read
+            self.store.set_scope(scope)
+            logger.debug("keywords of contexts %s" % (scope,),
+                         extra={'className': strip(self.__class__)})
+            if self.highlighter.enabled:
+                self.highlighter.highlight()
+
+    @measure
+    @log
+    def helper_add_rule(self, context, pattern):
+        """Documents that match pattern (a filetype or a path glob) will
+        have their keywords looked up in context.
+        context, pattern - strings
+        """
+        context_obj = self.store.get_context(context)
+        if not context_obj:
+            print("Context %s doesn't exist in the database." % context)
+            return
+        utils.ContextRule.objects.get_or_create(context=context_obj,
+                                                pattern=pattern)
+        self.rules.append((context_obj.id, pattern))
+        self.select_contexts()
+
+    @measure
+    @log
+    def helper_delete_rule(self, context, pattern):
+        "Deletes the rule that maps pattern to context."
+        context_obj = self.store.get_context(context)
+        if not context_obj:
+            print("Context %s doesn't exist in the database." % context)
+            return
+        utils.ContextRule.objects.filter(context=context_obj,
+                                         pattern=pattern).delete()
+        self.rules = [rule for rule in self.rules
+                      if rule != (context_obj.id, pattern)]
+        self.select_contexts()
+
+    @measure
+    @log
+    def helper_rules(self):
+        """Displays the rules that tell which contexts documents belong to.
+        Returns a list of (pattern, context name) tuples.
+        """
+        rules = sorted((pattern, self.store.contexts[ctx_id].name)
+                       for ctx_id, pattern in self.rules
+                       if ctx_id in self.store.contexts)
+        header = ["Documents matching a filetype or a path glob belong to "
+                  "these contexts:"]
+        body = ["%-30s %s" % rule for rule in rules]
+        self.template.template(body, header=header, modifiable=False)
+        return rules
+
+    def helper_stats(self, argument=""):
+        """Displays the statistics of the commands run since Vim started, or
+        since they were reset: number of calls, latency percentiles, SQL
+        statements, their time, and calls to Vim, per call, and the hits and
+        misses of the notes cache.
+        argument - 'reset' forgets the statistics; any other word is the
+            name of a file to write them to, as JSON.
+        """
+        cache = self.notes_cache.as_dict()
+        if argument == "reset":
+            stats.reset()
+            self.notes_cache.reset()
+            print("The statistics were reset.")
+        elif argument:
+            stats.dump(argument, {'NoteCache': cache})
+            print("The statistics were written to %s" % argument)
+        else:
+            header = ["Statistics of the commands; times in ms, sql and vim "
+                      "are counted per call:"]
+            lines = stats.report() + [
+                "", "Notes cache: %(hits)s hits, %(misses)s misses, "
+                "%(notes)s of %(size)s notes cached" % cache]
+            self.template.template(lines, header=header, modifiable=False)
+
+    def helper_trace_start(self):
+        """Starts recording the calls of the plugin's functions, the SQL
+        statements and the calls to Vim, for helper_trace_stop()."""
+        tracing.start()
+        print("Recording a trace; :HelperTraceStop writes it to a file.")
+
+    def helper_trace_stop(self, path=""):
+        """Writes the trace recorded since helper_trace_start() to path, in
+        the Chrome Trace Event format, or to gotoword-trace-DATE.json in the
+        current directory.
+        Returns the path.
+        """
+        if tracing.events is None:
+            print("No trace is being recorded, use :HelperTraceStart.")
+            return None
+        path = path or time.strftime("gotoword-trace-%Y%m%d-%H%M%S.json")
+        count = tracing.stop(path)
+        print("%s spans were written to %s" % (count, path))
+        return path
+
+    def helper_profile(self, action, argument=""):
+        """Profiles the commands with cProfile.
+        action - 'start' starts profiling the commands that follow,
+            'stop' saves the profile in the current directory as
+            gotoword-DATE.pstats and 'report' displays the functions that
+            took the most time, cumulated, of the profile being recorded or
+            of the last one saved.
+        argument - for 'report', the number of functions to display (30 by
+            default) or a .pstats file to display them from.
+        """
+        if action == "start":
+            profiling.start()
+            print("Profiling; :HelperProfile stop saves the profile.")
+        elif action == "stop":
+            if profiling.profile is None:
+                print("Nothing is being profiled, use :HelperProfile start.")
+                return
+            try:
+                print("The profile was saved to %s" % profiling.stop())
+            except IOError as e:
+                print("The profile can't be saved: %s" % e)
+        elif action == "report":
+            try:
+                if argument.isdigit():
+                    lines = profiling.report(top=int(argument))
+                else:
+                    lines = profiling.report(argument or None)
+            except (IOError, ValueError, EOFError) as e:
+                # not a file, or not a .pstats one
+                print("The profile can't be read: %s" % e)
+                return
+            if not lines:
+                print("There is no profile, use :HelperProfile start.")
+                return
+            self.template.template(lines, header=["Profile of the plugin:"],
+                                   modifiable=False)
+        else:
+            print("Usage: :HelperProfile start|stop|report [N|file]")
 
     def get_test_answer(self, obj):
         """Retrieves first value from App.test_answers list.
@@ -393,6 +759,9 @@ class Template(object):
         # links are words that will lead to other notes (like vim tags)
         self.syntax_group = None
         # words belonging to syntax_group will be highlighted as links
+        self.pages = None
+        # iterator over the pages (lists of lines) of body that are not
+        # displayed yet; they are appended to the buffer while user scrolls
         self.modifiable = True
         # A user shouldn't be allowed to change the buffer after
         # some helper_* methods are executed because they just display data;
@@ -418,8 +787,9 @@ class Template(object):
             observer.post()
 
     #def template(self, *args, **kwargs):
+    @measure
     def template(self, body, header=None, links=[], syntax_group=None,
-                 modifiable=True):
+                 modifiable=True, pages=None):
         """Main method for this class. It chooses the template based on the
         arguments it gets.
         A template mimics the structure and functionality of an HTML document:
@@ -429,11 +799,15 @@ class Template(object):
         Eg:
         >>> t = Template(wrapper, buf_name)
         >>> t.template(body, header, links)
+
+        pages - an iterator of lists of lines that follow body; they are
+        displayed by next_page(), when user scrolls near the end of buffer.
         """
         self.header = header
         self.links = links
         self.syntax_group = syntax_group
         self.modifiable = modifiable
+        self.pages = pages
 
         # call observers before changing the template
         self._update_observers_pre()
@@ -441,7 +815,13 @@ class Template(object):
             self._template_with_header(body, header, links)
         else:
             self._template(body, links)
-        self._update_observers_post()
+        # the commands of the observers are run together, with one switch to
+        # the help buffer
+        self.vim_wrapper.begin()
+        try:
+            self._update_observers_post()
+        finally:
+            self.vim_wrapper.commit()
 
     def _template(self, body, links):
         """
@@ -467,6 +847,19 @@ class Template(object):
         self.vim_wrapper.help_buffer[0:0] = header
         self.vim_wrapper.help_buffer[1:] = body
 
+    def next_page(self):
+        """Appends the next page of body to the help buffer. It's called by
+        the autocmd set by PagerObserver."""
+        page = next(self.pages, None) if self.pages else None
+        if not page:
+            self.pages = None
+            PagerObserver.disable()
+            return
+        self.vim_wrapper.set_option("modifiable", True)
+        self.vim_wrapper.help_buffer.append(page)
+        if not self.modifiable:
+            self.vim_wrapper.set_option("modifiable", False)
+
     def _make_links(self):
         """Calls Helper if word under cursor (<cword>) exists in links."""
         word = vim.eval('expand("<cword>")')
@@ -578,14 +971,15 @@ class LinksObserver(object):
         self.template.vim_wrapper.toggle_activate(clickable, enter)
 
     def _highlight_links(self, group, links):
-        """Highlight the words which are considered links. In Vim, to define
-        the syntax item one would write something like this:
-        syntax match GotowordLinks /Ok\%4l\c\|Cancel\%4l\c/
+        """Highlight the words which are considered links. All links are
+        matched by one syntax item, so that Vim has only one pattern to try
+        on redraw, no matter how many links there are:
+        syntax match GotowordLinks /\c\V\k\@<!\%(Ok\|Cancel\)\k\@!/
         Of course, GotowordLinks needs to be defined already.
         """
-        # TODO: does helper buffer need to be the current buffer?
-        for link in links:
-            vim.command('syntax match %s /%s\c/' % (group, link.name))
+        names = sorted(set(link.name for link in links))
+        self.template.vim_wrapper.toggle_activate(
+            'syntax match %s /%s/' % (group, utils.create_vim_pattern(names)))
 
     def _clear_highlight_links(self, group):
         """Disables syntax highlighting for a group for the current buffer. Eg:
@@ -613,14 +1007,41 @@ class ToggleModifiableObserver(object):
         """Executed before the buffer contents (template) is changed. Useful
         to toggle on/off buffer options like 'modifiable' so that template
         can be changed."""
-        cmd = "set modifiable"
-        self.template.vim_wrapper.toggle_activate(cmd)
+        self.template.vim_wrapper.set_option("modifiable", True)
 
     def post(self):
         """Executed after the new template is displayed."""
         if not self.template.modifiable:
-            cmd = "set nomodifiable"
-            self.template.vim_wrapper.toggle_activate(cmd)
+            self.template.vim_wrapper.set_option("modifiable", False)
+
+
+class PagerObserver(object):
+    """Loads the next page of a paged template when the cursor gets close to
+    the end of the help buffer, so that long lists are displayed without
+    reading them all from database."""
+    margin = 100
+    # lines left below the cursor when next page is loaded
+    augroup = "gotoword_pager"
+
+    def __init__(self, template):
+        self.template = template
+
+    def post(self):
+        "It's called from methods of self.template when template has changed."
+        cmds = ["silent! autocmd! %s" % self.augroup]
+        if self.template.pages:
+            cmds.extend([
+                "augroup %s" % self.augroup,
+                "autocmd CursorMoved <buffer=%s> if line('.') + %s >= "
+                "line('$') | python app.template.next_page() | endif" %
+                (self.template.vim_wrapper.buffer_nr, self.margin),
+                "augroup END"])
+        self.template.vim_wrapper.toggle_activate(*cmds)
+
+    @classmethod
+    def disable(cls):
+        "Removes the autocmd that loads pages."
+        vim.command("silent! autocmd! %s" % cls.augroup)
 
 
 class VimWrapper(object):
@@ -630,8 +1051,12 @@ class VimWrapper(object):
     It is an alternative to the vim python module, by implementing it as an
     interface to a vim server, all commands and expressions are sent to it.
     """
+    has_execute = None
+    # if Vim has the execute() function; checked on first use
     def __init__(self, app=None):
         self.help_buffer = None
+        self.pending = None
+        # commands for help buffer collected between begin() and commit()
 
     #@log
     def setup_help_buffer(self, buffer_name):
@@ -659,7 +1084,9 @@ class VimWrapper(object):
         # vim.eval returns a string that contains a vim list index
         self.buffer_nr = int(buffer_nr)
         #self.help_buffer = HelperBuffer(buffer_name, self)
-        self.help_buffer = vim.buffers[self.buffer_nr]
+        self.help_buffer = stats.CountingBuffer(vim.buffers[self.buffer_nr])
+        # its lines are read and written by Template, counted for
+        # :HelperStats
         logger.debug("help_buffer is: %s with index: %s" %
                      (self.help_buffer, self.buffer_nr),
                      extra={'className': strip(self.__class__)})
@@ -688,24 +1115,23 @@ class VimWrapper(object):
                  that you can import this fct. in other modules, as well, such
                  as the testing module.
         """
-        # save current global value of 'switchbuf' in order to restore it later
-        # and add 'useopen' value to it
-        editor.command("let oldswitchbuf=&switchbuf | set switchbuf+=useopen")
-
-        # open help buffer
-        # 'sbuffer' replaces 'split' because we want to use same buffer window if
-        # it exists because sbuffer checks the switchbuf option
-        editor.command("sbuffer %s" % buffer_name)
-
-        # restore switchbuf to its default value in order not to affect other plugin
-        # functionality:
-        editor.command("let &switchbuf=oldswitchbuf | unlet oldswitchbuf")
-
-        # prevent vim from focusing the helper window created on top, by
-        # focusing the last one used (the window used by user before calling this
-        # plugin).
-        # CTRL-W p   Go to previous (last accessed) window.
-        editor.command('call feedkeys("\<C-w>p")')
+        # all steps are run as one command line, with one call to Vim:
+        editor.command(" | ".join([
+            # save current global value of 'switchbuf' in order to restore it
+            # later and add 'useopen' value to it
+            "let oldswitchbuf=&switchbuf", "set switchbuf+=useopen",
+            # open help buffer
+            # 'sbuffer' replaces 'split' because we want to use same buffer
+            # window if it exists because sbuffer checks the switchbuf option
+            "sbuffer %s" % buffer_name,
+            # restore switchbuf to its default value in order not to affect
+            # other plugin functionality:
+            "let &switchbuf=oldswitchbuf", "unlet oldswitchbuf",
+            # prevent vim from focusing the helper window created on top, by
+            # focusing the last one used (the window used by user before
+            # calling this plugin).
+            # CTRL-W p   Go to previous (last accessed) window.
+            'call feedkeys("\<C-w>p")']))
 
     @staticmethod
     def get_active_buffer():
@@ -714,20 +1140,63 @@ class VimWrapper(object):
         """
         return vim.eval("winbufnr(0)")
 
+    @staticmethod
+    def run_commands(cmds):
+        """Runs a list of Ex commands in the current buffer, with only one call
+        to Vim if Vim has the execute() function (Vim 8), else one by one.
+        """
+        if VimWrapper.has_execute is None:
+            VimWrapper.has_execute = vim.eval("exists('*execute')") == '1'
+        if VimWrapper.has_execute:
+            vim.eval("execute(%s)" % create_vim_string_list(cmds))
+        else:
+            for cmd in cmds:
+                vim.command(cmd)
+
     def toggle_activate(self, *cmds):
         """
         Activate/focus the helper buffer, run a cmd, and then activate/focus
         again the last used buffer.
+        Between begin() and commit(), cmds are only collected.
         """
-        # store old buffer
-        user_buf_nr = self.get_active_buffer()
-        # activate the buffer so we can do other operations on it
-        vim.command("buffer! %s" % self.buffer_nr)
-        # run our operations
-        for cmd in cmds:
-            vim.command(cmd)
-        # make the old buffer active again
-        vim.command("buffer! %s" % user_buf_nr)
+        if self.pending is not None:
+            self.pending.extend(cmds)
+            return
+        self._run_in_help_buffer(list(cmds))
+
+    def begin(self):
+        "Starts collecting the commands given to toggle_activate()."
+        self.pending = []
+
+    def commit(self):
+        "Runs the commands collected since begin()."
+        cmds, self.pending = self.pending, None
+        if cmds:
+            self._run_in_help_buffer(cmds)
+
+    def _run_in_help_buffer(self, cmds):
+        # switch buffers only if help buffer isn't the current one already
+        user_buf_nr = vim.current.buffer.number
+        if user_buf_nr == self.buffer_nr:
+            self.run_commands(cmds)
+            return
+        try:
+            self.run_commands(["buffer! %s" % self.buffer_nr] + cmds +
+                              ["buffer! %s" % user_buf_nr])
+        except vim.error:
+            # make the old buffer active again
+            vim.command("buffer! %s" % user_buf_nr)
+            raise
+
+    def set_option(self, name, value):
+        """Sets a boolean option local to help buffer, like 'modifiable',
+        without switching to help buffer if Vim has buffer.options."""
+        options = getattr(self.help_buffer, 'options', None)
+        if options is not None:
+            options[name] = value
+        else:
+            self.toggle_activate("setlocal %s%s" % ('' if value else 'no',
+                                                    name))
 
 
 class EntryState(object):
@@ -757,7 +1226,7 @@ class EntryState(object):
             # case when kw doesn't exist in DB and context was given by user;
             # context was supplied by user to save keyword in that context;
             # check if it exists in the database (if it is not a new one)
-            ctx = utils.find_model_object(context, utils.Context)
+            ctx = app.store.get_context(context)
             # if context not in DB, ctx will be None, create a new context
             if not ctx:
                 return CreateContextState()
@@ -852,9 +1321,10 @@ class NewKeywordState(object):
     def evaluate(self, app, kw, context, test_answer):
         if not context:
             # use the default context
-            context = utils.Context.objects.get(name="default")
+            context = app.store.get_context("default")
         app.keyword = utils.create_keyword(app.word, context,
-                                           app.vim_wrapper.help_buffer)
+                                           app.vim_wrapper.help_buffer,
+                                           app.store, app.notes_cache)
         app.keyword.current_context = context
         logger.debug('echomsg "keyword %s saved into context %s"' %
                      (app.keyword.name, context.name),
@@ -881,7 +1351,7 @@ class CheckContextState(object):
             answer = get_user_input(message, test_answer)
 
         # validate it
-        context = utils.find_model_object(answer, utils.Context)
+        context = app.store.get_context(answer)
         # debug
         logger.debug("kw: %s, context: %s, test_answer: %s, answer: %s" %
                      (app.keyword, context, test_answer, answer),
@@ -913,6 +1383,7 @@ class CreateContextState(object):
 
         context = utils.Context.objects.create(name=context,
                                                description=answer)
+        app.store.add_context(context)
         # debug
         logger.debug("kw: %s, context: %s, test_answer: %s, answer: %s" %
                      (app.keyword, context, test_answer, answer),
@@ -934,18 +1405,30 @@ class UpdateKeywordState(object):
         if context:
             # user wants to add info in another context than the default one
             # check that given context exists
-            ctx = utils.find_model_object(context, utils.Context)
+            ctx = app.store.get_context(context)
             # if context not in DB, ctx will be None, create a new context
             if not ctx:
                 return CreateContextState()
             current_context = ctx
         current_context = kw.current_context
         utils.update_keyword(kw, current_context,
-                             app.vim_wrapper.help_buffer)
+                             app.vim_wrapper.help_buffer,
+                             cache=app.notes_cache)
         vim.command('echomsg "Info field of keyword \"%s\" updated"' % kw.name)
         return None
 
 
+def create_vim_string_list(values):
+    """Like utils.create_vim_list(), but values can contain any char, because
+    they are written as literal Vim strings, where only ' is escaped.
+
+        >>> create_vim_string_list(["syntax match X /it's/"])
+        "['syntax match X /it''s/']"
+    """
+    return '[%s]' % ', '.join("'%s'" % value.replace("'", "''")
+                              for value in values)
+
+
 def get_user_input(message, test_answer):
     "Returns the user input from vim, displaying a message at the prompt."
     #if test_answer:
@@ -1,10 +1,31 @@
 # -*- coding: utf8 -*-
 
+import sys
+import time
+import Queue
+import atexit
 import logging
 import logging.handlers
+import thread
+import functools
+import threading
+import traceback
+
+
+QUEUE_SIZE = 10000
+# records waiting to be written; more are dropped, and counted
+
+queue_handler = None
+listener = None
+# set by set_up_logging()
 
 
 def set_up_logging(default_level, name=''):
+    """The logger only puts the records in a queue; a thread writes them to
+    the log file and, if the log server of the functional tests is
+    listening, to its socket. So logging doesn't slow down Vim.
+    """
+    global queue_handler, listener
     ### DEBUG -> is the lowest level ###
     #logging.basicConfig(level=default_level)
     # .basicConfig adds a stream handler by default
@@ -14,9 +35,9 @@ def set_up_logging(default_level, name=''):
     #              "- %(message)s")
     formatter = logging.Formatter(msg_format)
 
-    file_handler = logging.FileHandler(filename="gotoword.log",
-                                       mode="w")
+    file_handler = BatchFileHandler(filename="gotoword.log", mode="w")
     file_handler.setFormatter(formatter)
+    handlers = [file_handler]
 
     IP = 'localhost'
     PORT = logging.handlers.DEFAULT_TCP_LOGGING_PORT
@@ -26,6 +47,11 @@ def set_up_logging(default_level, name=''):
     sock_msg_format = "%(message)s"
     socket_formatter = logging.Formatter(sock_msg_format)
     socket_handler.setFormatter(socket_formatter)
+    # connect now, once: if the server isn't listening, we aren't under test
+    # and the handler would retry to connect on every record
+    socket_handler.createSocket()
+    if socket_handler.sock:
+        handlers.append(socket_handler)
 
     # override Logger.makeRecord with a custom one to allow
     # logging facilities used by @log:
@@ -33,11 +59,149 @@ def set_up_logging(default_level, name=''):
     #logger = logging.getLogger('app')
     logger = logging.getLogger(name)
     logger.setLevel(default_level)
-    logger.addHandler(file_handler)
-    logger.addHandler(socket_handler)
+    if listener:
+        # set up again
+        logger.removeHandler(queue_handler)
+        listener.stop()
+    queue = Queue.Queue(QUEUE_SIZE)
+    queue_handler = QueueHandler(queue)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler, *handlers)
+    listener.start()
     return logger
 
 
+def log_server_listening():
+    """Returns True if the log server of the functional tests is listening,
+    so the plugin is under test."""
+    return listener is not None and any(
+        isinstance(handler, logging.handlers.SocketHandler)
+        for handler in listener.handlers)
+
+
+class BatchFileHandler(logging.FileHandler):
+    """FileHandler that writes the records to the file when commit() is
+    called, by QueueListener after each batch, instead of after each record.
+    """
+    def flush(self):
+        pass
+
+    def commit(self):
+        logging.FileHandler.flush(self)
+
+
+class QueueHandler(logging.Handler):
+    """Puts the records in a queue, for a QueueListener; python 2 has no
+    logging.handlers.QueueHandler. If the queue is full, the record is
+    dropped and counted in self.dropped.
+    """
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Formats the message and the exception now, because the args may
+        change before the listener gets the record, and tracebacks can't be
+        kept."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Passes the records queued by a QueueHandler to handlers, in a
+    thread, batch_size records at a time at most. stop() handles the records
+    left in the queue; it is called at exit, too.
+    Eg.:
+        >>> queue_handler = QueueHandler(Queue.Queue(1000))
+        >>> logger.addHandler(queue_handler)
+        >>> QueueListener(queue_handler, file_handler).start()
+    """
+    batch_size = 100
+    _stop = object()
+    # put in the queue by stop()
+
+    def __init__(self, queue_handler, *handlers):
+        self.queue_handler = queue_handler
+        self.queue = queue_handler.queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._monitor,
+                                       name='gotoword logging')
+        self.thread.daemon = True
+        # Vim can exit without waiting for it
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def _monitor(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            records = [record for record in batch if record is not self._stop]
+            try:
+                for record in records:
+                    self.handle(record)
+                for handler in self.handlers:
+                    getattr(handler, 'commit', handler.flush)()
+            except Exception:
+                # the batch is lost, not the thread
+                if logging.raiseExceptions:
+                    traceback.print_exc(None, sys.stderr)
+            if len(records) < len(batch):
+                return
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self, timeout=5):
+        """Writes the records left and stops the thread. If the thread
+        doesn't stop in timeout seconds, it is left running, with its
+        handlers open.
+        """
+        if self.thread is None:
+            return
+        thread, self.thread = self.thread, None
+        start = time.time()
+        try:
+            self.queue.put(self._stop, timeout=timeout)
+        except Queue.Full:
+            # the thread is stuck, or it would empty the queue
+            return
+        thread.join(max(timeout - (time.time() - start), 0))
+        if thread.is_alive():
+            return
+        dropped = self.queue_handler.dropped
+        if dropped:
+            self.handle(logging.makeLogRecord({
+                'msg': "%s log records were dropped, the queue was full" %
+                       dropped,
+                'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'className': '', 'funcName': 'stop'}))
+        for handler in self.handlers:
+            handler.close()
+
+
 def custom_makeRecord(self, name, level, fn, lno, msg, args, exc_info, func=None, extra=None):
         """
         A factory method which can be overridden in subclasses to create
@@ -90,31 +254,73 @@ def logger_as_decorator_factory(logger):
         #decorators = get_decorators(fn)
         #fn = decorators[0]
 
+        @functools.wraps(fn)
         def wrapper(obj, *args, **kwargs):
-            """
-            Because fn is wrapped, the function name when logging, will be
-            'wrapper':
-            >>> fn.__repr__()
-            '<unbound method CheckContextState.wrapper>'
-            """
-            logger.debug('About to run %s with args: %s and kwargs: %s' %
-                         (fn.__name__, args[1:], kwargs),
-                         extra={'className': strip(getattr(obj, '__class__', "")),
-                                'funcName': fn.__name__}
-                         )
+            # functools.wraps keeps the name and docstring of fn, else they
+            # would be those of wrapper:
+            # >>> fn.__repr__()
+            # '<unbound method CheckContextState.wrapper>'
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if not debug and spans is None:
+                # nothing to log or record; args and the return value can
+                # be big (buffers, model instances), don't format them
+                return fn(obj, *args, **kwargs)
+            class_name = strip(getattr(obj, '__class__', ""))
             # getattr() is needed because not all functions decorated by log()
             # are bounded to a class instance.
-            out = fn(obj, *args, **kwargs)
-            logger.debug('Done running %s; return value: %s' %
-                         (fn.__name__, out),
-                         extra={'className': strip(getattr(obj, '__class__', "")),
-                                'funcName': fn.__name__}
-                         )
+            if debug:
+                logger.debug('About to run %s with args: %s and kwargs: %s' %
+                             (fn.__name__, args[1:], kwargs),
+                             extra={'className': class_name,
+                                    'funcName': fn.__name__}
+                             )
+            start = time.time()
+            try:
+                out = fn(obj, *args, **kwargs)
+            finally:
+                if spans is not None:
+                    spans.append((fn.__name__, class_name, start,
+                                  time.time() - start, thread.get_ident()))
+            if debug:
+                logger.debug('Done running %s; return value: %s' %
+                             (fn.__name__, out),
+                             extra={'className': class_name,
+                                    'funcName': fn.__name__}
+                             )
             return out
+        wrapper.records_spans = True
+        # so that other decorators, like stats.measure, don't record the
+        # same calls again
         return wrapper
     return log
 
 
+spans = None
+# (function name, class name, start, duration in seconds, thread id) of
+# every call of a function decorated by @log, while spans are recorded; None
+# otherwise
+
+
+def record_spans():
+    """Starts recording the calls of the functions decorated by @log, even
+    if their logger doesn't log them.
+    Eg.:
+        >>> record_spans()
+        >>> app.helper("canvas")
+        >>> stop_spans()
+        [('helper', 'gotoword.App', 1448960152.27, 0.0031, 140147)]
+    """
+    global spans
+    spans = []
+
+
+def stop_spans():
+    "Stops recording and returns the spans recorded, in the order they ended."
+    global spans
+    recorded, spans = spans, None
+    return recorded or []
+
+
 def get_decorators(function):
     """Get decorators wrapping a function:
     http://schinckel.net/2012/01/20/get-decorators-wrapping-a-function/
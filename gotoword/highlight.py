@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+
+"""Highlights the words of a document that have a note in the database.
+
+All keyword names are compiled into an Aho-Corasick automaton, so a document
+is scanned in one pass, no matter how many keywords there are. Only the
+keywords found in the document become syntax items, in one :syntax keyword
+command and one :syntax match command, so the cost of redrawing depends on
+the document, not on the size of the database.
+"""
+
+### System libraries ###
+import logging
+import threading
+import Queue
+from array import array
+from collections import deque
+
+try:
+    import vim
+except ImportError:
+    # see gotoword.py
+    pass
+
+# gotoword libraries:
+import utils
+import stats
+from gotoword_logging import logger_as_decorator_factory
+
+if 'vim' in globals():
+    vim = stats.CountingVim(vim)
+
+
+logger = logging.getLogger('vim.gotoword.highlight')
+log = logger_as_decorator_factory(logger)
+
+SYNTAX_OPTIONS = frozenset([
+    'contained', 'containedin', 'contains', 'nextgroup', 'transparent',
+    'oneline', 'keepend', 'extend', 'excludenl', 'skipwhite', 'skipnl',
+    'skipempty', 'grouphere', 'groupthere', 'display', 'fold', 'conceal',
+    'concealends', 'cchar'])
+# arguments of :syntax keyword, in any case; Vim reads a keyword named like
+# one of them as the argument
+
+LINE_CACHE_SIZE = 100000
+# lines whose keywords are kept, see scan_lines()
+
+
+class Automaton(object):
+    """Aho-Corasick automaton that finds all occurrences of a set of words in
+    a text in time linear to the length of the text.
+    Eg:
+        >>> a = Automaton([u'he', u'she', u'hers'])
+        >>> list(a.scan(u'ushers'))
+        [(3, u'she'), (3, u'he'), (5, u'hers')]
+    """
+    shift = 21
+    # unicode code points fit in 21 bits, so a transition (state, char) is
+    # stored as the int key state << shift | ord(char) in one dict; it takes
+    # a lot less memory than one dict per state
+
+    def __init__(self, words):
+        self.goto = {}
+        # transitions: state << shift | ord(char) -> next state
+        self.fail = array('l', [0])
+        # fail[state] - state of the longest proper suffix that is in the trie
+        self.report = array('l', [0])
+        # report[state] - closest state on the fail chain, state included,
+        # where a word ends; 0 if there's none
+        self.output = {}
+        # state -> the word that ends in state
+        children = {}
+        # state -> list of (ord(char), child state), needed only by _build
+        self._add_words(words, children)
+        self._build(children)
+
+    def _add_words(self, words, children):
+        "Builds the trie of words."
+        goto, fail, report, output = (self.goto, self.fail, self.report,
+                                      self.output)
+        shift = self.shift
+        for word in words:
+            state = 0
+            for char in word:
+                code = ord(char)
+                key = state << shift | code
+                next_state = goto.get(key)
+                if next_state is None:
+                    next_state = goto[key] = len(fail)
+                    fail.append(0)
+                    report.append(0)
+                    if state in children:
+                        children[state].append((code, next_state))
+                    else:
+                        children[state] = [(code, next_state)]
+                state = next_state
+            if state:
+                output[state] = word
+
+    def _build(self, children):
+        "Computes the fail and report links, breadth first."
+        goto, fail, report, output = (self.goto, self.fail, self.report,
+                                      self.output)
+        queue = deque()
+        for code, child in children.get(0, ()):
+            report[child] = child if child in output else 0
+            queue.append(child)
+        while queue:
+            state = queue.popleft()
+            for code, child in children.get(state, ()):
+                suffix = fail[state]
+                while suffix and (suffix << self.shift | code) not in goto:
+                    suffix = fail[suffix]
+                suffix = goto.get(suffix << self.shift | code, 0)
+                fail[child] = suffix
+                report[child] = child if child in output else report[suffix]
+                queue.append(child)
+
+    def __len__(self):
+        return len(self.output)
+
+    def scan(self, text):
+        """Yields (index of last char, word) for every occurrence of every
+        word in text, overlapping ones included."""
+        goto, fail, report, output = (self.goto, self.fail, self.report,
+                                      self.output)
+        shift = self.shift
+        state = 0
+        for index, char in enumerate(text):
+            code = ord(char)
+            next_state = goto.get(state << shift | code)
+            while next_state is None and state:
+                state = fail[state]
+                next_state = goto.get(state << shift | code)
+            state = next_state or 0
+            found = report[state]
+            while found:
+                yield index, output[found]
+                found = report[fail[found]]
+
+    def find_words(self, text):
+        """Returns the set of words that occur in text as whole words, not as
+        parts of other words. text should be lowercase, like keyword names.
+        """
+        found = set()
+        length = len(text)
+        for end, word in self.scan(text):
+            start = end - len(word) + 1
+            if start and is_word_char(text[start - 1]):
+                continue
+            if end + 1 < length and is_word_char(text[end + 1]):
+                continue
+            found.add(word)
+        return found
+
+
+def is_word_char(char):
+    return char.isalnum() or char == u'_'
+
+
+def is_syntax_keyword(name):
+    """Returns True if name can be in a :syntax keyword command: its chars
+    are in the default 'iskeyword' (@,48-57,_,192-255), which doesn't go
+    above 255, and it isn't an argument of the command."""
+    return name.lower() not in SYNTAX_OPTIONS and all(
+        is_word_char(char) and (char < u'\x80' or u'\xc0' <= char <= u'\xff')
+        for char in name)
+
+
+class Highlighter(object):
+    """Highlights keywords in the buffers of the user, when enabled.
+    Buffers are scanned by a Scanner thread, on a copy of their lines, and
+    the syntax items are updated from a Vim timer when the scan is done, so
+    that Vim doesn't block while a big buffer is scanned. The automaton is
+    rebuilt by the Scanner thread too, when keywords are added; until it is
+    ready the old one is used. Deleted keywords need no rebuild, they are
+    left out when the syntax items are defined. Vim without +timers does all
+    of it on its main thread.
+    Eg:
+        >>> highlighter = Highlighter(app)
+        >>> highlighter.toggle()
+    """
+    group = "GotowordKeywords"
+    # syntax group of keywords; it is linked to GotowordLinks highlight
+    # group in gotoword.vim
+    augroup = "gotoword_highlight"
+    poll_interval = 30
+    # milliseconds between checks for finished scans
+
+    def __init__(self, app):
+        """app - parent app, it provides the keywords store and the help
+        buffer, which is never highlighted."""
+        self.app = app
+        self.enabled = False
+        self.automaton = None
+        self.version = 0
+        # incremented for every new automaton
+        self.stale = True
+        # keywords were added to app.store since the automaton was built
+        self.build = None
+        # BuildJob in progress
+        self.highlighted = set()
+        # numbers of buffers that have syntax items defined by us
+        self.buffers = {}
+        # buffer number -> BufferState, the keywords found in each line
+        self.line_cache = {}
+        # text of a line -> frozenset of keywords found in it; a new cache
+        # is made for every automaton
+        self.scanner = None
+        # worker thread, started when highlighting is enabled
+        self.timer = None
+        # id of the Vim timer that calls poll()
+        app.store.attach(self)
+
+    def loaded(self):
+        self.stale = True
+
+    def keyword_added(self, name):
+        self.stale = True
+        if self.enabled:
+            # start the build now, so it's ready sooner
+            self.keywords()
+
+    def keyword_removed(self, name):
+        # apply() leaves it out
+        pass
+
+    @log
+    def toggle(self):
+        "Enables/disables highlighting. Returns the new state."
+        self.enabled = not self.enabled
+        if self.enabled:
+            # highlight buffers when they are displayed and when their syntax
+            # is reloaded, because that clears our syntax items; after that,
+            # only lines that are changed are scanned again
+            vim.command("augroup %s" % self.augroup)
+            vim.command("autocmd!")
+            vim.command("autocmd BufWinEnter * "
+                        "python app.highlighter.highlight()")
+            vim.command("autocmd Syntax * "
+                        "python app.highlighter.highlight(True)")
+            vim.command("autocmd TextChanged,TextChangedI * "
+                        "python app.highlighter.update()")
+            vim.command("augroup END")
+            if self.scanner is None and vim.eval("has('timers')") == '1':
+                self.scanner = Scanner()
+                self.scanner.start()
+            self.highlight()
+        else:
+            vim.command("autocmd! %s" % self.augroup)
+            self.stop()
+            self.clear()
+        return self.enabled
+
+    def stop(self):
+        """Cancels the scans and the build in progress, stops the timer and
+        the Scanner thread."""
+        for state in self.buffers.values():
+            state.cancel()
+        self.buffers = {}
+        if self.build is not None:
+            self.build.cancelled = True
+            self.build = None
+            # the keywords added are still missing from the automaton
+            self.stale = True
+        if self.timer is not None:
+            vim.eval("timer_stop(%s)" % self.timer)
+            self.timer = None
+        if self.scanner is not None:
+            self.scanner.stop()
+            self.scanner = None
+
+    def clear(self):
+        """Clears the syntax items of every highlighted buffer that is still
+        loaded, with one call to Vim. Other buffers are cleared by switching
+        to them in the current window, without triggering autocommands."""
+        current = vim.current.buffer.number
+        numbers = [int(number) for number in vim.eval(
+            "filter(%s, 'bufloaded(v:val)')" % sorted(self.highlighted))]
+        self.highlighted.clear()
+        cmds = []
+        for number in numbers:
+            if number != current:
+                cmds.append("noautocmd keepalt buffer! %s" % number)
+            cmds.append("syntax clear %s" % self.group)
+        if not cmds:
+            return
+        if numbers != [current]:
+            cmds.append("noautocmd keepalt buffer! %s" % current)
+        self.app.vim_wrapper.run_commands(cmds)
+
+    def keywords(self):
+        """Returns the automaton of the keywords, None if the first one is
+        being built. If keywords were added, a new automaton is built, in
+        the Scanner thread if there is one; the old one is returned until
+        poll() gets the new one.
+        """
+        if self.stale and self.build is None:
+            self.stale = False
+            # names are copied here, the store is changed on this thread
+            job = BuildJob(list(self.app.store.keywords))
+            if self.scanner is None:
+                job.run()
+                self.built(job)
+            else:
+                self.build = job
+                self.scanner.jobs.put(job)
+                self.start_timer()
+        return self.automaton
+
+    def built(self, job):
+        "Starts using the automaton built by job."
+        self.build = None
+        self.automaton = job.automaton
+        self.version += 1
+        self.line_cache = {}
+        logger.debug("automaton built for %s keywords" % len(job.automaton),
+                     extra={'className': ''})
+
+    def scan(self, lines):
+        """Returns the set of keywords that occur in lines.
+        lines - a list of strings, like the ones of a Vim buffer.
+        """
+        found = set()
+        for names in scan_lines(lines, self.keywords(), self.line_cache):
+            found |= names
+        return found
+
+    def highlight(self, reapply=False):
+        """Highlights the keywords in the current buffer.
+        reapply - the syntax items were cleared by Vim, define them again.
+        """
+        buf = vim.current.buffer
+        if not self.enabled or buf.number == self.app.vim_wrapper.buffer_nr:
+            return
+        if self.keywords() is None:
+            # poll() highlights the buffer when the automaton is built
+            return
+        tick = int(vim.eval('b:changedtick'))
+        state = self.buffers.get(buf.number)
+        if state and state.version == self.version and state.tick == tick:
+            # buffer is already scanned
+            if reapply:
+                state.applied = None
+            if not state.job:
+                self.apply(state)
+            return
+        if state:
+            state.cancel()
+        state = BufferState(tick)
+        state.version = self.version
+        self.buffers[buf.number] = state
+        state.replace(0, 0, [None] * len(buf))
+        self.submit(buf, state, 0, len(buf))
+
+    def update(self):
+        """Called when the current buffer changed. It scans again only the
+        lines that changed, the ones between marks '[ and '] (:help '[),
+        unless more than one change happened since last scan."""
+        if not self.enabled:
+            return
+        buf = vim.current.buffer
+        state = self.buffers.get(buf.number)
+        if self.keywords() is None:
+            return
+        if state is None or state.version != self.version:
+            # new buffer or keywords changed
+            return self.highlight()
+        tick, first, last, cursor = [int(value) for value in vim.eval(
+            """[b:changedtick, line("'["), line("']"), line(".")]""")]
+        if tick == state.tick:
+            return
+        # in Insert mode the marks are set only when Insert mode is left, so
+        # the cursor line is changed too, and the one above it when <CR>
+        # split a line
+        start = min(first, max(cursor - 1, 1)) - 1
+        stop = max(last, cursor)
+        delta = len(buf) - len(state.lines)
+        if not (tick == state.tick + 1 and 0 <= start and first <= last and
+                start <= stop - delta <= len(state.lines) and
+                stop <= len(buf)):
+            # several changes, the marks show only the last one
+            start, stop, delta = 0, len(buf), len(buf) - len(state.lines)
+        state.replace(start, stop - delta, [None] * (stop - start))
+        state.tick = tick
+        if state.job:
+            # the lines of the scan in progress must be scanned again too;
+            # they are shifted by delta if they follow the changed lines
+            old_start, old_stop = state.job.start, state.job.stop
+            state.cancel()
+            start, stop = (min(start, shift(old_start, start, stop, delta)),
+                           max(stop, shift(old_stop, start, stop, delta)))
+        self.submit(buf, state, start, stop)
+
+    def submit(self, buf, state, start, stop):
+        """Scans lines start:stop of buf, which are a copy of the lines in
+        state, in the Scanner thread if there is one."""
+        job = ScanJob(buf.number, start, stop, buf[start:stop],
+                      self.automaton, self.line_cache)
+        state.job = job
+        if self.scanner is None:
+            job.run()
+            self.finish(job)
+            return
+        self.scanner.jobs.put(job)
+        self.start_timer()
+
+    def start_timer(self):
+        "Makes Vim call poll() until the jobs of the Scanner are done."
+        if self.timer is None:
+            self.timer = vim.eval("timer_start(%s, g:gotoword_poll, "
+                                  "{'repeat': -1})" % self.poll_interval)
+
+    def poll(self):
+        """Called by a Vim timer, on Vim's main thread, to apply the results
+        of the finished scans and builds. The timer is stopped when no job
+        is left."""
+        while True:
+            try:
+                job = self.scanner.results.get_nowait()
+            except Queue.Empty:
+                break
+            if isinstance(job, BuildJob):
+                self.built(job)
+                if self.enabled:
+                    # scanned again with the new keywords
+                    self.highlight()
+            else:
+                self.finish(job)
+        if self.build is None and not any(state.job for state in
+                                          self.buffers.values()):
+            vim.eval("timer_stop(%s)" % self.timer)
+            self.timer = None
+
+    def finish(self, job):
+        """Stores the keywords found by job and updates the syntax items, if
+        the buffer didn't change since job was submitted."""
+        state = self.buffers.get(job.bufnr)
+        if state is None or state.job is not job:
+            # stale scan
+            return
+        state.replace(job.start, job.stop, job.found)
+        state.job = None
+        if job.bufnr == vim.current.buffer.number:
+            self.apply(state)
+        else:
+            # syntax items are defined for the current buffer only; they will
+            # be applied when the buffer is displayed again
+            state.applied = None
+
+    def apply(self, state):
+        """Replaces the syntax items of the current buffer with ones for the
+        keywords found in it that are in the scope of the store, in one call
+        to Vim, but only if they are not the ones already applied."""
+        in_scope = self.app.store.in_scope
+        names = frozenset(name for name in state.names() if in_scope(name))
+        if names == state.applied:
+            return
+        self.app.vim_wrapper.run_commands(syntax_commands(
+            self.group, names, self.syntax_case()))
+        state.applied = names
+        self.highlighted.add(vim.current.buffer.number)
+
+    def syntax_case(self):
+        """Returns 'ignore' or 'match', the :syntax case set by the syntax
+        file of the current buffer."""
+        try:
+            case = vim.eval("exists('*execute') ? execute('syntax case') : "
+                            "''")
+        except vim.error:
+            # Vim is too old to tell
+            return 'match'
+        return 'ignore' if 'ignore' in case else 'match'
+
+
+def shift(line, start, stop, delta):
+    """Returns the new index of line after lines start:stop - delta were
+    replaced by lines start:stop."""
+    if line >= stop - delta:
+        return line + delta
+    return min(line, stop)
+
+
+NO_NAMES = frozenset()
+
+
+def scan_lines(lines, automaton, cache):
+    """Returns a list with the frozenset of keywords found in each line.
+    cache - dict of line text -> keywords found in it, for this automaton;
+        the texts of a document don't change much between scans.
+    """
+    found = []
+    for line in lines:
+        names = cache.get(line)
+        if names is None:
+            names = automaton.find_words(decode(line).lower())
+            names = frozenset(names) if names else NO_NAMES
+            if len(cache) >= LINE_CACHE_SIZE:
+                cache.clear()
+            cache[line] = names
+        found.append(names)
+    return found
+
+
+class ScanJob(object):
+    """Scan of a copy of some lines of a buffer.
+    It doesn't use the vim module, so it can be run by the Scanner thread.
+    """
+    chunk = 1000
+    # lines scanned between checks for cancellation
+
+    def __init__(self, bufnr, start, stop, lines, automaton, cache):
+        self.bufnr = bufnr
+        self.start = start
+        self.stop = stop
+        # lines start:stop of buffer are scanned
+        self.lines = lines
+        self.automaton = automaton
+        self.cache = cache
+        self.found = []
+        self.cancelled = False
+        # set by Vim's main thread when the buffer changed again
+
+    def run(self):
+        for index in range(0, len(self.lines), self.chunk):
+            if self.cancelled:
+                return
+            self.found.extend(scan_lines(
+                self.lines[index:index + self.chunk], self.automaton,
+                self.cache))
+
+
+class BuildJob(object):
+    """Build of an automaton from a copy of the keyword names, run by the
+    Scanner thread like a ScanJob."""
+    cancelled = False
+
+    def __init__(self, names):
+        self.names = names
+        self.automaton = None
+
+    def run(self):
+        self.automaton = Automaton(self.names)
+
+
+class Scanner(threading.Thread):
+    """Worker thread that runs ScanJobs and BuildJobs. Python threads run
+    while Vim waits for user input, so typing stays responsive while a
+    buffer is scanned.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name="gotoword-scanner")
+        self.daemon = True
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+
+    def stop(self):
+        "Makes the thread exit when the jobs queued before are done."
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            job.run()
+            if not job.cancelled:
+                self.results.put(job)
+
+
+class BufferState(object):
+    """Keywords found in each line of a buffer, so that when the buffer is
+    changed only the changed lines are scanned.
+    """
+    def __init__(self, tick):
+        self.tick = tick
+        # b:changedtick of the buffer when it was scanned
+        self.version = None
+        # version of the automaton used to scan the buffer
+        self.lines = []
+        # frozenset of keywords for each line of the buffer, or None for
+        # the lines that are being scanned
+        self.counts = {}
+        # keyword -> number of lines it occurs in
+        self.applied = None
+        # frozenset of keywords that have syntax items in the buffer
+        self.job = None
+        # ScanJob in progress
+
+    def replace(self, start, stop, lines):
+        "Replaces self.lines[start:stop] with lines, like list slicing."
+        counts = self.counts
+        for names in self.lines[start:stop]:
+            for name in names or ():
+                counts[name] -= 1
+                if not counts[name]:
+                    del counts[name]
+        for names in lines:
+            for name in names or ():
+                counts[name] = counts.get(name, 0) + 1
+        self.lines[start:stop] = lines
+
+    def cancel(self):
+        "Cancels the scan in progress."
+        if self.job:
+            self.job.cancelled = True
+            self.job = None
+
+    def names(self):
+        "Returns the keywords found in the whole buffer."
+        return frozenset(self.counts)
+
+
+def syntax_commands(group, names, case='match'):
+    """Returns the Vim commands that define syntax items of group for names.
+    Names made only of keyword chars go into one :syntax keyword (a hash
+    lookup for Vim), the rest into one :syntax match with an alternation.
+    case - 'match' or 'ignore', the :syntax case of the buffer, which is
+        restored after the items are defined.
+    """
+    keywords = []
+    others = []
+    for name in sorted(names):
+        if is_syntax_keyword(name):
+            keywords.append(name)
+        else:
+            others.append(name)
+    cmds = ['syntax clear %s' % group, 'syntax case ignore']
+    if keywords:
+        cmds.append('syntax keyword %s %s containedin=ALL' %
+                    (group, ' '.join(keywords)))
+    if others:
+        cmds.append('syntax match %s /%s/ containedin=ALL' %
+                    (group, utils.create_vim_pattern(others)))
+    cmds.append('syntax case %s' % case)
+    return cmds
+
+
+def decode(line):
+    "Lines of Vim buffers are byte strings in python 2."
+    if isinstance(line, bytes):
+        return line.decode('utf-8', 'replace')
+    return line
+
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Infers the context of a piece of text from the keywords it contains.
+
+Every keyword found in the text votes for the contexts it has definitions
+in. A keyword defined in only one context is strong evidence for it, so a
+keyword's vote is split between its contexts. The votes are counted with
+NumPy over the keyword x context incidence of the whole database, when
+NumPy is installed; there's a pure python fallback.
+"""
+
+### System libraries ###
+import logging
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# gotoword libraries:
+from highlight import decode
+
+
+logger = logging.getLogger('vim.gotoword.inference')
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+class ContextScorer(object):
+    """Scores the contexts of lines of text.
+    Eg:
+        >>> scorer = ContextScorer(store)
+        >>> context, keywords = scorer.infer(["canvas.add(Color(1, 0, 0))"])
+        >>> context.name, keywords
+        (u'kivy', [u'canvas', u'color'])
+    """
+    generic_context = "default"
+    # holds keywords saved without a context, so it doesn't say anything
+    # about the text; it wins only if no other context scores
+
+    def __init__(self, store):
+        """store - utils.KeywordsStore; keyword ids are used as row indexes
+        of the incidence."""
+        self.store = store
+        self.version = None
+        # version of store the incidence was built from
+        self.rows = {}
+        # keyword id -> slice of its pairs in the arrays below
+        self.columns = None
+        # column (index of context in self.contexts) of every pair
+        self.weights = None
+        # vote of the keyword for that context: 1 / number of its contexts
+        self.contexts = []
+        # context ids, in column order
+
+    def _build(self):
+        """Builds the incidence in coordinate format, from store. The pairs
+        of a keyword are contiguous, so self.rows maps its id to a slice."""
+        self.contexts = sorted(self.store.contexts)
+        column = dict((ctx_id, col) for col, ctx_id in
+                      enumerate(self.contexts))
+        rows = {}
+        columns = []
+        weights = []
+        for kw_id, ctx_ids in self.store.keywords.itervalues():
+            ctx_ids = [ctx_id for ctx_id in set(ctx_ids) if ctx_id in column]
+            rows[kw_id] = slice(len(columns), len(columns) + len(ctx_ids))
+            for ctx_id in ctx_ids:
+                columns.append(column[ctx_id])
+                weights.append(1.0 / len(ctx_ids))
+        self.rows = rows
+        self.columns = numpy.array(columns, dtype=numpy.intp)
+        self.weights = numpy.array(weights)
+        self.version = self.store.version
+
+    def tokenize(self, lines):
+        """Returns the keywords in lines that are in the scope of the store,
+        as a list of tuples (occurrences, (keyword id, context ids)), and
+        their names; both most frequent first."""
+        keywords = self.store.keywords
+        in_scope = self.store.in_scope
+        entries = {}
+        counts = {}
+        order = []
+        for line in lines:
+            for token in TOKEN.findall(decode(line).lower()):
+                if token in counts:
+                    counts[token] += 1
+                    continue
+                entry = keywords.get(token)
+                if entry is None or not in_scope(token):
+                    continue
+                entries[token] = entry
+                counts[token] = 1
+                order.append(token)
+        order.sort(key=lambda name: -counts[name])
+        # sort is stable, so ties keep the order of first occurrence
+        return [(counts[name], entries[name]) for name in order], order
+
+    def score(self, hits):
+        """Returns a dict context id -> weight, for hits as returned by
+        tokenize()."""
+        if not hits:
+            return {}
+        if numpy is None:
+            return self._score_python(hits)
+        if self.version != self.store.version:
+            self._build()
+        pairs = []
+        counts = []
+        for count, (kw_id, ctx_ids) in hits:
+            rows = self.rows[kw_id]
+            pairs.extend(xrange(rows.start, rows.stop))
+            counts.extend([count] * (rows.stop - rows.start))
+        pairs = numpy.array(pairs, dtype=numpy.intp)
+        votes = numpy.array(counts) * self.weights[pairs]
+        weights = numpy.bincount(self.columns[pairs], weights=votes,
+                                 minlength=len(self.contexts))
+        return dict((self.contexts[col], weights[col])
+                    for col in numpy.flatnonzero(weights))
+
+    def _score_python(self, hits):
+        weights = {}
+        for count, (kw_id, ctx_ids) in hits:
+            ctx_ids = set(ctx_ids)
+            for ctx_id in ctx_ids:
+                weights[ctx_id] = (weights.get(ctx_id, 0) +
+                                   float(count) / len(ctx_ids))
+        return weights
+
+    def infer(self, lines):
+        """Returns a tuple (context, keywords): the Context instance that
+        scores best for lines, or None if lines contain no keywords, and the
+        names of the keywords found, most frequent first."""
+        hits, names = self.tokenize(lines)
+        weights = self.score(hits)
+        generic = self.store.context_ids.get(self.generic_context)
+        if len(weights) > 1:
+            weights.pop(generic, None)
+        if not weights:
+            return None, names
+        ctx_id = max(weights, key=lambda ctx_id: (weights[ctx_id],
+                                                  -ctx_id))
+        logger.debug("context weights: %s" % weights, extra={'className': ''})
+        return self.store.contexts[ctx_id], names
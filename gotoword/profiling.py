@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""Profiles the plugin with cProfile, for :HelperProfile.
+
+While a profile is recorded, the commands measured by stats.measure run under
+one cProfile.Profile; commands called by other commands are part of the
+caller's run. stop() saves the profile as a .pstats file, which report() or
+any pstats tool can read later, on another machine too.
+"""
+
+### System libraries ###
+import os
+import time
+import pstats
+import cProfile
+from StringIO import StringIO
+
+
+profile = None
+# cProfile.Profile while profiling, else None
+depth = 0
+# commands running under profile
+last_path = None
+# file saved by the last stop()
+
+
+def start():
+    "Starts profiling; a profile being recorded is discarded."
+    global profile
+    profile = cProfile.Profile()
+
+
+def runcall(fn, *args, **kwargs):
+    "Calls fn under the profile, unless a command that called it is already."
+    global depth
+    if depth:
+        return fn(*args, **kwargs)
+    depth += 1
+    try:
+        return profile.runcall(fn, *args, **kwargs)
+    finally:
+        depth -= 1
+
+
+def stop(directory=""):
+    """Stops profiling and saves the profile in directory, as
+    gotoword-DATE.pstats.
+    Returns the absolute path of the file.
+    """
+    global profile, last_path
+    # absolute, so report() finds it after a :cd
+    path = os.path.abspath(os.path.join(
+        directory, time.strftime("gotoword-%Y%m%d-%H%M%S.pstats")))
+    profile.dump_stats(path)
+    profile = None
+    last_path = path
+    return path
+
+
+class Snapshot(object):
+    """The statistics of a profile, for pstats.Stats, which would disable
+    a profile being recorded to get them."""
+    def __init__(self, profile):
+        profile.snapshot_stats()
+        self.stats = profile.stats
+
+    def create_stats(self):
+        pass
+
+
+def report(source=None, top=30):
+    """Returns, as lines of text, the top functions by cumulative time of
+    source: a .pstats file or, by default, the profile being recorded or
+    the last one saved.
+    Raises IOError or ValueError if source can't be read.
+    """
+    stream = StringIO()
+    source = source or profile or last_path
+    if source is None:
+        return []
+    if isinstance(source, cProfile.Profile):
+        source = Snapshot(source)
+    stats = pstats.Stats(source, stream=stream)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+    return stream.getvalue().strip("\n").splitlines()
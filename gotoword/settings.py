@@ -40,8 +40,18 @@ import standalone.conf
 DATABASE = os.path.join(VIM_PLUGIN_PATH, 'keywords.db')
 
 
-def setup(db='test.db', engine='django.db.backends.sqlite3'):
-    """Calls django's settings() which must be called only once per project."""
+STORAGE = 'django'
+# how the plugin reads and writes the database, see utils.STORAGES
+
+
+def setup(db='test.db', engine='django.db.backends.sqlite3',
+          storage='django'):
+    """Calls django's settings() which must be called only once per project.
+    storage - 'django' to use the ORM for everything or 'sqlite' to run the
+    frequent queries with the sqlite3 module; both work with the same
+    database."""
+    global STORAGE
+    STORAGE = storage
     # fetch the settings and cache them for later use
     init_settings = standalone.conf.settings(
         DATABASES={
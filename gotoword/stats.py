@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Statistics of the commands of the plugin, shown by :HelperStats.
+
+For every command (a method decorated by @measure) it keeps the number of
+calls, the latencies of the last calls and how many SQL statements and calls
+to Vim they made, and how long the statements took. The statements and the
+Vim calls are counted in counters, by storage.SqliteStorage, by the cursors
+of utils.count_queries(), by CountingVim and by CountingBuffer; a command
+records how much the counters grew while it ran.
+"""
+
+### System libraries ###
+import time
+import json
+import functools
+from collections import deque
+
+# gotoword libraries:
+import tracing
+import profiling
+
+
+SAMPLES = 1000
+# latencies kept for every command, to compute the percentiles
+
+
+class Counters(object):
+    "Totals since the plugin started."
+    def __init__(self):
+        self.sql = 0
+        # SQL statements run by storage.SqliteStorage
+        self.orm = 0
+        # SQL statements run by django, through the ORM or its cursors
+        self.sql_time = 0.0
+        # seconds spent running both
+        self.vim = 0
+        # calls of vim.command() and vim.eval(), uses of vim.current and
+        # reads and writes of the lines of a CountingBuffer
+
+
+counters = Counters()
+
+
+def count_statement(start, sql=None, orm=False):
+    """Counts a SQL statement that started at time start and just ended, in
+    counters.orm if django ran it, else in counters.sql; adds it to the
+    trace, if one is recorded."""
+    duration = time.time() - start
+    if orm:
+        counters.orm += 1
+    else:
+        counters.sql += 1
+    counters.sql_time += duration
+    if tracing.events is not None:
+        tracing.add('sql', 'sql', start, duration,
+                    {'sql': sql[:200]} if sql else None)
+
+
+class CountingVim(object):
+    """Stands for the vim module and counts the calls to Vim.
+    Eg.:
+        >>> vim = CountingVim(vim)
+        >>> vim.command("echo 'hello'")
+        >>> counters.vim
+        1
+    """
+    def __init__(self, module):
+        self.module = module
+
+    def command(self, cmd):
+        counters.vim += 1
+        if tracing.events is not None:
+            return self._trace('vim.command', self.module.command, cmd)
+        return self.module.command(cmd)
+
+    def eval(self, expr):
+        counters.vim += 1
+        if tracing.events is not None:
+            return self._trace('vim.eval', self.module.eval, expr)
+        return self.module.eval(expr)
+
+    @property
+    def current(self):
+        # every attribute of vim.current asks Vim
+        counters.vim += 1
+        return self.module.current
+
+    def _trace(self, name, call, argument):
+        start = time.time()
+        try:
+            return call(argument)
+        finally:
+            tracing.add(name, 'vim', start, time.time() - start,
+                        {'arg': argument[:200]})
+
+    def __getattr__(self, name):
+        # buffers, error, etc.
+        return getattr(self.module, name)
+
+
+class CountingBuffer(object):
+    """Stands for a Vim buffer and counts, in counters.vim, the reads and
+    writes of its lines, which are calls to Vim too.
+    Eg.:
+        >>> buf = CountingBuffer(vim.buffers[2])
+        >>> buf[1:] = ["a note"]
+        >>> counters.vim
+        1
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        counters.vim += 1
+        return len(self.buffer)
+
+    def __iter__(self):
+        counters.vim += 1
+        return iter(self.buffer[:])
+
+    def __getitem__(self, key):
+        counters.vim += 1
+        return self.buffer[key]
+
+    def __setitem__(self, key, value):
+        counters.vim += 1
+        self.buffer[key] = value
+
+    def __delitem__(self, key):
+        counters.vim += 1
+        del self.buffer[key]
+
+    # python 2 calls these for buf[i:j], even on new-style classes
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
+    def __setslice__(self, i, j, value):
+        self.__setitem__(slice(i, j), value)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def append(self, lines, *nr):
+        counters.vim += 1
+        self.buffer.append(lines, *nr)
+
+    def __getattr__(self, name):
+        # number, name, options, etc.
+        return getattr(self.buffer, name)
+
+
+class CommandStats(object):
+    "Statistics of one command."
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.time = 0.0
+        self.latencies = deque(maxlen=SAMPLES)
+        # seconds
+        self.sql = 0
+        self.orm = 0
+        self.sql_time = 0.0
+        self.vim = 0
+
+    def add(self, latency, sql, orm, sql_time, vim):
+        self.count += 1
+        self.time += latency
+        self.latencies.append(latency)
+        self.sql += sql
+        self.orm += orm
+        self.sql_time += sql_time
+        self.vim += vim
+
+    def percentile(self, percent):
+        "Returns the latency, in ms, percent % of the last calls are under."
+        latencies = sorted(self.latencies)
+        index = int(round(percent / 100.0 * (len(latencies) - 1)))
+        return latencies[index] * 1000
+
+    def as_dict(self):
+        """Returns the statistics in ms, the counts per call.
+        Eg.:
+            >>> commands['App.helper'].as_dict()
+            {'count': 3, 'p50': 1.2, 'p95': 3.1, 'p99': 3.1, 'mean': 1.8,
+             'sql': 2.0, 'orm': 0.0, 'sql_ms': 0.3, 'vim': 2.0}
+        """
+        return {'count': self.count,
+                'mean': self.time / self.count * 1000,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'sql': float(self.sql) / self.count,
+                'orm': float(self.orm) / self.count,
+                'sql_ms': self.sql_time / self.count * 1000,
+                'vim': float(self.vim) / self.count}
+
+
+commands = {}
+# name -> CommandStats
+
+
+def measure(fn):
+    """Decorator that records the statistics of the calls of a method in
+    commands[ClassName.method_name]. Calls made by other measured methods
+    are counted in both. The method runs under the profiler of :HelperProfile
+    when one is recording.
+    """
+    traced = not getattr(fn, 'records_spans', False)
+    # methods decorated by @log are in the trace already
+
+    @functools.wraps(fn)
+    def wrapper(obj, *args, **kwargs):
+        sql, orm, vim = counters.sql, counters.orm, counters.vim
+        sql_time = counters.sql_time
+        start = time.time()
+        try:
+            if profiling.profile is not None:
+                return profiling.runcall(fn, obj, *args, **kwargs)
+            return fn(obj, *args, **kwargs)
+        finally:
+            latency = time.time() - start
+            name = "%s.%s" % (obj.__class__.__name__, fn.__name__)
+            command = commands.get(name)
+            if command is None:
+                command = commands[name] = CommandStats(name)
+            command.add(latency, counters.sql - sql, counters.orm - orm,
+                        counters.sql_time - sql_time, counters.vim - vim)
+            if traced and tracing.events is not None:
+                tracing.add(name, 'function', start, latency)
+    return wrapper
+
+
+def reset():
+    commands.clear()
+
+
+def report():
+    """Returns the statistics as lines of text, the command that took the
+    most time first."""
+    lines = ["%-32s %6s %8s %8s %8s %7s %7s %8s %7s" % (
+        "command", "calls", "p50 ms", "p95 ms", "p99 ms", "sql", "orm",
+        "sql ms", "vim")]
+    for command in sorted(commands.values(), key=lambda c: -c.time):
+        stats = command.as_dict()
+        lines.append("%-32s %6d %8.2f %8.2f %8.2f %7.1f %7.1f %8.2f %7.1f" % (
+            command.name, stats['count'], stats['p50'], stats['p95'],
+            stats['p99'], stats['sql'], stats['orm'], stats['sql_ms'],
+            stats['vim']))
+    return lines
+
+
+def dump(path, extra=None):
+    """Writes the statistics of all commands to path, as JSON.
+    extra - a dict of other statistics to write, like those of the caches.
+    """
+    data = dict((name, command.as_dict()) for name, command in
+                commands.iteritems())
+    data.update(extra or {})
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,215 @@
+# -*- coding: utf8 -*-
+
+"""Access to the database, for the queries the plugin runs most often.
+
+Storage is the interface; utils.DjangoStorage implements it with the django
+models and SqliteStorage with the sqlite3 module, on the same tables, so
+both work with the same keywords.db. settings.setup(storage=...) chooses
+one of them and utils.get_storage() returns it.
+"""
+
+### System libraries ###
+import time
+import sqlite3
+
+# gotoword libraries:
+import stats
+
+
+SUMMARY_LENGTH = 100
+# max length of Data.summary
+
+# tables created by django-standalone for the models in utils:
+KEYWORD_TABLE = 'standalone_keyword'
+CONTEXT_TABLE = 'standalone_context'
+DATA_TABLE = 'standalone_data'
+RULE_TABLE = 'standalone_contextrule'
+
+
+def summarize(info, info_public):
+    """Returns the one line summary of a note: the first line of user's note
+    if there is one, else the first line of the public note."""
+    note = info if info else info_public
+    return note.split("\n", 1)[0][:SUMMARY_LENGTH]
+
+
+class Storage(object):
+    """Interface of the database.
+    Keywords and contexts are given by name or by id; rows are tuples.
+    Eg.:
+        >>> storage = get_storage()
+        >>> kw_id = storage.create_keyword(u"canvas")
+        >>> storage.save_note(kw_id, kivy_id, u"Define a canvas section")
+        >>> storage.get_notes(u"canvas")
+        [(1, 2, u'kivy', u'Define a canvas section', u'', u'')]
+    """
+    def find_keyword(self, name):
+        "Returns the id of keyword name or None."
+        raise NotImplementedError
+
+    def list_contexts(self):
+        "Returns a list of (id, name, description) tuples, sorted by name."
+        raise NotImplementedError
+
+    def keyword_rows(self):
+        """Returns (name, keyword id, context id) tuples, one for every
+        definition; a keyword without definitions has context id None."""
+        raise NotImplementedError
+
+    def get_notes(self, name):
+        """Returns a list of (keyword id, context id, context name, info,
+        info_public, cmd) tuples, one for every definition of keyword name,
+        sorted by context name. A keyword without definitions has one row
+        with context id None; a word that is not a keyword has none.
+        """
+        raise NotImplementedError
+
+    def create_keyword(self, name):
+        "Creates the keyword and returns its id."
+        raise NotImplementedError
+
+    def save_note(self, keyword_id, context_id, info):
+        """Saves user's note for the definition of the keyword in context,
+        which is created if it doesn't exist."""
+        raise NotImplementedError
+
+    def delete_keyword(self, name):
+        "Deletes the keyword with all its definitions."
+        raise NotImplementedError
+
+    def delete_context(self, name):
+        "Deletes the context with the definitions and the rules in it."
+        raise NotImplementedError
+
+    def list_keywords(self, after=None, limit=500, context_id=None):
+        """Returns at most limit keyword names, sorted, that come after name
+        after; only the ones with a definition in context_id, if given."""
+        raise NotImplementedError
+
+    def keyword_summaries(self, keyword_id):
+        """Returns a list of (context id, context name, summary) tuples, one
+        for every definition of the keyword, sorted by context name."""
+        raise NotImplementedError
+
+    def data_version(self):
+        """Returns a number that changes every time another connection
+        commits changes to the database, or None if it can't tell."""
+        raise NotImplementedError
+
+
+class SqliteStorage(Storage):
+    """Storage that talks to sqlite directly, without the ORM. sqlite3 keeps
+    the statements it has prepared, keyed by their SQL, so every query below
+    is compiled only once per connection.
+    """
+    cached_statements = 64
+
+    tables = dict(keyword=KEYWORD_TABLE, context=CONTEXT_TABLE,
+                  data=DATA_TABLE, rule=RULE_TABLE)
+    FIND_KEYWORD = "SELECT id FROM {keyword} WHERE name = ?".format(**tables)
+    LIST_CONTEXTS = ("SELECT id, name, description FROM {context} "
+                     "ORDER BY name").format(**tables)
+    KEYWORD_ROWS = ("SELECT k.name, k.id, d.context_id FROM {keyword} k "
+                    "LEFT JOIN {data} d ON d.keyword_id = k.id").format(
+                        **tables)
+    GET_NOTES = ("SELECT k.id, d.context_id, c.name, d.info, d.info_public, "
+                 "d.cmd FROM {keyword} k "
+                 "LEFT JOIN {data} d ON d.keyword_id = k.id "
+                 "LEFT JOIN {context} c ON c.id = d.context_id "
+                 "WHERE k.name = ? ORDER BY c.name").format(**tables)
+    CREATE_KEYWORD = "INSERT INTO {keyword} (name) VALUES (?)".format(
+        **tables)
+    FIND_NOTE = ("SELECT id, info_public FROM {data} "
+                 "WHERE keyword_id = ? AND context_id = ?").format(**tables)
+    UPDATE_NOTE = "UPDATE {data} SET info = ?, summary = ? WHERE id = ?".format(
+        **tables)
+    INSERT_NOTE = ("INSERT INTO {data} (keyword_id, context_id, cmd, "
+                   "info_public, info, summary) VALUES (?, ?, '', '', ?, ?)"
+                   ).format(**tables)
+    DELETE_KEYWORD_NOTES = ("DELETE FROM {data} WHERE keyword_id IN "
+                            "(SELECT id FROM {keyword} WHERE name = ?)"
+                            ).format(**tables)
+    DELETE_KEYWORD = "DELETE FROM {keyword} WHERE name = ?".format(**tables)
+    DELETE_CONTEXT_ROWS = [
+        ("DELETE FROM {%s} WHERE context_id IN "
+         "(SELECT id FROM {context} WHERE name = ?)" % table).format(**tables)
+        for table in ('data', 'rule')]
+    DELETE_CONTEXT = "DELETE FROM {context} WHERE name = ?".format(**tables)
+    LIST_KEYWORDS = ("SELECT name FROM {keyword} WHERE name > ? "
+                     "ORDER BY name LIMIT ?").format(**tables)
+    KEYWORD_SUMMARIES = ("SELECT d.context_id, c.name, d.summary "
+                         "FROM {data} d JOIN {context} c ON c.id = d.context_id "
+                         "WHERE d.keyword_id = ? ORDER BY c.name").format(
+                             **tables)
+    LIST_CONTEXT_KEYWORDS = ("SELECT DISTINCT k.name FROM {keyword} k "
+                             "JOIN {data} d ON d.keyword_id = k.id "
+                             "WHERE d.context_id = ? AND k.name > ? "
+                             "ORDER BY k.name LIMIT ?").format(**tables)
+
+    def __init__(self, database):
+        self.database = database
+        self.connection = sqlite3.connect(
+            database, cached_statements=self.cached_statements)
+
+    def execute(self, sql, parameters=()):
+        "Runs a statement, counted in stats.counters."
+        start = time.time()
+        try:
+            return self.connection.execute(sql, parameters)
+        finally:
+            stats.count_statement(start, sql)
+
+    def find_keyword(self, name):
+        row = self.execute(self.FIND_KEYWORD, (name,)).fetchone()
+        return row[0] if row else None
+
+    def list_contexts(self):
+        return self.execute(self.LIST_CONTEXTS).fetchall()
+
+    def keyword_rows(self):
+        return self.execute(self.KEYWORD_ROWS)
+
+    def get_notes(self, name):
+        return self.execute(self.GET_NOTES, (name,)).fetchall()
+
+    def create_keyword(self, name):
+        with self.connection:
+            return self.execute(self.CREATE_KEYWORD, (name,)).lastrowid
+
+    def save_note(self, keyword_id, context_id, info):
+        with self.connection:
+            row = self.execute(self.FIND_NOTE,
+                               (keyword_id, context_id)).fetchone()
+            if row:
+                data_id, info_public = row
+                self.execute(self.UPDATE_NOTE, (
+                    info, summarize(info, info_public), data_id))
+            else:
+                self.execute(self.INSERT_NOTE, (
+                    keyword_id, context_id, info, summarize(info, u'')))
+
+    def delete_keyword(self, name):
+        with self.connection:
+            self.execute(self.DELETE_KEYWORD_NOTES, (name,))
+            self.execute(self.DELETE_KEYWORD, (name,))
+
+    def delete_context(self, name):
+        with self.connection:
+            for sql in self.DELETE_CONTEXT_ROWS:
+                self.execute(sql, (name,))
+            self.execute(self.DELETE_CONTEXT, (name,))
+
+    def list_keywords(self, after=None, limit=500, context_id=None):
+        after = after if after is not None else u''
+        if context_id is None:
+            rows = self.execute(self.LIST_KEYWORDS, (after, limit))
+        else:
+            rows = self.execute(self.LIST_CONTEXT_KEYWORDS,
+                                (context_id, after, limit))
+        return [name for name, in rows]
+
+    def keyword_summaries(self, keyword_id):
+        return self.execute(self.KEYWORD_SUMMARIES, (keyword_id,)).fetchall()
+
+    def data_version(self):
+        return self.execute("PRAGMA data_version").fetchone()[0]
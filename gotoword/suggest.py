@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""Suggests keywords for misspelled words.
+
+The index maps every string that can be obtained by deleting at most
+max_distance chars from the beginning (prefix_length chars) of a keyword to
+the keywords it comes from. A misspelled word within max_distance edits of a
+keyword shares one of these strings with it, so candidates are found by
+looking up the deletes of the word, without comparing it to all keywords.
+"""
+
+### System libraries ###
+import logging
+import threading
+
+
+logger = logging.getLogger('vim.gotoword.suggest')
+
+
+def deletes(word, max_distance):
+    """Returns the set of strings made by deleting at most max_distance chars
+    from word, word included.
+    Eg:
+        >>> sorted(deletes("abc", 1))
+        ['ab', 'abc', 'ac', 'bc']
+    """
+    found = set([word])
+    edge = [word]
+    for distance in range(max_distance):
+        new_edge = []
+        for item in edge:
+            for i in range(len(item)):
+                shorter = item[:i] + item[i + 1:]
+                if shorter not in found:
+                    found.add(shorter)
+                    new_edge.append(shorter)
+        edge = new_edge
+    return found
+
+
+def osa_distance(a, b, max_distance):
+    """Returns the optimal string alignment distance between a and b (edits
+    are insertions, deletions, substitutions and transpositions of adjacent
+    chars) or max_distance + 1 if it is bigger than max_distance.
+    Eg:
+        >>> osa_distance("canvas", "cnavas", 2)
+        1
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = None
+    row = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        before, previous, row = previous, row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            row[j] = min(previous[j] + 1, row[j - 1] + 1,
+                         previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and
+                    a[i - 2] == b[j - 1]):
+                row[j] = min(row[j], before[j - 2] + 1)
+        if min(row) > max_distance and min(previous) > max_distance:
+            # the next rows are computed from these two only, so their
+            # distances can't get smaller
+            return max_distance + 1
+    return min(row[-1], max_distance + 1)
+
+
+class SuggestIndex(object):
+    """Finds the keywords of a KeywordsStore that are close to a word.
+    It is built by a thread started on the first lookup, so that Vim doesn't
+    block while it is built (seconds, for a million keywords); until it is
+    ready there are no suggestions. Then it follows the changes of the store.
+    Eg:
+        >>> index = SuggestIndex(store)
+        >>> index.suggest("cnavas")
+        []
+        >>> index.thread.join()
+        >>> index.suggest("cnavas")
+        [u'canvas']
+    """
+    max_distance = 2
+    prefix_length = 7
+    # only the beginning of the keywords is indexed, which keeps the index
+    # small; candidates are checked against the whole word
+
+    def __init__(self, store):
+        self.store = store
+        self.index = None
+        # delete -> keyword name, or list of names if there are more of them
+        # (most deletes come from one keyword only, and a list for each would
+        # double the size of the index); None until it is built
+        self.thread = None
+        # thread building the index, or None
+        self.changes = []
+        # (method, name) for the keywords added or removed while the thread
+        # builds the index, to be replayed on it
+        self.generation = 0
+        # incremented when the store is reloaded, which makes the index
+        # being built stale
+        self.lock = threading.Lock()
+        store.attach(self)
+
+    def start(self):
+        """Builds the index in a new thread, unless one is building it.
+        Returns the thread."""
+        thread = self.thread
+        if thread is not None:
+            return thread
+        # the names are copied here, the store changes only on this thread
+        self.thread = threading.Thread(
+            target=self.build, name="gotoword-suggest",
+            args=(list(self.store.keywords), self.generation))
+        thread = self.thread
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def build(self, names=None, generation=None):
+        """Builds the index from names, all the names in the store by
+        default."""
+        if names is None:
+            names = list(self.store.keywords)
+            generation = self.generation
+        index = {}
+        for name in names:
+            self._add(name, index)
+        with self.lock:
+            if generation == self.generation:
+                for method, name in self.changes:
+                    method(name, index)
+                self.index = index
+            self.changes = []
+            self.thread = None
+        logger.debug("suggest index built: %s deletes" % len(index),
+                     extra={'className': ''})
+
+    def _add(self, name, index):
+        for key in deletes(name[:self.prefix_length], self.max_distance):
+            names = index.get(key)
+            if names is None:
+                index[key] = name
+            elif type(names) is list:
+                names.append(name)
+            else:
+                index[key] = [names, name]
+
+    def _remove(self, name, index):
+        for key in deletes(name[:self.prefix_length], self.max_distance):
+            names = index.get(key)
+            if names == name:
+                del index[key]
+            elif type(names) is list and name in names:
+                names.remove(name)
+                if len(names) == 1:
+                    index[key] = names[0]
+
+    def _change(self, method, name):
+        with self.lock:
+            if self.index is not None:
+                method(name, self.index)
+            elif self.thread is not None:
+                self.changes.append((method, name))
+
+    def loaded(self):
+        with self.lock:
+            self.index = None
+            self.changes = []
+            self.generation += 1
+
+    def keyword_added(self, name):
+        self._change(self._add, name)
+
+    def keyword_removed(self, name):
+        self._change(self._remove, name)
+
+    def lookup(self, key):
+        "Returns the list of keyword names that have key as a delete."
+        names = self.index.get(key)
+        if names is None:
+            return []
+        return names if type(names) is list else [names]
+
+    def suggest(self, word, limit=10):
+        """Returns at most limit keywords within max_distance edits of word,
+        closest first; only those in the scope of the store."""
+        if self.index is None:
+            self.start()
+            return []
+        word = word.lower()
+        distances = {}
+        in_scope = self.store.in_scope
+        for key in deletes(word[:self.prefix_length], self.max_distance):
+            for name in self.lookup(key):
+                if name not in distances and name != word and \
+                        in_scope(name):
+                    distances[name] = osa_distance(word, name,
+                                                   self.max_distance)
+        names = sorted((distance, name) for name, distance in
+                       distances.iteritems() if distance <= self.max_distance)
+        return [name for distance, name in names[:limit]]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Records what the plugin does, between :HelperTraceStart and
+:HelperTraceStop, as a file in the Chrome Trace Event format, which
+chrome://tracing, Perfetto and speedscope open.
+
+The spans are the calls of the functions decorated by @log (the App methods,
+the states of helper_save, etc.), those of the commands measured by
+stats.measure, the SQL statements and the calls to Vim. A span is a
+complete event ("ph": "X"), so the viewers nest them by time.
+When no trace is recorded, the only cost is a check of tracing.events.
+"""
+
+### System libraries ###
+import os
+import json
+import thread
+
+# gotoword libraries:
+import gotoword_logging
+
+
+events = None
+# trace events recorded since start(); None when not tracing
+
+
+def start():
+    "Starts recording a trace; a trace being recorded is discarded."
+    global events
+    events = []
+    gotoword_logging.record_spans()
+
+
+def add(name, category, start, duration, args=None, thread_id=None):
+    """Adds a span to the trace.
+    start, duration - in seconds, like time.time()
+    args - a dict shown by the viewer with the span, like the SQL statement
+    """
+    event = {'name': name, 'cat': category, 'ph': 'X',
+             'ts': start * 1e6, 'dur': duration * 1e6, 'pid': os.getpid(),
+             'tid': thread_id or thread.get_ident()}
+    if args:
+        event['args'] = args
+    events.append(event)
+
+
+def stop(path):
+    """Stops recording and writes the trace to path.
+    Returns the number of spans written.
+    """
+    global events
+    for name, class_name, start, duration, thread_id in \
+            gotoword_logging.stop_spans():
+        # gotoword.gotoword.App -> App.helper
+        name = "%s.%s" % (class_name.rsplit('.', 1)[-1], name) \
+            if class_name else name
+        add(name, 'function', start, duration, thread_id=thread_id)
+    recorded, events = events, None
+    recorded.sort(key=lambda event: event['ts'])
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': recorded, 'displayTimeUnit': 'ms'}, f)
+    return len(recorded)
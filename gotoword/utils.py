@@ -1,7 +1,20 @@
 # -*- coding: utf8 -*-
 
+from collections import namedtuple, OrderedDict
+import time
+import bisect
+import fnmatch
+
 # import from django-standalone:
 from standalone import models
+from django.db import connection, transaction, OperationalError
+from django.db.backends.utils import CursorWrapper
+
+# gotoword libraries:
+import settings
+import storage
+import stats
+from storage import summarize
 # Read more about models:
 # https://docs.djangoproject.com/en/1.7/topics/db/models/
 #from gotoword_logging import logger, log
@@ -72,16 +85,44 @@ class Data(models.StandaloneModel):
     info_public(keyword, context)
     info(keyword, context)
     cmd(keyword, context)
+    summary - first line of the note, kept up to date on every save, so
+        that listings don't need to load whole notes.
     """
     keyword = models.ForeignKey(Keyword)
     context = models.ForeignKey(Context)
     cmd = models.CharField("cmd to run to obtain info", max_length=100)
     info_public = models.TextField("info note publicly available")
     info = models.TextField("note with user's own data")
+    summary = models.CharField("first line of the note",
+                               max_length=storage.SUMMARY_LENGTH,
+                               blank=True)
 
     def __unicode__(self):
         return self.keyword.name + self.context.name
 
+    def save(self, *args, **kwargs):
+        self.summary = summarize(self.info, self.info_public)
+        super(Data, self).save(*args, **kwargs)
+
+
+class ContextRule(models.StandaloneModel):
+    """Tells which contexts the documents of a filetype or a path belong to,
+    so that only the keywords of those contexts are loaded while user edits
+    them.
+    pattern - a vim filetype, like "python", or a glob matched against the
+        full path of the file, like "*.kv" or "*/kivy/*".
+    Eg.:
+        ContextRule.objects.create(context=kivy, pattern="*.kv")
+    """
+    class Meta:
+        ordering = ['pattern']
+        unique_together = ('context', 'pattern')
+    context = models.ForeignKey(Context)
+    pattern = models.CharField("filetype or path glob", max_length=100)
+
+    def __unicode__(self):
+        return self.pattern + " " + self.context.name
+
 
 def initialize(database):
     '''This should be run only once, to create the db, maybe when the script
@@ -92,18 +133,578 @@ def initialize(database):
     pass
 
 
+NOTE_SQL = "CASE WHEN info <> '' THEN info ELSE info_public END"
+SUMMARY_UPDATE = (
+    "UPDATE {data} SET summary = substr(substr({note}, 1, "
+    "instr({note} || char(10), char(10)) - 1), 1, {length})").format(
+        data=Data._meta.db_table, note=NOTE_SQL,
+        length=storage.SUMMARY_LENGTH)
+# storage.summarize() of every note, in SQL
+
+
+def upgrade_database():
+    '''Brings a database created by an older version of this plugin up to
+    date with the models. It is cheap when there's nothing to do, so it can be
+    run every time the plugin is loaded.
+    '''
+    with transaction.atomic():
+        cursor = connection.cursor()
+        if ContextRule._meta.db_table not in \
+                connection.introspection.table_names(cursor):
+            with connection.schema_editor() as editor:
+                editor.create_model(ContextRule)
+        columns = [column[0] for column in
+                   connection.introspection.get_table_description(
+                       cursor, Data._meta.db_table)]
+        if 'summary' not in columns:
+            with connection.schema_editor() as editor:
+                editor.add_field(Data, Data._meta.get_field('summary'))
+            if connection.vendor == 'sqlite':
+                # one statement, not one per note: databases can have
+                # millions of them
+                cursor.execute(SUMMARY_UPDATE)
+            else:
+                rows = Data.objects.values_list('id', 'info', 'info_public')
+                for data_id, info, info_public in rows:
+                    Data.objects.filter(id=data_id).update(
+                        summary=summarize(info, info_public))
+        create_search_index(cursor)
+
+
+SEARCH_TABLE = Data._meta.db_table + "_fts"
+# FTS5 index of the notes; it keeps no copy of the text, it reads it from
+# Data's table
+
+SEARCH_TRIGGERS = [
+    # keep the index in sync with Data, whatever changes it (the ORM, raw SQL,
+    # cascading deletes)
+    '''CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {data} BEGIN
+        INSERT INTO {index}(rowid, info, info_public)
+        VALUES (new.id, new.info, new.info_public);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {data} BEGIN
+        INSERT INTO {index}({index}, rowid, info, info_public)
+        VALUES ('delete', old.id, old.info, old.info_public);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE ON {data} BEGIN
+        INSERT INTO {index}({index}, rowid, info, info_public)
+        VALUES ('delete', old.id, old.info, old.info_public);
+        INSERT INTO {index}(rowid, info, info_public)
+        VALUES (new.id, new.info, new.info_public);
+    END''',
+]
+
+
+def create_search_index(cursor):
+    '''Creates the full-text index of the notes, if sqlite supports FTS5.
+    Rebuilds it when its triggers are missing, because sqlite drops them
+    when Data's table is rebuilt by a schema change.
+    Returns True if the index exists.
+    '''
+    if connection.vendor != 'sqlite':
+        return False
+    cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'trigger' "
+                   "AND tbl_name = %s", [Data._meta.db_table])
+    if cursor.fetchone()[0] == len(SEARCH_TRIGGERS):
+        return True
+    names = dict(index=SEARCH_TABLE, data=Data._meta.db_table)
+    try:
+        with transaction.atomic():
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING "
+                           "fts5(info, info_public, content='{data}', "
+                           "content_rowid='id')".format(**names))
+    except OperationalError:
+        # sqlite was built without FTS5
+        return False
+    for trigger in SEARCH_TRIGGERS:
+        cursor.execute(trigger.format(**names))
+    cursor.execute("INSERT INTO {index}({index}) VALUES ('rebuild')".format(
+        **names))
+    return True
+
+
+SearchHit = namedtuple('SearchHit', 'keyword context snippet')
+
+
+def fts_query(query):
+    '''Turns user's words into an FTS5 query that matches notes containing
+    all of them, so that punctuation in the words is not taken as query
+    syntax. A word ending in * matches words that start with it.
+    Eg.:
+        >>> fts_query('canvas add*')
+        u'"canvas" "add"*'
+    '''
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if word:
+            terms.append(u'"%s"%s' % (word.replace('"', '""'),
+                                      '*' if prefix else ''))
+    return u' '.join(terms)
+
+
+def search_notes(query, limit=100):
+    '''Searches the notes for words in query, the best matches first.
+    Returns a list of SearchHit(keyword name, context name, snippet) or None
+    if the full-text index doesn't exist.
+    Eg.:
+        >>> search_notes("graphics instructions")
+        [SearchHit(keyword=u'canvas', context=u'kivy',
+                   snippet=u'...you can add Graphics instructions that...')]
+    '''
+    query = fts_query(query)
+    if not query:
+        return []
+    sql = '''SELECT k.name, c.name,
+                    snippet({index}, -1, '', '', '...', 12)
+             FROM {index} JOIN {data} d ON d.id = {index}.rowid
+             JOIN {keyword} k ON k.id = d.keyword_id
+             JOIN {context} c ON c.id = d.context_id
+             WHERE {index} MATCH %s ORDER BY rank LIMIT %s'''.format(
+        index=SEARCH_TABLE, data=Data._meta.db_table,
+        keyword=Keyword._meta.db_table, context=Context._meta.db_table)
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql, [query, limit])
+    except OperationalError:
+        # no index
+        return None
+    return [SearchHit(name, ctx_name, u" ".join(snippet.split()))
+            for name, ctx_name, snippet in cursor.fetchall()]
+
+
 def load_keywords_store(database):
     '''Creates a connection to the database and loads all keywords.
-    Probably, it should first identify the context, and load the keywords
-    from that context, not all keywords in db.
     This function should be ran when the plugin is loaded.
 
     database - a string of the form SCHEME:PATH where:
     scheme - sqlite, postgresql, mysql, etc.
     path - it can be an absolute path.
     eg. '/home/user1/data.db' or 'data.db' for file in current dir.
+    The connection itself is the one configured by settings.setup(database).
+
+    Returns a KeywordsStore instance.
     '''
-    pass
+    store = KeywordsStore(database)
+    store.load()
+    return store
+
+
+GLOB_CHARS = set('*?[/')
+# a rule pattern that contains any of these is a path glob, not a filetype
+
+
+def match_contexts(rules, filetype, path):
+    '''Finds the contexts of a document.
+    rules - a list of (context id, pattern) tuples, see ContextRule.
+    filetype - vim's &filetype of the document; a compound filetype, like
+        "htmldjango.html", matches the rules of each of its parts.
+    path - full path of the document.
+
+    Returns a frozenset of context ids or None if no rule matches.
+    Eg.:
+        >>> match_contexts([(1, "*.kv"), (2, "python")], "", "/tmp/app.kv")
+        frozenset([1])
+    '''
+    filetypes = filetype.split('.') if filetype else []
+    contexts = frozenset(ctx_id for ctx_id, pattern in rules
+                         if (fnmatch.fnmatch(path, pattern)
+                             if GLOB_CHARS.intersection(pattern)
+                             else pattern in filetypes))
+    return contexts or None
+
+
+class KeywordsStore(object):
+    """In-memory index of the database, so that the plugin can tell if a word
+    is a keyword and which contexts it has definitions in, without querying
+    the database.
+    It holds only keyword names, keyword ids and context ids, plus the whole
+    Context table, which is small. Notes (Data.info, etc.) are not loaded.
+    Eg.:
+        >>> store = load_keywords_store(DATABASE)
+        >>> store.find("canvas")
+        (1, (2, 5))
+        >>> [ctx.name for ctx in store.keyword_contexts("canvas")]
+        [u'kivy', u'python']
+    """
+    def __init__(self, database=None):
+        self.database = database
+        self.keywords = {}
+        # keyword name -> (keyword id, tuple of context ids)
+        self.contexts = {}
+        # context id -> Context instance
+        self.context_ids = {}
+        # context name -> context id
+        self.version = 0
+        # incremented on every change, so that users of the store know when
+        # to rebuild what they computed from it
+        self.scope = None
+        # frozenset of the ids of the contexts the document being edited
+        # belongs to, or None; all keywords are loaded anyway, the scope
+        # only filters them, see in_scope()
+        self.observers = []
+        # objects that keep an index of the keyword names, see NameIndex
+
+    def attach(self, observer):
+        '''observer will be told about every change of the keyword names
+        by calls to observer.loaded(), observer.keyword_added(name) and
+        observer.keyword_removed(name).'''
+        self.observers.append(observer)
+
+    def load(self):
+        "Reads all keywords and contexts from database, in 2 queries."
+        db = get_storage()
+        self.contexts = {}
+        self.context_ids = {}
+        for ctx_id, name, description in db.list_contexts():
+            self.add_context(Context(id=ctx_id, name=name,
+                                     description=description))
+
+        keywords = {}
+        # one row for every (keyword, context) pair; keywords without a
+        # definition come with context id None because of the LEFT JOIN
+        for name, kw_id, ctx_id in db.keyword_rows():
+            ctx_ids = keywords[name][1] if name in keywords else ()
+            if ctx_id is not None:
+                ctx_ids += (ctx_id,)
+            keywords[name] = (kw_id, ctx_ids)
+        self.keywords = keywords
+        self.version += 1
+        for observer in self.observers:
+            observer.loaded()
+
+    def set_scope(self, contexts=None):
+        '''Narrows the keywords used for highlighting, completion,
+        suggestions and context inference to the ones that have a definition
+        in contexts, an iterable of context ids, or to all if it's None.
+        It doesn't read the database, so it's cheap to switch between the
+        scopes of different documents, and it doesn't change the version:
+        what was computed from all keywords is still good.
+        '''
+        self.scope = None if contexts is None else frozenset(contexts)
+
+    def in_scope(self, name):
+        "Returns True if keyword name has a definition in the scope."
+        entry = self.keywords.get(name)
+        if entry is None:
+            return False
+        return self.scope is None or not self.scope.isdisjoint(entry[1])
+
+    def __contains__(self, name):
+        return name in self.keywords
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def find(self, name):
+        """Returns a tuple (keyword id, tuple of context ids) or None if name
+        is not a keyword."""
+        return self.keywords.get(name)
+
+    def keyword_contexts(self, name):
+        """Returns a list of Context instances keyword has definitions in,
+        sorted by name, like Keyword.contexts.all() would."""
+        entry = self.keywords.get(name)
+        if not entry:
+            return []
+        contexts = [self.contexts[ctx_id] for ctx_id in set(entry[1])
+                    if ctx_id in self.contexts]
+        contexts.sort(key=lambda ctx: ctx.name)
+        return contexts
+
+    def get_context(self, name):
+        """Returns the Context instance with this name or None.
+        name - a string; a Context instance is accepted too, like the ORM
+        lookups do.
+        """
+        ctx_id = self.context_ids.get(getattr(name, 'name', name))
+        if ctx_id is None:
+            return None
+        return self.contexts[ctx_id]
+
+    def add_context(self, context):
+        "context - a Context instance which is already saved to database."
+        self.contexts[context.id] = context
+        self.context_ids[context.name] = context.id
+
+    def remove_context(self, name):
+        """Removes context and the definitions belonging to it, as the
+        database does when a context is deleted."""
+        ctx_id = self.context_ids.pop(name, None)
+        if ctx_id is None:
+            return
+        del self.contexts[ctx_id]
+        self.version += 1
+        for kw_name, (kw_id, ctx_ids) in self.keywords.items():
+            if ctx_id in ctx_ids:
+                self.keywords[kw_name] = (kw_id, tuple(
+                    i for i in ctx_ids if i != ctx_id))
+
+    def add_keyword(self, keyword, context=None):
+        """Adds a keyword or a new definition of the keyword, in context.
+        keyword - a Keyword instance which is already saved to database.
+        context - a Context instance.
+        """
+        is_new = keyword.name not in self
+        ctx_ids = () if is_new else self.keywords[keyword.name][1]
+        if context is not None and context.id not in ctx_ids:
+            ctx_ids += (context.id,)
+        self.keywords[keyword.name] = (keyword.id, ctx_ids)
+        self.version += 1
+        if is_new:
+            for observer in self.observers:
+                observer.keyword_added(keyword.name)
+
+    def remove_keyword(self, name):
+        if self.keywords.pop(name, None) is None:
+            return
+        self.version += 1
+        for observer in self.observers:
+            observer.keyword_removed(name)
+
+
+class NameIndex(object):
+    '''Keyword names of a KeywordsStore in sorted order, for completion: the
+    names starting with a prefix are next to each other, so they are found
+    by binary search. It follows the changes of the store.
+    Eg.:
+        >>> index = NameIndex(store)
+        >>> index.complete("ca")
+        [u'canvas', u'case']
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.names = []
+        self.loaded()
+        store.attach(self)
+
+    def loaded(self):
+        self.names = sorted(self.store.keywords)
+
+    def keyword_added(self, name):
+        bisect.insort_left(self.names, name)
+
+    def keyword_removed(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            del self.names[i]
+
+    def complete(self, prefix, context=None, limit=50):
+        '''Returns at most limit names that start with prefix, sorted.
+        prefix - it is lowercased, like the names are
+        context - a context id; if given, only names that have a definition
+            in this context are returned, else only those in the scope of
+            the store.
+        '''
+        prefix = prefix.lower()
+        names = self.names
+        keywords = self.store.keywords
+        in_scope = self.store.in_scope
+        matches = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and len(matches) < limit:
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            if (in_scope(name) if context is None
+                    else context in keywords[name][1]):
+                matches.append(name)
+            i += 1
+        return matches
+
+
+class NoteCache(object):
+    """The notes displayed last, as lists of lines ready for the help buffer,
+    so that displaying a note again doesn't read the database.
+    Keys are (keyword name, context id) tuples; when size notes are cached,
+    the least recently used one is dropped.
+    Notes changed by this plugin have to be invalidated by the code that
+    changes them. Changes made by other processes (another Vim) are noticed
+    by check(), from sqlite's data_version; they clear the whole cache and
+    reload store, the KeywordsStore, if one is given. It costs a query, so
+    it's called once per command, not by get() and put().
+    Eg.:
+        >>> cache = NoteCache()
+        >>> cache.put((u"canvas", 2), [u"Define a canvas section"])
+        >>> cache.get((u"canvas", 2))
+        [u'Define a canvas section']
+        >>> cache.hits, cache.misses
+        (1, 0)
+    """
+    def __init__(self, size=200, store=None):
+        self.size = size
+        self.store = store
+        self.notes = OrderedDict()
+        # least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.data_version = None
+
+    def check(self):
+        """Clears the cache and reloads the store if another process has
+        changed the database since the last check."""
+        version = get_storage().data_version()
+        if version != self.data_version:
+            self.notes.clear()
+            if self.data_version is not None and self.store is not None:
+                # keywords may have been added or deleted too
+                self.store.load()
+            self.data_version = version
+
+    def get(self, key):
+        "Returns the lines of the note or None if it isn't cached."
+        lines = self.notes.pop(key, None)
+        if lines is None:
+            self.misses += 1
+            return None
+        self.notes[key] = lines
+        self.hits += 1
+        return lines
+
+    def put(self, key, lines):
+        self.notes.pop(key, None)
+        self.notes[key] = lines
+        if len(self.notes) > self.size:
+            self.notes.popitem(last=False)
+
+    def as_dict(self):
+        """Returns the counters, for :HelperStats.
+        Eg.:
+            >>> cache.as_dict()
+            {'hits': 1, 'misses': 0, 'notes': 1, 'size': 200}
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'notes': len(self.notes), 'size': self.size}
+
+    def reset(self):
+        "Resets the counters."
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, keyword=None, context=None):
+        """Drops the notes of keyword (a name) or of context (an id), or all
+        notes if none is given."""
+        if keyword is None and context is None:
+            self.notes.clear()
+            return
+        for key in list(self.notes):
+            if key[0] == keyword or key[1] == context:
+                del self.notes[key]
+
+
+class DjangoStorage(storage.Storage):
+    "storage.Storage that uses the models above."
+    def __init__(self, database=None):
+        self.database = database
+
+    def find_keyword(self, name):
+        ids = list(Keyword.objects.filter(name=name).values_list('id',
+                                                                 flat=True))
+        return ids[0] if ids else None
+
+    def list_contexts(self):
+        return list(Context.objects.values_list('id', 'name', 'description'))
+
+    def keyword_rows(self):
+        return Keyword.objects.values_list('name', 'id',
+                                           'data__context_id').order_by()
+
+    def get_notes(self, name):
+        return list(Keyword.objects.filter(name=name).values_list(
+            'id', 'data__context_id', 'data__context__name', 'data__info',
+            'data__info_public', 'data__cmd').order_by('data__context__name'))
+
+    def create_keyword(self, name):
+        return Keyword.objects.create(name=name).id
+
+    def save_note(self, keyword_id, context_id, info):
+        try:
+            data = Data.objects.get(keyword_id=keyword_id,
+                                    context_id=context_id)
+        except Data.DoesNotExist:
+            data = Data(keyword_id=keyword_id, context_id=context_id)
+        data.info = info
+        # saving updates the summary as well
+        data.save()
+
+    def delete_keyword(self, name):
+        # the ORM deletes the definitions, too
+        Keyword.objects.filter(name=name).delete()
+
+    def delete_context(self, name):
+        Context.objects.filter(name=name).delete()
+
+    def list_keywords(self, after=None, limit=500, context_id=None):
+        names = Keyword.objects.order_by('name')
+        if context_id is not None:
+            names = names.filter(data__context_id=context_id).distinct()
+        if after is not None:
+            names = names.filter(name__gt=after)
+        return list(names.values_list('name', flat=True)[:limit])
+
+    def keyword_summaries(self, keyword_id):
+        return list(Data.objects.filter(keyword_id=keyword_id).values_list(
+            'context_id', 'context__name', 'summary').order_by(
+                'context__name'))
+
+    def data_version(self):
+        if connection.vendor != 'sqlite':
+            return None
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA data_version")
+        return cursor.fetchone()[0]
+
+
+STORAGES = {
+    'django': DjangoStorage,
+    'sqlite': storage.SqliteStorage,
+}
+
+_storage = None
+
+
+def get_storage():
+    """Returns the storage.Storage chosen by settings.setup(), for the
+    database django is configured with."""
+    global _storage
+    if _storage is None:
+        _storage = STORAGES[settings.STORAGE](
+            connection.settings_dict['NAME'])
+    return _storage
+
+
+class CountingCursorWrapper(CursorWrapper):
+    "Cursor that counts its statements in stats.counters."
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).execute(sql, params)
+        finally:
+            stats.count_statement(start, sql, orm=True)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).executemany(sql,
+                                                                  param_list)
+        finally:
+            stats.count_statement(start, sql, orm=True)
+
+
+def count_queries():
+    """Makes the statements run by django, through the ORM or a cursor,
+    count in stats.counters. Django 1.7 has no connection.execute_wrapper(),
+    so connection.cursor() is wrapped.
+    """
+    if getattr(connection, 'counting', False):
+        return
+    cursor = connection.cursor
+
+    def counting_cursor():
+        return CountingCursorWrapper(cursor(), connection)
+    connection.cursor = counting_cursor
+    connection.counting = True
 
 
 def find_model_object(name, model=None):
@@ -126,6 +727,88 @@ def find_model_object(name, model=None):
             return None
     return model_obj
 
+
+def keyword_summaries(keyword):
+    '''Returns a list of (context, summary) tuples, one for every context
+    keyword has a definition in, sorted by context name. It takes one query
+    and it doesn't load the notes, only their summaries.
+    context - a Context instance; only its id and name are loaded.
+    '''
+    rows = get_storage().keyword_summaries(keyword.id)
+    return [(Context(id=ctx_id, name=ctx_name), summary)
+            for ctx_id, ctx_name, summary in rows]
+
+
+def iter_keyword_names(context=None, page_size=500):
+    '''Like iter_names(), for keyword names, through the storage.
+    context - a context id; if given, only the keywords that have a
+        definition in this context are listed.
+    '''
+    db = get_storage()
+    page = db.list_keywords(limit=page_size, context_id=context)
+    while page:
+        yield page
+        if len(page) < page_size:
+            return
+        page = db.list_keywords(page[-1], page_size, context)
+
+
+def iter_names(queryset, page_size=500):
+    '''Yields the names of queryset's objects in alphabetical order, as
+    lists of at most page_size names.
+    queryset - a queryset of Keyword or Context or anything with a 'name'
+        field that is unique and indexed.
+
+    Every page is a separate query that starts after the last name of the
+    previous page (keyset pagination), so no cursor is kept open between
+    pages and memory doesn't grow with the size of the table. Django's
+    sqlite backend reads the whole result set of a query even when
+    .iterator() is used, so streaming one big query wouldn't do.
+    Eg.:
+        >>> pages = iter_names(Keyword.objects.all(), 2)
+        >>> next(pages)
+        [u'canvas', u'color']
+    '''
+    names = queryset.order_by('name').values_list('name', flat=True)
+    page = list(names[:page_size])
+    while page:
+        yield page
+        if len(page) < page_size:
+            return
+        page = list(names.filter(name__gt=page[-1])[:page_size])
+
+
+Note = namedtuple('Note', 'context info info_public cmd')
+"""A definition of a keyword, as returned by resolve_keyword().
+context - a Context instance; only its id and name are loaded.
+"""
+
+
+def resolve_keyword(name):
+    '''Looks up the keyword and all its definitions in one joined query.
+    name - any string
+
+    Returns a tuple (keyword, notes), where keyword is a Keyword instance or
+    None if name is not a keyword and notes is a list of Note tuples, sorted
+    by context name.
+    Eg.:
+        >>> keyword, notes = resolve_keyword("canvas")
+        >>> [(note.context.name, note.info) for note in notes]
+        [(u'kivy', u'Define a canvas section ...'), (u'python', u'...')]
+    '''
+    keyword = None
+    notes = []
+    for kw_id, ctx_id, ctx_name, info, info_public, cmd in \
+            get_storage().get_notes(name):
+        if keyword is None:
+            keyword = Keyword(id=kw_id, name=name)
+        if ctx_id is None:
+            # keyword has no definitions (LEFT JOIN)
+            continue
+        notes.append(Note(Context(id=ctx_id, name=ctx_name), info,
+                          info_public, cmd))
+    return keyword, notes
+
 #def find_context(context, store=None):
 #    try:
 #        context = Context.objects.get(name=context)
@@ -145,32 +828,37 @@ def find_model_object(name, model=None):
 #    #if not hasattr(word, "name"):
 #    #    keyword = Keyword(name=word)
 
-def create_keyword(word, context, buf, store=None):
+def create_keyword(word, context, buf, store=None, cache=None):
     '''Creates a new keyword with name=word and adds contents from vim buffer
     as information for the keyword and updates the database.
+    cache - a NoteCache whose notes of word are stale after this
     Returns the keyword.
     '''
 
-    keyword = Keyword.objects.create(name=word)
-    # create the ManyToMany relationship
-    r1 = Data(keyword=keyword, context=context)
-    r1.save()
+    db = get_storage()
+    kw_id = db.find_keyword(word)
+    if kw_id is None:
+        kw_id = db.create_keyword(word)
+    # else another Vim created it since the store was loaded
+    keyword = Keyword(id=kw_id, name=word)
     #r1.info_public = "http://kivy.org/docs/api-kivy.graphics.html#kivy.graphics.Canvas"
     #r1.info = ("Define a canvas section in which you can add Graphics "
     #           "instructions that define how the widget is rendered.")
     #r1.save()
     buf_content = read_vim_buffer(buf, 0)
-    update_info(keyword, context, buf_content, store)
+    update_info(keyword, context, buf_content, store, cache)
+    if store is not None:
+        store.add_keyword(keyword, context)
     return keyword
 
 
 # TODO: unit tests for all these functions
-def update_keyword(keyword, context, buf, store=None):
+def update_keyword(keyword, context, buf, store=None, cache=None):
     '''Reads contents from vim buffer except for the title line and updates
     the keyword's info (personal note), not info_public.
     '''
     content = read_vim_buffer(buf, 1)
-    update_info(keyword, context, content, store)
+    update_info(keyword, context, content, store, cache)
     #store.find(Keyword, Keyword.name == keyword.name).set(info=buf_content)
     # write to DB file
     return keyword
@@ -184,11 +872,11 @@ def read_vim_buffer(buf, start_line):
     return buf_content
 
 
-def update_info(keyword, context, content, store):
+def update_info(keyword, context, content, store, cache=None):
     'Updates the keyword information and commits to database.'
-    data = keyword.data_set.get(context=context)
-    data.info = content
-    data.save()
+    get_storage().save_note(keyword.id, context.id, content)
+    if cache is not None:
+        cache.invalidate(keyword.name)
     # maybe content replaced with info, and info_public added
 
 
@@ -223,6 +911,23 @@ def create_vim_list(values):
     #return '[%s]' % ', '.join("\"%s\"" % elem for elem in values)
 
 
+def create_vim_pattern(words):
+    r"""Creates one Vim regex that matches any of words, ignoring case, but
+    only as whole words.
+
+        >>> print(create_vim_pattern(['canvas', 'a/b']))
+        \c\V\k\@<!\%(canvas\|a\/b\)\k\@!
+
+    words - a list of strings; they are matched literally (very nomagic), so
+        only backslashes and the '/' pattern delimiter need escaping.
+    Returns a string that can be used as /pattern/ in Vim commands like
+    :syntax match.
+    """
+    escaped = (word.replace('\\', '\\\\').replace('/', '\\/')
+               for word in words)
+    return '\\c\\V\\k\\@<!\\%%(%s\\)\\k\\@!' % '\\|'.join(escaped)
+
+
 #def toggle_activate(f):
 #    """
 #    Activate/focus the helper buffer and then activate/focus again the last
@@ -0,0 +1,277 @@
+#!/home/andrei/.vim/andrei_plugins/gotoword/virtualenv/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Measures how the App operations scale with the size of the database.
+
+For every size, a database of that many keywords is generated (see
+gen_db.py) and the operations below are run against it, through the vim
+stand-in of the unit tests, in a new python process (settings.setup() can
+be called only once per process). For every operation it reports the
+latency of the first call and the 50th, 95th and 99th percentiles of all
+calls, the SQL statements and calls to Vim per call (see gotoword/stats.py)
+and how much the peak memory of the process grew during the operation.
+
+From the command line:
+$: python bench_scale.py                          # 10k and 100k keywords
+$: python bench_scale.py -s 1000000 -n 50 -o scale.json
+$: python bench_scale.py -k /tmp/dbs              # keep generated databases
+$: python bench_scale.py --isolate                # a process per operation
+
+1M keywords are not in the default sizes because they are slow: generating
+the database alone takes minutes; ask for them with -s, as above.
+
+Python 2 has no tracemalloc, so memory is the peak resident size of the
+process (ru_maxrss), which never goes down: "grow" is how much it grew
+during the operation, and misses the memory an operation needs if an
+earlier one already made the process that big. With --isolate every
+operation runs in its own process, after App.main(), so "grow" is the
+memory the operation needed on top of the loaded plugin.
+"""
+
+import sys
+import os
+import os.path
+import json
+import codecs
+import time
+import random
+import shutil
+import logging
+import resource
+import tempfile
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+import gen_db
+
+SELF = os.path.abspath(__file__)
+TEST_PATH = os.path.dirname(SELF)
+VIM_PLUGIN_PATH = os.path.dirname(TEST_PATH)
+
+OPERATIONS = ['helper', 'helper miss', 'helper_word_contexts',
+              'helper_save', 'helper_save new', 'helper_all_words',
+              'helper_context_words', 'helper_delete',
+              'helper_delete_context']
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def maxrss():
+    "Returns the peak resident size of this process, in MB."
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def child(database, calls, seed, storage, debug, operations=OPERATIONS):
+    """Runs operations on database, in this process, and prints their
+    statistics as JSON: {operation: {"first": ms, "p50": ms, ..., "queries":
+    per call, "vim": calls to Vim per call, "maxrss": MB, "grow": MB the
+    peak memory grew during the operation}}."""
+    sys.path.insert(1, VIM_PLUGIN_PATH)
+    sys.path.insert(1, TEST_PATH)
+    import vimstub
+    sys.modules['vim'] = vimstub
+    from gotoword import settings
+    settings.setup(database, storage=storage)
+    from gotoword import gotoword_logging
+    gotoword_logging.set_up_logging(logging.DEBUG if debug else
+                                    logging.WARNING, 'vim')
+    from gotoword import gotoword
+    from gotoword import stats
+
+    start = time.time()
+    app = gotoword.App()
+    app.main()
+    app.select_contexts()
+    results = {'App.main': {'first': (time.time() - start) * 1000}}
+    # the plugin builds the suggestions index in a thread, on the first
+    # miss; here it is built first, so that the misses use it
+    start = time.time()
+    app.suggestions.build()
+    results['suggest index'] = {'first': (time.time() - start) * 1000}
+
+    rand = random.Random(seed)
+    names = list(app.store.keywords)
+    rand.shuffle(names)
+    words = iter(names)
+    multiple = [name for name in names[:calls * 20]
+                if len(app.store.keyword_contexts(name)) > 1]
+    contexts = sorted(app.store.contexts.values(), key=lambda ctx: ctx.id)
+
+    def helper(word):
+        app.helper(word)
+        if app.keyword and not hasattr(app.keyword, 'current_context'):
+            app.keyword.current_context = app.keyword.definitions[0]
+
+    def save():
+        helper(next(words))
+        app.vim_wrapper.help_buffer[:] = ["title", "a new note", "on 2 lines"]
+        app.helper_save(None, None)
+
+    def save_new(i):
+        app.helper(u'newword%s' % i)
+        app.vim_wrapper.help_buffer[:] = ["a note for a new keyword"]
+        app.helper_save(contexts[0].name, None)
+
+    def delete():
+        helper(next(words))
+        app.helper_delete(app.keyword)
+
+    functions = {
+        'helper': lambda i: helper(next(words)),
+        'helper miss': lambda i: app.helper(next(words)[::-1] + u'x'),
+        'helper_word_contexts': lambda i: (
+            helper(multiple[i % len(multiple)]), app.helper_word_contexts()),
+        'helper_save': lambda i: save(),
+        'helper_save new': save_new,
+        'helper_all_words': lambda i: app.helper_all_words(),
+        'helper_context_words': lambda i: app.helper_context_words(
+            contexts[i % 3].name),
+        'helper_delete': lambda i: delete(),
+        'helper_delete_context': lambda i: app.helper_delete_context(
+            contexts[-1 - i].name),
+    }
+    # the plugin prints messages, with unicode names, to Vim's message area
+    out, sys.stdout = sys.stdout, codecs.getwriter('utf8')(open(os.devnull,
+                                                                'w'))
+    for name in operations:
+        # deleting contexts is slow and there are only so many of them
+        count = min(calls, 5) if name == 'helper_delete_context' else calls
+        if name == 'helper_word_contexts' and not multiple:
+            continue
+        latencies = []
+        queries = 0
+        vim_calls = 0
+        before = maxrss()
+        for i in range(count):
+            vimstub.reset()
+            app.vim_wrapper.help_buffer = stats.CountingBuffer(
+                vimstub.current.buffer)
+            # App.main() makes stats count the statements of both storages
+            sql = stats.counters.sql + stats.counters.orm
+            vim = stats.counters.vim
+            start = time.time()
+            functions[name](i)
+            latencies.append((time.time() - start) * 1000)
+            queries += stats.counters.sql + stats.counters.orm - sql
+            vim_calls += stats.counters.vim - vim
+        results[name] = {
+            'calls': count,
+            'first': latencies[0],
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'queries': float(queries) / count,
+            'vim': float(vim_calls) / count,
+            'maxrss': maxrss(),
+            'grow': maxrss() - before,
+        }
+    json.dump(results, out)
+
+
+def run(size, calls, seed, storage, debug, keep=None, large_notes=0.01,
+        large_note_lines=2000, isolate=False):
+    """Generates (or reuses, from dir keep) a database of size keywords and
+    runs the operations on a copy of it, in a new process.
+    large_notes, large_note_lines - see gen_db.populate()
+    isolate - run every operation in its own process, on its own copy
+    """
+    workdir = tempfile.mkdtemp(prefix='gotoword_bench')
+    try:
+        pristine = os.path.join(keep or workdir, 'bench_%s_%s_%s_%s.db' % (
+            size, seed, large_notes, large_note_lines))
+        if not os.path.exists(pristine):
+            start = time.time()
+            gen_db.generate(pristine, keywords=size, seed=seed,
+                            large_notes=large_notes,
+                            large_note_lines=large_note_lines)
+            print("generated %s keywords in %.1fs" % (size,
+                                                      time.time() - start))
+        database = os.path.join(workdir, 'keywords.db')
+        results = {}
+        for operations in ([[name] for name in OPERATIONS] if isolate else
+                           [OPERATIONS]):
+            shutil.copy(pristine, database)
+            command = [sys.executable, SELF, '--child', '-d', database,
+                       '-n', str(calls), '--seed', str(seed),
+                       '--storage', storage,
+                       '--operations', ','.join(operations)]
+            if debug:
+                command.append('--debug')
+            out = subprocess.check_output(command, cwd=workdir)
+            for name, stats in json.loads(out.splitlines()[-1]).items():
+                # App.main and the index are measured by every process
+                results.setdefault(name, stats)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+def report(results):
+    for size, stats in sorted(results.items(), key=lambda item:
+                              int(item[0])):
+        print("\n%s keywords, App.main: %.1f ms, suggest index: %.1f ms" % (
+            size, stats['App.main']['first'],
+            stats['suggest index']['first']))
+        print("%-22s %9s %9s %9s %9s %8s %6s %8s %8s" % (
+            '', 'first', 'p50', 'p95', 'p99', 'queries', 'vim', 'maxrss',
+            'grow'))
+        for name in OPERATIONS:
+            if name not in stats:
+                continue
+            op = stats[name]
+            print("%-22s %9.2f %9.2f %9.2f %9.2f %8.1f %6.1f %7.0fM %7.1fM" % (
+                name, op['first'], op['p50'], op['p95'], op['p99'],
+                op['queries'], op['vim'], op['maxrss'], op['grow']))
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [-s SIZES] [-n CALLS] [-o OUTPUT]\n\n"
+                          "1000000 keywords are opt-in (-s 1000000), "
+                          "because they are slow")
+    parser.add_option('-s', '--sizes', default='10000,100000',
+                      help="comma separated numbers of keywords [%default]")
+    parser.add_option('-n', '--calls', type='int', default=100,
+                      help="calls of every operation")
+    parser.add_option('--seed', type='int', default=0,
+                      help="seed of the generated databases and of the "
+                      "words used")
+    parser.add_option('--large-notes', type='float', default=0.01,
+                      help="fraction of the notes that are large [%default]")
+    parser.add_option('--large-note-lines', type='int', default=2000,
+                      help="number of lines of a large note [%default]")
+    parser.add_option('--storage', default='sqlite',
+                      help="storage backend, 'sqlite' or 'django'")
+    parser.add_option('--debug', action='store_true',
+                      help="log at DEBUG level instead of WARNING")
+    parser.add_option('-k', '--keep',
+                      help="dir where the generated databases are kept and "
+                      "reused from")
+    parser.add_option('--isolate', action='store_true',
+                      help="run every operation in its own process, so "
+                      "that its memory growth is its own")
+    parser.add_option('-o', '--output', help="save the results as JSON")
+    parser.add_option('-d', '--database', help=SUPPRESS_HELP)
+    parser.add_option('--child', action='store_true', help=SUPPRESS_HELP)
+    parser.add_option('--operations', default=','.join(OPERATIONS),
+                      help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        child(options.database, options.calls, options.seed,
+              options.storage, options.debug, options.operations.split(','))
+        sys.exit()
+    results = {}
+    for size in [int(size) for size in options.sizes.split(',')]:
+        results[str(size)] = run(size, options.calls, options.seed,
+                                 options.storage, options.debug,
+                                 options.keep, options.large_notes,
+                                 options.large_note_lines, options.isolate)
+    report(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,276 @@
+#!/home/andrei/.vim/andrei_plugins/gotoword/virtualenv/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Measures how long the plugin takes to start: what s:Bootstrap() in
+gotoword.vim runs before the first command shows its result.
+
+Every run is a fresh python process (imports are cached otherwise) that
+drives the plugin through the vim stand-in of the unit tests and reports the
+wall time of each phase and of every module imported while starting. The
+runs are summarized (median, min, max) and can be saved as a JSON baseline
+that later runs are compared with.
+
+From the command line:
+$: python bench_startup.py -n 20 -o baseline.json
+$: python bench_startup.py -n 20 -b baseline.json
+$: python bench_startup.py --vim vim      # also time sourcing in Vim
+
+Python 2 has no "-X importtime", so the imports are timed by wrapping
+__import__; the breakdown has the same columns: self and cumulative time.
+"""
+
+import sys
+import os
+import os.path
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import __builtin__
+from optparse import OptionParser, SUPPRESS_HELP
+
+SELF = os.path.abspath(__file__)
+TEST_PATH = os.path.dirname(SELF)
+VIM_PLUGIN_PATH = os.path.dirname(TEST_PATH)
+SCRIPT = os.path.join(VIM_PLUGIN_PATH, 'gotoword.vim')
+DATABASE = os.path.join(VIM_PLUGIN_PATH, 'keywords.db')
+
+PHASES = ['import settings', 'settings.setup', 'set_up_logging',
+          'import gotoword', 'App()', 'App.main', 'select_contexts',
+          'first helper']
+# in the order s:Bootstrap() and the first :Helper run them
+
+
+class ImportTimer(object):
+    """Times the imports that load a module, like python3's -X importtime.
+    Eg.:
+        >>> timer = ImportTimer().install()
+        >>> import json
+        >>> timer.uninstall()
+        >>> timer.imports[-1]
+        ('json', 0, 1523.0, 2688.0)
+    """
+    def __init__(self):
+        self.imports = []
+        # (module, depth, self us, cumulative us), in the order they finished
+        self.stack = []
+        # time spent in nested imports, for every import in progress
+        self.original = None
+
+    def install(self):
+        self.original = __builtin__.__import__
+        __builtin__.__import__ = self.import_
+        return self
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original
+
+    def import_(self, name, globals=None, locals=None, fromlist=None,
+                level=-1):
+        package = (globals or {}).get('__package__') or ''
+        if not package and '__path__' in (globals or {}):
+            package = globals.get('__name__', '')
+        elif not package and globals and '.' in globals.get('__name__', ''):
+            package = globals['__name__'].rsplit('.', 1)[0]
+        relative = package + '.' + name if package else None
+        if name in sys.modules or relative in sys.modules:
+            # nothing to load
+            return self.original(name, globals, locals, fromlist, level)
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = (time.time() - start) * 1e6
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += cumulative
+            if sys.modules.get(relative) is not None:
+                # python 2 implicit relative import
+                name = relative
+            self.imports.append((name, len(self.stack), cumulative - nested,
+                                 cumulative))
+
+
+def child(database, word):
+    """Runs the startup once, in this process, and prints the timings as
+    JSON: {"phases": {phase: ms}, "imports": [[module, depth, self us,
+    cumulative us], ...]}."""
+    sys.path.insert(1, VIM_PLUGIN_PATH)
+    sys.path.insert(1, TEST_PATH)
+    phases = {}
+    timer = ImportTimer().install()
+
+    def phase(name, fn):
+        start = time.time()
+        out = fn()
+        phases[name] = (time.time() - start) * 1000
+        return out
+
+    import logging
+    import vimstub
+    sys.modules['vim'] = vimstub
+    settings = phase('import settings',
+                     lambda: __import__('gotoword.settings').settings)
+    phase('settings.setup', lambda: settings.setup(database,
+                                                   storage='sqlite'))
+    gotoword_logging = __import__('gotoword.gotoword_logging').gotoword_logging
+    phase('set_up_logging', lambda: gotoword_logging.set_up_logging(
+        logging.DEBUG, 'vim'))
+    gotoword = phase('import gotoword',
+                     lambda: __import__('gotoword.gotoword').gotoword)
+    app = phase('App()', gotoword.App)
+    phase('App.main', app.main)
+    phase('select_contexts', app.select_contexts)
+    phase('first helper', lambda: app.helper(word))
+    timer.uninstall()
+    json.dump({'phases': phases, 'imports': timer.imports}, sys.stdout)
+
+
+def run_child(database, word):
+    """Runs the startup in a new python process, from a scratch dir (the
+    log file is written in the current dir) and on a copy of database.
+    Returns the timings of child(), with the wall time of the whole process
+    in phases['process'] and that of python's own start in
+    phases['interpreter']."""
+    workdir = tempfile.mkdtemp(prefix='gotoword_bench')
+    try:
+        copy = os.path.join(workdir, 'keywords.db')
+        shutil.copy(database, copy)
+        start = time.time()
+        out = subprocess.check_output([sys.executable, SELF, '--child',
+                                       '-d', copy, '-w', word], cwd=workdir)
+        elapsed = (time.time() - start) * 1000
+    finally:
+        shutil.rmtree(workdir)
+    timings = json.loads(out.splitlines()[-1])
+    phases = timings['phases']
+    phases['interpreter'] = elapsed - sum(phases.values())
+    phases['process'] = elapsed
+    return timings
+
+
+def run_vim(vim, word):
+    """Sources the plugin in a headless Vim and runs :Helper word; returns
+    the ms --startuptime reports for the whole session."""
+    workdir = tempfile.mkdtemp(prefix='gotoword_bench')
+    try:
+        log = os.path.join(workdir, 'startuptime.log')
+        subprocess.check_call([vim, '-Nu', 'NONE', '-i', 'NONE', '-es',
+                               '--startuptime', log,
+                               '-c', 'source %s' % SCRIPT,
+                               '-c', 'Helper %s' % word, '-c', 'qa!'],
+                              cwd=workdir)
+        with open(log) as f:
+            lines = [line for line in f if line[:1].isdigit()]
+    finally:
+        shutil.rmtree(workdir)
+    # the first column is the time since Vim started
+    return float(lines[-1].split()[0])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(samples):
+    "Returns {'median': .., 'min': .., 'max': ..} of a list of numbers."
+    return {'median': median(samples), 'min': min(samples),
+            'max': max(samples)}
+
+
+def benchmark(runs, database, word, vim=None):
+    """Returns the summary of runs startups: phases in ms and, for every
+    module, its cumulative import time in ms."""
+    phases = {}
+    imports = {}
+    for i in range(runs):
+        timings = run_child(database, word)
+        for name, ms in timings['phases'].items():
+            phases.setdefault(name, []).append(ms)
+        for name, depth, self_us, cumulative_us in timings['imports']:
+            imports.setdefault(name, []).append(cumulative_us / 1000)
+        if vim:
+            phases.setdefault('vim', []).append(run_vim(vim, word))
+    return {'python': sys.version.split()[0],
+            'runs': runs,
+            'phases': dict((name, summarize(samples)) for name, samples in
+                           phases.items()),
+            'imports': dict((name, summarize(samples)) for name, samples in
+                            imports.items())}
+
+
+def report(result, baseline=None, top=15):
+    """Prints the phases and the slowest imports, with the change from
+    baseline if one is given."""
+    def row(name, stats, old_stats):
+        line = "%-28s %9.1f %9.1f %9.1f" % (name, stats['median'],
+                                            stats['min'], stats['max'])
+        if old_stats:
+            old = old_stats['median']
+            change = (stats['median'] - old) / old * 100 if old else 0
+            line += " %9.1f %+7.1f%%" % (old, change)
+        return line
+
+    baseline = baseline or {}
+    header = "%-28s %9s %9s %9s" % ('', 'median', 'min', 'max')
+    if baseline:
+        header += " %9s %8s" % ('baseline', 'change')
+    print("%s runs, python %s, times in ms" % (result['runs'],
+                                               result['python']))
+    print(header)
+    old_phases = baseline.get('phases', {})
+    names = [name for name in PHASES + ['interpreter', 'process', 'vim']
+             if name in result['phases']]
+    for name in names:
+        print(row(name, result['phases'][name], old_phases.get(name)))
+    print("\nslowest imports (cumulative)")
+    print(header)
+    old_imports = baseline.get('imports', {})
+    imports = sorted(result['imports'].items(),
+                     key=lambda item: -item[1]['median'])
+    for name, stats in imports[:top]:
+        print(row(name, stats, old_imports.get(name)))
+    gotoword = [(name, stats) for name, stats in imports
+                if name.startswith('gotoword')]
+    print("\ngotoword modules (cumulative)")
+    for name, stats in gotoword:
+        print(row(name, stats, old_imports.get(name)))
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [-n RUNS] [-o OUTPUT] [-b BASELINE]")
+    parser.add_option('-n', '--runs', type='int', default=10,
+                      help="number of startups to time")
+    parser.add_option('-d', '--database', default=DATABASE,
+                      help="database to start with (a copy of it is used)")
+    parser.add_option('-w', '--word', default='python',
+                      help="word looked up by the first :Helper")
+    parser.add_option('-o', '--output', help="save the results as JSON")
+    parser.add_option('-b', '--baseline',
+                      help="JSON results of a previous run to compare with")
+    parser.add_option('--vim', help="also time the plugin in this Vim")
+    parser.add_option('--top', type='int', default=15,
+                      help="number of slowest imports to show")
+    parser.add_option('--child', action='store_true', help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        child(options.database, options.word)
+        sys.exit()
+    result = benchmark(options.runs, options.database, options.word,
+                       options.vim)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline, options.top)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
@@ -0,0 +1,279 @@
+#!/home/andrei/.vim/andrei_plugins/gotoword/virtualenv/bin/python
+# -*- coding: utf8 -*-
+
+"""
+Generates keywords databases of any size, for load and scaling tests.
+
+The schema is created by django's syncdb from the models in gotoword.utils,
+then the rows are written with the sqlite3 module, in batches, in one
+transaction. The same seed always gives the same database.
+
+    - the number of contexts of a keyword follows a Zipf distribution: most
+      keywords have one definition, a few have many;
+    - the contexts are picked with a Zipf distribution too, so the first
+      contexts get most of the definitions; the first one is 'default';
+    - the number of lines of a note is log-normal, with a long tail of large
+      notes; on top of that, a fixed fraction of the notes is large;
+    - a fraction of the names has non-ascii chars.
+
+From the command line:
+$: python gen_db.py -k 1000000 big.db
+$: python gen_db.py -k 10000 -c 200 --fanout-skew 1.5 --seed 3 small.db
+$: python gen_db.py -k 100000 --large-notes 0.05 --large-note-lines 3000 a.db
+"""
+
+import sys
+import os
+import os.path
+import time
+import random
+import math
+import bisect
+import sqlite3
+import itertools
+import subprocess
+from optparse import OptionParser
+
+TEST_PATH = os.path.dirname(os.path.abspath(__file__))
+VIM_PLUGIN_PATH = os.path.dirname(TEST_PATH)
+
+BATCH = 10000
+# rows per executemany()
+
+WORDS = [u'canvas', u'color', u'widget', u'button', u'label', u'layout',
+         u'list', u'dict', u'string', u'import', u'class', u'query',
+         u'model', u'view', u'thread', u'socket', u'buffer', u'window']
+UNICODE_WORDS = [u'café', u'straße', u'naïve', u'señal', u'élément',
+                 u'функция', u'класс', u'λέξη', u'関数', u'变量']
+# names are made of one of these words and a number, so they are unique
+TEXT = (u"the quick brown fox jumps over the lazy dog while the kivy canvas "
+        u"draws a color line and python imports the module from the path "
+        u"of the virtualenv so that django can set up the database").split()
+
+
+class Zipf(object):
+    """Draws numbers from 1 to n, where k is drawn with a probability
+    proportional to 1 / k ** skew.
+    Eg.:
+        >>> zipf = Zipf(50, 2.0, random.Random(0))
+        >>> [zipf() for i in range(10)]
+        [1, 1, 1, 2, 1, 1, 1, 4, 1, 1]
+    """
+    def __init__(self, n, skew, rand):
+        total = 0.0
+        self.cumulative = []
+        for k in range(1, n + 1):
+            total += 1.0 / k ** skew
+            self.cumulative.append(total)
+        self.total = total
+        self.random = rand.random
+
+    def __call__(self):
+        return bisect.bisect(self.cumulative,
+                             self.random() * self.total) + 1
+
+
+def create_schema(database):
+    """Creates the tables of the plugin in database with syncdb, in a new
+    python process, because django can be set up only once per process."""
+    script = ("import sys; sys.path.insert(1, %r)\n"
+              "from gotoword import settings\n"
+              "settings.setup(%r)\n"
+              "from gotoword import utils\n"
+              "from django.core.management import call_command\n"
+              "call_command('syncdb', interactive=False, verbosity=0)\n"
+              % (VIM_PLUGIN_PATH, database))
+    subprocess.check_call([sys.executable, '-c', script])
+
+
+def upgrade_database(database):
+    "Runs utils.upgrade_database(), which builds the full-text index."
+    script = ("import sys; sys.path.insert(1, %r)\n"
+              "from gotoword import settings\n"
+              "settings.setup(%r)\n"
+              "from gotoword import utils\n"
+              "utils.upgrade_database()\n" % (VIM_PLUGIN_PATH, database))
+    subprocess.check_call([sys.executable, '-c', script])
+
+
+def batches(rows, size=BATCH):
+    "Splits an iterable of rows in lists of at most size rows."
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def populate(database, keywords=10000, contexts=50, fanout_skew=2.0,
+             context_skew=1.0, note_lines=4, note_sigma=1.0,
+             max_note_lines=5000, large_notes=0.01, large_note_lines=2000,
+             unicode_names=0.1, seed=0):
+    """Writes the rows of a database created by create_schema().
+    keywords, contexts - how many of each
+    fanout_skew - skew of the Zipf distribution of the number of contexts of
+        a keyword; bigger means fewer keywords with many contexts
+    context_skew - skew of the Zipf distribution the contexts are drawn
+        from; 0 draws them uniformly
+    note_lines, note_sigma - median and sigma of the log-normal number of
+        lines of a note, which has at most max_note_lines
+    large_notes - fraction of the notes that have large_note_lines lines,
+        whatever the log-normal distribution gives
+    unicode_names - fraction of the keyword names with non-ascii chars
+    Returns the number of notes.
+    """
+    rand = random.Random(seed)
+    random_ = rand.random
+    fanout = Zipf(contexts, fanout_skew, rand)
+    pick_context = Zipf(contexts, context_skew, rand)
+    # notes are slices of a text made of a pool of lines, and their number
+    # of lines is drawn from a table of log-normal samples, which is much
+    # faster than making up every note
+    pool = [u" ".join(rand.choice(TEXT) for i in range(rand.randint(3, 12)))
+            for i in range(1000)]
+    large_note_lines = min(large_note_lines, max_note_lines)
+    repeats = max_note_lines // len(pool) + 2
+    text = u"\n".join(pool * repeats) + u"\n"
+    offsets = [0]
+    for line in pool * repeats:
+        offsets.append(offsets[-1] + len(line) + 1)
+    mu = math.log(note_lines)
+    note_lengths = [min(int(rand.lognormvariate(mu, note_sigma)) + 1,
+                        max_note_lines) for i in range(4096)]
+
+    def context_rows():
+        for ctx_id in range(1, contexts + 1):
+            name = u'default' if ctx_id == 1 else u'context%s' % ctx_id
+            yield (ctx_id, name, u'generated context %s' % ctx_id)
+
+    def keyword_rows():
+        for kw_id in range(1, keywords + 1):
+            if random_() < unicode_names:
+                word = UNICODE_WORDS[kw_id % len(UNICODE_WORDS)]
+            else:
+                word = WORDS[kw_id % len(WORDS)]
+            yield (kw_id, u'%s%s' % (word, kw_id))
+
+    notes = [0]
+
+    def data_rows():
+        pool_size = len(pool)
+        for kw_id in range(1, keywords + 1):
+            count = fanout()
+            if count == 1:
+                ctx_ids = [pick_context()]
+            elif count > contexts // 2:
+                ctx_ids = rand.sample(range(1, contexts + 1), count)
+            else:
+                ctx_ids = set()
+                while len(ctx_ids) < count:
+                    ctx_ids.add(pick_context())
+            for ctx_id in ctx_ids:
+                start = int(random_() * pool_size)
+                if random_() < large_notes:
+                    end = start + large_note_lines
+                else:
+                    end = start + note_lengths[int(random_() * 4096)]
+                notes[0] += 1
+                yield (kw_id, ctx_id, u'', u'',
+                       text[offsets[start]:offsets[end] - 1],
+                       pool[start][:100])
+
+    connection = sqlite3.connect(database)
+    # nothing is lost if the machine crashes now: the file is generated
+    connection.execute("PRAGMA synchronous = OFF")
+    connection.execute("PRAGMA journal_mode = OFF")
+    with connection:
+        # the indexes are faster to build once, at the end
+        indexes = connection.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND "
+            "tbl_name = 'standalone_data' AND sql IS NOT NULL").fetchall()
+        for name, sql in indexes:
+            connection.execute('DROP INDEX "%s"' % name)
+        statements = [
+            ("INSERT INTO standalone_context (id, name, description) "
+             "VALUES (?, ?, ?)", context_rows()),
+            ("INSERT INTO standalone_keyword (id, name) VALUES (?, ?)",
+             keyword_rows()),
+            ("INSERT INTO standalone_data (keyword_id, context_id, cmd, "
+             "info_public, info, summary) VALUES (?, ?, ?, ?, ?, ?)",
+             data_rows()),
+        ]
+        for sql, rows in statements:
+            for batch in batches(rows):
+                connection.executemany(sql, batch)
+        for name, sql in indexes:
+            connection.execute(sql)
+    connection.close()
+    return notes[0]
+
+
+def generate(database, search_index=True, **options):
+    """Creates database, which must not exist, with the tables of the plugin
+    and fills it; options are those of populate().
+    search_index - build the full-text index of the notes now, instead of
+        the first time the plugin opens the database.
+    Returns the number of notes.
+    """
+    if os.path.exists(database):
+        raise ValueError("%s exists already" % database)
+    create_schema(database)
+    notes = populate(database, **options)
+    if search_index:
+        upgrade_database(database)
+    return notes
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [options] DATABASE")
+    parser.add_option('-k', '--keywords', type='int', default=10000)
+    parser.add_option('-c', '--contexts', type='int', default=50)
+    parser.add_option('--fanout-skew', type='float', default=2.0,
+                      help="Zipf skew of the number of contexts of a "
+                      "keyword [%default]")
+    parser.add_option('--context-skew', type='float', default=1.0,
+                      help="Zipf skew of the popularity of the contexts "
+                      "[%default]")
+    parser.add_option('--note-lines', type='float', default=4,
+                      help="median number of lines of a note [%default]")
+    parser.add_option('--note-sigma', type='float', default=1.0,
+                      help="sigma of the log-normal number of lines "
+                      "[%default]")
+    parser.add_option('--max-note-lines', type='int', default=5000)
+    parser.add_option('--large-notes', type='float', default=0.01,
+                      help="fraction of the notes that are large [%default]")
+    parser.add_option('--large-note-lines', type='int', default=2000,
+                      help="number of lines of a large note [%default]")
+    parser.add_option('--unicode-names', type='float', default=0.1,
+                      help="fraction of non-ascii keyword names [%default]")
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--no-search-index', action='store_false',
+                      dest='search_index', default=True,
+                      help="leave the full-text index to the plugin")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("DATABASE is required")
+
+    database = args[0]
+    if os.path.exists(database):
+        parser.error("%s exists already" % database)
+    start = time.time()
+    create_schema(database)
+    notes = populate(database, keywords=options.keywords,
+                     contexts=options.contexts,
+                     fanout_skew=options.fanout_skew,
+                     context_skew=options.context_skew,
+                     note_lines=options.note_lines,
+                     note_sigma=options.note_sigma,
+                     max_note_lines=options.max_note_lines,
+                     large_notes=options.large_notes,
+                     large_note_lines=options.large_note_lines,
+                     unicode_names=options.unicode_names, seed=options.seed)
+    print("%s: %s keywords, %s contexts, %s notes in %.1fs" % (
+        database, options.keywords, options.contexts, notes,
+        time.time() - start))
+    if options.search_index:
+        start = time.time()
+        upgrade_database(database)
+        print("full-text index built in %.1fs" % (time.time() - start))
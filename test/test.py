@@ -5,7 +5,16 @@ from os import sys, path
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 import os
 import os.path
+import json
+import pstats
+import Queue
+import random
 import shutil
+import sqlite3
+import tempfile
+import StringIO
+import threading
+import time
 #import inspect
 
 import unittest
@@ -17,11 +26,36 @@ import unittest
 database_name = 'test.db'
 from gotoword import settings
 settings.setup(db=database_name)
+# the views are driven by a stand-in for the vim module, which has to be in
+# place before any module that uses it is imported
+import vimstub
+sys.modules['vim'] = vimstub
 from gotoword.utils import Keyword, Context, Data
+from gotoword.utils import load_keywords_store, resolve_keyword
+from gotoword.utils import keyword_summaries, update_info, iter_names
+from gotoword.utils import ContextRule, match_contexts
+from gotoword.utils import upgrade_database, search_notes, NameIndex
+from gotoword.utils import NoteCache, DjangoStorage, SUMMARY_UPDATE
+from gotoword.storage import SqliteStorage, summarize
+from gotoword import inference
+from gotoword.inference import ContextScorer
+from gotoword.suggest import SuggestIndex
+from gotoword import stats, tracing, profiling
+from gotoword.utils import KeywordsStore
+from gotoword.utils import count_queries
+from gotoword import utils
+
+import logging
+from gotoword import gotoword_logging
+gotoword_logging.set_up_logging(logging.WARNING, 'vim')
+from gotoword import gotoword
+from gotoword import highlight
 
 import django
 #from standalone.conf import settings
 from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 
 # parse command line to get the database and whether we want to
@@ -114,6 +148,8 @@ class TestMain(unittest.TestCase):
             pass
         '''Create a test database.'''
         call_command('syncdb')
+        # full-text index, etc.
+        upgrade_database()
 
     def setUp(self):
         # populate db
@@ -224,6 +260,458 @@ class TestMain(unittest.TestCase):
         kw = Keyword.objects.filter(name="canvas")
         self.assertEqual(u'canvas', kw.values()[0]['name'])
 
+    def test_load_keywords_store(self):
+        canvas = Keyword.objects.get(name='canvas')
+        kivy = Context.objects.get(name='kivy')
+        python = Context.objects.get(name='python')
+        Data.objects.create(keyword=canvas, context=kivy)
+        Data.objects.create(keyword=canvas, context=python)
+        store = load_keywords_store(database_name)
+        self.assertEqual(len(keywords), len(store))
+        color = Keyword.objects.get(name='color')
+        self.assertEqual((color.id, ()), store.find('color'))
+        self.assertEqual(['kivy', 'python'],
+                         [ctx.name for ctx in store.keyword_contexts('canvas')])
+        self.assertIsNone(store.find('unknown'))
+
+        # keep the store in sync with the database
+        store.remove_context('python')
+        self.assertEqual(['kivy'],
+                         [ctx.name for ctx in store.keyword_contexts('canvas')])
+        store.remove_keyword('canvas')
+        self.assertNotIn('canvas', store)
+
+    def test_load_keywords_of_matching_contexts(self):
+        kivy = Context.objects.get(name='kivy')
+        python = Context.objects.get(name='python')
+        Data.objects.create(keyword=Keyword.objects.get(name='canvas'),
+                            context=kivy)
+        Data.objects.create(keyword=Keyword.objects.get(name='color'),
+                            context=python)
+        ContextRule.objects.create(context=kivy, pattern='*.kv')
+        ContextRule.objects.create(context=python, pattern='python')
+        rules = list(ContextRule.objects.values_list('context_id', 'pattern'))
+        self.assertEqual(frozenset([kivy.id]),
+                         match_contexts(rules, '', '/home/user/app.kv'))
+        self.assertEqual(frozenset([python.id]),
+                         match_contexts(rules, 'python.django', '/tmp/a.py'))
+        self.assertIsNone(match_contexts(rules, 'c', '/tmp/a.c'))
+
+        store = load_keywords_store(database_name)
+        store.set_scope([kivy.id])
+        self.assertEqual(['canvas'], [name for name in sorted(store.keywords)
+                                      if store.in_scope(name)])
+        self.assertEqual(frozenset([kivy.id]), store.scope)
+        # switching scopes filters the keywords loaded, without queries and
+        # without changing the version, so the indexes are kept
+        version = store.version
+        with CaptureQueriesContext(connection) as queries:
+            store.set_scope([python.id])
+            self.assertTrue(store.in_scope('color'))
+            self.assertFalse(store.in_scope('canvas'))
+            store.set_scope(None)
+            self.assertTrue(store.in_scope('test'))
+        self.assertEqual(0, len(queries))
+        self.assertEqual(version, store.version)
+        self.assertEqual(len(keywords), len(store))
+
+    def test_name_index_completes_prefix(self):
+        kivy = Context.objects.get(name='kivy')
+        Data.objects.create(keyword=Keyword.objects.get(name='canvas'),
+                            context=kivy)
+        store = load_keywords_store(database_name)
+        index = NameIndex(store)
+        self.assertEqual(['canvas', 'color'], index.complete('C'))
+        self.assertEqual(['canvas'], index.complete('c', context=kivy.id))
+        self.assertEqual(['canvas'], index.complete('c', limit=1))
+        store.set_scope([kivy.id])
+        self.assertEqual(['canvas'], index.complete('c'))
+        store.set_scope(None)
+        self.assertEqual([], index.complete('canvasx'))
+
+        # names added or removed through the store are completed right away
+        cap = Keyword.objects.create(name='cap')
+        store.add_keyword(cap, kivy)
+        self.assertEqual(['canvas', 'cap'], index.complete('ca'))
+        store.remove_keyword('canvas')
+        self.assertEqual(['cap'], index.complete('ca'))
+
+    def test_suggest_index(self):
+        store = load_keywords_store(database_name)
+        index = SuggestIndex(store)
+        # the index is built by a thread, there are no suggestions until then
+        self.assertEqual([], index.suggest('Cnavas'))
+        thread = index.thread
+        if thread:
+            thread.join()
+        self.assertIsNone(index.thread)
+        self.assertEqual(['canvas'], index.suggest('Cnavas'))
+        # a keyword added while the index is built is added when it's done
+        index.loaded()
+        names, generation = list(store.keywords), index.generation
+        index.thread = threading.current_thread()
+        store.add_keyword(Keyword(id=0, name='cavas'))
+        index.build(names, generation)
+        self.assertEqual(['canvas', 'cavas'], index.suggest('Cnavas'))
+        store.remove_keyword('cavas')
+        self.assertEqual(['canvas'], index.suggest('Cnavas'))
+        self.assertEqual(['canvas'], index.suggest('canvs'))
+        self.assertEqual(['color'], index.suggest('colour'))
+        self.assertEqual([], index.suggest('cnv'))
+        self.assertEqual([], index.suggest('canvas'))
+        # an index built from the names before the store was loaded again is
+        # dropped
+        index.loaded()
+        thread = index.start()
+        store.load()
+        thread.join()
+        self.assertIsNone(index.index)
+        index.build()
+        self.assertEqual(['canvas'], index.suggest('Cnavas'))
+        store.set_scope([Context.objects.get(name='kivy').id])
+        self.assertEqual([], index.suggest('colour'))
+        store.set_scope(None)
+
+        cavas = Keyword.objects.create(name='cavas')
+        store.add_keyword(cavas)
+        self.assertEqual(['cavas', 'canvas'], index.suggest('cvas'))
+        store.remove_keyword('canvas')
+        self.assertEqual(['cavas'], index.suggest('cvas'))
+
+    def test_note_cache(self):
+        cache = NoteCache(size=2)
+        cache.put(('canvas', 1), ['canvas note'])
+        cache.put(('color', 1), ['color note'])
+        self.assertEqual(['canvas note'], cache.get(('canvas', 1)))
+        # color is the least recently used one
+        cache.put(('canvas', 2), ['canvas note 2'])
+        self.assertIsNone(cache.get(('color', 1)))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual({'hits': 1, 'misses': 1, 'notes': 2, 'size': 2},
+                         cache.as_dict())
+        cache.invalidate('canvas')
+        self.assertIsNone(cache.get(('canvas', 2)))
+
+        # another process changes the database
+        cache.check()
+        cache.put(('canvas', 1), ['canvas note'])
+        other = sqlite3.connect(database_name)
+        other.execute("UPDATE %s SET description = 'changed'" %
+                      Context._meta.db_table)
+        other.commit()
+        other.close()
+        self.assertEqual(['canvas note'], cache.get(('canvas', 1)))
+        cache.check()
+        self.assertIsNone(cache.get(('canvas', 1)))
+
+    def test_sqlite_storage_agrees_with_django(self):
+        kivy = Context.objects.get(name='kivy')
+        python = Context.objects.get(name='python')
+        django_storage = DjangoStorage(database_name)
+        sqlite_storage = SqliteStorage(database_name)
+        kw_id = sqlite_storage.create_keyword(u'widget')
+        sqlite_storage.save_note(kw_id, kivy.id, u"first line\nsecond line")
+        django_storage.save_note(kw_id, python.id, u"python widget")
+        for storage in (django_storage, sqlite_storage):
+            self.assertEqual(kw_id, storage.find_keyword('widget'))
+            self.assertIsNone(storage.find_keyword('unknown'))
+            self.assertEqual(
+                [(kw_id, kivy.id, 'kivy', 'first line\nsecond line', '', ''),
+                 (kw_id, python.id, 'python', 'python widget', '', '')],
+                list(storage.get_notes('widget')))
+            self.assertEqual(sorted(contexts),
+                             [name for ctx_id, name, description in
+                              storage.list_contexts()])
+            self.assertEqual(['canvas', 'color'],
+                             storage.list_keywords(limit=2))
+            self.assertEqual(['test', 'widget'],
+                             storage.list_keywords('color'))
+            self.assertEqual(['widget'],
+                             storage.list_keywords(context_id=kivy.id))
+            self.assertEqual(sorted([('widget', kw_id, kivy.id),
+                                     ('widget', kw_id, python.id)]),
+                             sorted(row for row in storage.keyword_rows()
+                                    if row[0] == 'widget'))
+            self.assertEqual([(kivy.id, 'kivy', 'first line'),
+                              (python.id, 'python', 'python widget')],
+                             list(storage.keyword_summaries(kw_id)))
+        # the summary is kept up to date by both
+        self.assertEqual('first line', Data.objects.get(context=kivy).summary)
+
+        sqlite_storage.delete_context('kivy')
+        self.assertEqual(['python'], [row[2] for row in
+                                      django_storage.get_notes('widget')])
+        sqlite_storage.delete_keyword('widget')
+        self.assertIsNone(django_storage.find_keyword('widget'))
+        self.assertEqual(0, Data.objects.count())
+
+    def test_statements_are_counted(self):
+        count_queries()
+        count_queries()
+        # the second call doesn't count them twice
+        sql, orm = stats.counters.sql, stats.counters.orm
+        list(Keyword.objects.all())
+        SqliteStorage(database_name).find_keyword('canvas')
+        self.assertEqual(orm + 1, stats.counters.orm)
+        self.assertEqual(sql + 1, stats.counters.sql)
+
+    def test_context_scorer(self):
+        kivy = Context.objects.get(name='kivy')
+        python = Context.objects.get(name='python')
+        for name in ('canvas', 'color'):
+            Data.objects.create(keyword=Keyword.objects.get(name=name),
+                                context=kivy)
+        Data.objects.create(keyword=Keyword.objects.get(name='canvas'),
+                            context=python)
+        scorer = ContextScorer(load_keywords_store(database_name))
+        context, names = scorer.infer(["with self.canvas:",
+                                       "    Color(1, 0, 0)  # color"])
+        # color is only in kivy, so it outweighs canvas being in both
+        self.assertEqual('kivy', context.name)
+        self.assertEqual(['color', 'canvas'], names)
+        self.assertEqual((None, []), scorer.infer(["nothing to see here"]))
+
+    @unittest.skipIf(inference.numpy is None, "NumPy is not installed")
+    def test_context_scorer_numpy_agrees_with_python(self):
+        names = {'canvas': ['kivy', 'python'], 'color': ['kivy'],
+                 'test': ['django', 'python', 'kivy']}
+        for name, ctx_names in names.items():
+            for ctx_name in ctx_names:
+                Data.objects.create(keyword=Keyword.objects.get(name=name),
+                                    context=Context.objects.get(name=ctx_name))
+        scorer = ContextScorer(load_keywords_store(database_name))
+        hits, found = scorer.tokenize(["canvas color test", "canvas", "test",
+                                       "test.color"])
+        self.assertEqual([3, 2, 2], [count for count, entry in hits])
+        numpy_weights = scorer.score(hits)
+        python_weights = scorer._score_python(hits)
+        self.assertEqual(sorted(python_weights), sorted(numpy_weights))
+        for ctx_id, weight in python_weights.items():
+            self.assertAlmostEqual(weight, numpy_weights[ctx_id])
+
+    def test_search_notes(self):
+        kivy = Context.objects.get(name='kivy')
+        python = Context.objects.get(name='python')
+        canvas = Data.objects.create(
+            keyword=Keyword.objects.get(name='canvas'), context=kivy,
+            info=keywords['canvas'])
+        Data.objects.create(keyword=Keyword.objects.get(name='color'),
+                            context=python, info="Colors of the widget.")
+        hits = search_notes('graphics instruct*')
+        self.assertEqual([('canvas', 'kivy')],
+                         [(hit.keyword, hit.context) for hit in hits])
+        self.assertIn('Graphics', hits[0].snippet)
+        self.assertEqual(['canvas', 'color'],
+                         sorted(hit.keyword for hit in search_notes('widget')))
+        # the index follows the notes
+        canvas.info = "Nothing here."
+        canvas.save()
+        self.assertEqual([], search_notes('graphics'))
+        self.assertEqual([], search_notes('"-'))
+
+    def test_resolve_keyword_uses_one_query(self):
+        canvas = Keyword.objects.get(name='canvas')
+        for ctx in Context.objects.all():
+            Data.objects.create(keyword=canvas, context=ctx,
+                                info="canvas in %s" % ctx.name)
+        with CaptureQueriesContext(connection) as queries:
+            keyword, notes = resolve_keyword('canvas')
+            rows = [(note.context.name, note.info) for note in notes]
+        # the lookup path must not drift back to one query per context
+        self.assertEqual(1, len(queries))
+        self.assertEqual(canvas.id, keyword.id)
+        self.assertEqual(sorted((c, "canvas in %s" % c) for c in contexts),
+                         rows)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual((None, []), resolve_keyword('unknown'))
+            keyword, notes = resolve_keyword('color')
+        self.assertEqual(2, len(queries))
+        self.assertEqual([], notes)
+
+    def make_app(self, storage='django'):
+        """Returns an App that runs on the vim stand-in, with notes of canvas
+        in kivy and python and of color in kivy."""
+        canvas = Keyword.objects.get(name='canvas')
+        color = Keyword.objects.get(name='color')
+        kivy = Context.objects.get(name='kivy')
+        python = Context.objects.get(name='python')
+        # App needs it
+        Context.objects.create(name='default', description='')
+        for keyword, ctx in [(canvas, kivy), (canvas, python), (color, kivy)]:
+            Data.objects.create(keyword=keyword, context=ctx,
+                                info="%s in %s\nsecond line" % (
+                                    keyword.name, ctx.name))
+        utils._storage = (SqliteStorage(database_name) if storage == 'sqlite'
+                          else DjangoStorage(database_name))
+        self.addCleanup(setattr, utils, '_storage', None)
+        vimstub.reset()
+        app = gotoword.App()
+        app.main()
+        return app
+
+    def test_helper_after_another_process_deleted_the_keyword(self):
+        for storage in ['django', 'sqlite']:
+            app = self.make_app(storage)
+            app.helper('color')
+            self.assertEqual(['color in kivy', 'second line'],
+                             app.vim_wrapper.help_buffer[1:])
+            other = sqlite3.connect(database_name)
+            other.execute("DELETE FROM %s" % Data._meta.db_table)
+            other.execute("DELETE FROM %s WHERE name = 'canvas'" %
+                          Keyword._meta.db_table)
+            other.commit()
+            other.close()
+            self.assertIsNone(app.helper('canvas'))
+            self.assertNotIn('canvas', app.store)
+            # color is a keyword still, without definitions
+            self.assertEqual([], app.helper('color').definitions)
+            self.tearDown()
+            self.setUp()
+
+    def test_helper_when_the_store_is_stale(self):
+        # deleted through the plugin's own connection, data_version doesn't
+        # change; the store still has canvas
+        app = self.make_app()
+        Data.objects.filter(keyword__name='canvas',
+                            context__name='python').delete()
+        app.helper('canvas')
+        # the user picks python from the list of contexts
+        app.keyword.current_context = app.store.get_context('python')
+        app._kwd_multiple_contexts()
+        self.assertIsNone(app.keyword)
+        Keyword.objects.filter(name='color').delete()
+        self.assertIsNone(app.helper('color'))
+        self.assertIn("doesn't exist", app.vim_wrapper.help_buffer[0])
+
+    def test_helper_finds_keywords_saved_by_another_process(self):
+        for storage in ['django', 'sqlite']:
+            app = self.make_app(storage)
+            kivy = Context.objects.get(name='kivy')
+            self.assertIsNone(app.helper('label'))
+            other = sqlite3.connect(database_name)
+            kw_id = other.execute("INSERT INTO %s (name) VALUES ('label')" %
+                                  Keyword._meta.db_table).lastrowid
+            other.execute("INSERT INTO %s (keyword_id, context_id, cmd, "
+                          "info_public, info, summary) VALUES "
+                          "(?, ?, '', '', 'label in kivy', '')" %
+                          Data._meta.db_table, (kw_id, kivy.id))
+            other.commit()
+            other.close()
+            self.assertEqual(kw_id, app.helper('label').id)
+            self.assertEqual(['label in kivy'],
+                             app.vim_wrapper.help_buffer[1:])
+            self.tearDown()
+            self.setUp()
+
+    def test_helper_without_data_version(self):
+        # a database that can't tell when another process changed it
+        app = self.make_app()
+        utils._storage.data_version = lambda: None
+        app.notes_cache.data_version = None
+        label = Keyword.objects.create(name='label')
+        Data.objects.create(keyword=label,
+                            context=Context.objects.get(name='kivy'),
+                            info="label in kivy")
+        self.assertEqual(label.id, app.helper('label').id)
+        self.assertEqual(['label in kivy'], app.vim_wrapper.help_buffer[1:])
+        self.assertEqual((label.id, (Context.objects.get(name='kivy').id,)),
+                         app.store.find('label'))
+
+    def test_create_keyword_saved_by_another_process(self):
+        app = self.make_app()
+        Keyword.objects.create(name='label')
+        # the store doesn't know label
+        keyword = utils.create_keyword('label',
+                                       Context.objects.get(name='kivy'),
+                                       ["label in kivy"], app.store)
+        self.assertEqual(Keyword.objects.get(name='label').id, keyword.id)
+        self.assertIn('label', app.store)
+
+    def test_helper_queries(self):
+        def queries(word):
+            "Returns the number of queries app.helper(word) runs."
+            before = stats.counters.sql + stats.counters.orm
+            app.helper(word)
+            return stats.counters.sql + stats.counters.orm - before
+
+        def follow(name):
+            "Returns the number of queries following link name runs."
+            before = stats.counters.sql + stats.counters.orm
+            link = [link for link in app.template.links
+                    if link.name == name][0]
+            link.action(app.template, app, name)
+            link.target(app.template, app)
+            return stats.counters.sql + stats.counters.orm - before
+
+        for storage in ['django', 'sqlite']:
+            app = self.make_app(storage)
+            # every command checks data_version first
+            self.assertEqual(1, queries('nothing'))
+            # the note is read along with the keyword, then it is cached
+            self.assertEqual(2, queries('color'))
+            self.assertEqual(['color in kivy', 'second line'],
+                             app.vim_wrapper.help_buffer[1:])
+            self.assertEqual(1, queries('color'))
+            self.assertEqual(['color in kivy', 'second line'],
+                             app.vim_wrapper.help_buffer[1:])
+            # the notes of all its contexts are read in one query
+            self.assertEqual(2, queries('canvas'))
+            self.assertEqual(2, follow('python'))
+            self.assertEqual(['canvas in python', 'second line'],
+                             app.vim_wrapper.help_buffer[1:])
+            self.assertEqual(2, queries('canvas'))
+            self.assertEqual(1, follow('python'))
+            if storage == 'django':
+                Data.objects.all().delete()
+                Context.objects.get(name='default').delete()
+
+    def test_helper_complete_non_ascii(self):
+        Keyword.objects.create(name=u'caf\xe9')
+        app = self.make_app()
+        # Vim passes the base as utf-8 bytes
+        self.assertEqual([u'caf\xe9'], app.helper_complete('caf\xc3\xa9'))
+        self.assertEqual([u'caf\xe9'], app.helper_complete('caf'))
+
+    def test_keyword_summaries(self):
+        canvas = Keyword.objects.get(name='canvas')
+        kivy = Context.objects.get(name='kivy')
+        python = Context.objects.get(name='python')
+        Data.objects.create(keyword=canvas, context=kivy,
+                            info_public="public note\nsecond line")
+        Data.objects.create(keyword=canvas, context=python)
+        # the summary is maintained by update_info
+        update_info(canvas, python, "first line\nsecond line", None)
+        self.assertEqual("first line",
+                         Data.objects.get(context=python).summary)
+
+        with CaptureQueriesContext(connection) as queries:
+            summaries = keyword_summaries(canvas)
+        self.assertEqual(1, len(queries))
+        self.assertEqual([('kivy', 'public note'), ('python', 'first line')],
+                         [(ctx.name, line) for ctx, line in summaries])
+
+    def test_summary_update_agrees_with_summarize(self):
+        notes = [(u'', u'public note\nsecond line'),
+                 (u'first line\nsecond line', u'public note'),
+                 (u'x' * 150, u''), (u'', u''), (u'caf\xe9 ' * 30, u'')]
+        db = sqlite3.connect(':memory:')
+        db.execute("CREATE TABLE %s (info TEXT, info_public TEXT, "
+                   "summary TEXT)" % Data._meta.db_table)
+        db.executemany("INSERT INTO %s (info, info_public) VALUES (?, ?)" %
+                       Data._meta.db_table, notes)
+        db.execute(SUMMARY_UPDATE)
+        self.assertEqual([summarize(*note) for note in notes],
+                         [summary for summary, in db.execute(
+                             "SELECT summary FROM %s ORDER BY rowid" %
+                             Data._meta.db_table)])
+
+    def test_iter_names_pages(self):
+        pages = list(iter_names(Keyword.objects.all(), page_size=2))
+        self.assertEqual([['canvas', 'color'], ['test']], pages)
+        pages = list(iter_names(Keyword.objects.all(), page_size=3))
+        self.assertEqual([['canvas', 'color', 'test']], pages)
+
     def copy_database_for_inspection(self, test_name):
         '''Dump a copy of the database for inspection with other tools.
         One way to set 'test_name' automatically is by doing:
@@ -243,6 +731,569 @@ class TestContext(unittest.TestCase):
     pass
 
 
+class TestLog(unittest.TestCase):
+    class Traced(object):
+        def __init__(self):
+            self.reprs = 0
+
+        def __repr__(self):
+            self.reprs += 1
+            return 'Traced()'
+
+    def setUp(self):
+        self.logger = logging.getLogger('vim.test_log')
+        log = gotoword_logging.logger_as_decorator_factory(self.logger)
+
+        class Decorated(object):
+            @log
+            def method(self, arg):
+                "Returns arg."
+                return arg
+        self.decorated = Decorated()
+
+    def tearDown(self):
+        self.logger.setLevel(logging.NOTSET)
+        gotoword_logging.stop_spans()
+
+    def test_disabled_log_formats_nothing(self):
+        # whatever level the plugin logs at, DEBUG is disabled here
+        self.logger.setLevel(logging.WARNING)
+        arg = self.Traced()
+        self.assertIs(arg, self.decorated.method(arg))
+        self.assertEqual(0, arg.reprs)
+        self.assertEqual('method', self.decorated.method.__name__)
+        self.assertEqual("Returns arg.", self.decorated.method.__doc__)
+
+    def test_spans(self):
+        gotoword_logging.record_spans()
+        self.decorated.method(1)
+        self.decorated.method(2)
+        spans = gotoword_logging.stop_spans()
+        self.assertEqual(['method', 'method'], [span[0] for span in spans])
+        self.assertTrue(spans[0][1].endswith('.Decorated'))
+        self.assertTrue(all(span[3] >= 0 for span in spans))
+        # not recording anymore
+        self.decorated.method(3)
+        self.assertEqual([], gotoword_logging.stop_spans())
+
+
+class TestLoggingQueue(unittest.TestCase):
+    class Collect(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+            self.commits = 0
+
+        def emit(self, record):
+            self.messages.append(self.format(record))
+
+        def commit(self):
+            self.commits += 1
+
+    def test_queue(self):
+        queue = Queue.Queue(2)
+        handler = gotoword_logging.QueueHandler(queue)
+        logger = logging.getLogger('vim.test_queue')
+        logger.propagate = False
+        logger.addHandler(handler)
+        args = ['canvas']
+        for i in range(3):
+            logger.warning("note of %s", args)
+        # the message is formatted when queued, not when written
+        args.append('color')
+        self.assertEqual(1, handler.dropped)
+
+        collect = self.Collect()
+        listener = gotoword_logging.QueueListener(handler, collect)
+        listener.start()
+        listener.stop()
+        self.assertEqual(["note of ['canvas']"] * 2 +
+                         ["1 log records were dropped, the queue was full"],
+                         collect.messages)
+        # in batches: the thread may get the records before stop() is called
+        self.assertIn(collect.commits, (1, 2))
+        logger.removeHandler(handler)
+
+    def test_failing_handler(self):
+        handler = gotoword_logging.QueueHandler(Queue.Queue(10))
+        collect = self.Collect()
+
+        class Failing(self.Collect):
+            def commit(self):
+                raise IOError("disk full")
+        listener = gotoword_logging.QueueListener(handler, collect, Failing())
+        listener.start()
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            for i in range(2):
+                handler.handle(logging.makeLogRecord(
+                    {'msg': str(i), 'levelno': logging.WARNING}))
+                # one batch at a time
+                while not handler.queue.empty():
+                    time.sleep(0.001)
+            listener.stop()
+        finally:
+            stderr, sys.stderr = sys.stderr, stderr
+        # the thread went on after the first batch
+        self.assertEqual(['0', '1'], collect.messages)
+        self.assertIn('disk full', stderr.getvalue())
+
+    def test_stop_stuck_thread(self):
+        handler = gotoword_logging.QueueHandler(Queue.Queue(1))
+        emitting, release = threading.Event(), threading.Event()
+
+        class Stuck(self.Collect):
+            def emit(self, record):
+                emitting.set()
+                release.wait()
+
+            def close(self):
+                self.closed = True
+        stuck = Stuck()
+        listener = gotoword_logging.QueueListener(handler, stuck)
+        listener.start()
+        handler.handle(logging.makeLogRecord(
+            {'msg': 'first', 'levelno': logging.WARNING}))
+        emitting.wait(1)
+        handler.handle(logging.makeLogRecord(
+            {'msg': 'fills the queue', 'levelno': logging.WARNING}))
+        start = time.time()
+        listener.stop(timeout=0.05)
+        self.assertLess(time.time() - start, 1)
+        # the thread still uses it
+        self.assertFalse(hasattr(stuck, 'closed'))
+        release.set()
+
+
+class TestTemplate(unittest.TestCase):
+    def setUp(self):
+        vimstub.reset()
+        gotoword.VimWrapper.has_execute = True
+        self.vim_wrapper = gotoword.VimWrapper()
+        self.vim_wrapper.setup_help_buffer('help')
+        self.help_buffer = self.vim_wrapper.help_buffer
+        # observers, like App.main() attaches them
+        self.template = gotoword.Template(None, self.vim_wrapper, 'help')
+        self.template.attach_post(gotoword.LinksObserver(self.template))
+        toggle_modifiable = gotoword.ToggleModifiableObserver(self.template)
+        self.template.attach_pre(toggle_modifiable)
+        self.template.attach_post(toggle_modifiable)
+        self.template.attach_post(gotoword.PagerObserver(self.template))
+        del vimstub.calls[:]
+
+    def test_template_stats(self):
+        stats.reset()
+        for i in range(3):
+            self.template.template(['kivy'])
+        command = stats.commands['Template.template']
+        self.assertEqual(3, command.count)
+        # and, per render, a write of the lines and a use of vim.current
+        vim_calls = len(vimstub.calls) + 3 * 2
+        self.assertEqual(vim_calls, command.vim)
+        self.assertEqual(['command', 'Template.template'],
+                         [line.split()[0] for line in stats.report()])
+        path = os.path.join(tempfile.mkdtemp(), 'stats.json')
+        stats.dump(path, {'NoteCache': {'hits': 2}})
+        with open(path) as f:
+            dumped = json.load(f)
+        self.assertEqual({'hits': 2}, dumped['NoteCache'])
+        dumped = dumped['Template.template']
+        shutil.rmtree(os.path.dirname(path))
+        self.assertEqual(3, dumped['count'])
+        self.assertEqual(float(vim_calls) / 3, dumped['vim'])
+        self.assertLessEqual(dumped['p50'], dumped['p99'])
+
+    def test_trace(self):
+        tracing.start()
+        self.template.template(['kivy'])
+        count_queries()
+        Keyword.objects.count()
+        path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+        self.assertEqual(len(tracing.events) + len(
+            gotoword_logging.spans), tracing.stop(path))
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        shutil.rmtree(os.path.dirname(path))
+        self.assertIsNone(tracing.events)
+        self.assertEqual(['Template.template', 'vim.command', 'vim.eval',
+                          'sql'], [event['name'] for event in events])
+        template = events[0]
+        for call in events[1:3]:
+            # the calls to Vim are nested in the span of template()
+            self.assertEqual('vim', call['cat'])
+            self.assertGreaterEqual(call['ts'], template['ts'])
+            self.assertLessEqual(call['ts'] + call['dur'],
+                                 template['ts'] + template['dur'])
+        self.assertIn('SELECT COUNT(*)', events[3]['args']['sql'])
+        self.assertEqual(['X'], list(set(event['ph'] for event in events)))
+
+    def test_profile(self):
+        profiling.start()
+        self.template.template(['kivy'])
+        self.template.template(['python'])
+        self.assertEqual(0, profiling.depth)
+        path = profiling.stop(tempfile.mkdtemp())
+        self.assertIsNone(profiling.profile)
+        self.assertTrue(path.endswith('.pstats'))
+        lines = profiling.report(top=5)
+        shutil.rmtree(os.path.dirname(path))
+        # both renders were recorded, as 2 calls of template()
+        calls = [line for line in lines if line.endswith('(template)')]
+        self.assertEqual(1, len(calls))
+        self.assertTrue(calls[0].split()[0].startswith('2'))
+
+    def test_profile_report(self):
+        def recorded():
+            pass
+
+        def command():
+            # the report of the running profile leaves it recording
+            self.assertTrue(profiling.report(top=5))
+            recorded()
+        profiling.start()
+        profiling.runcall(command)
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            path = profiling.stop()
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(os.path.join(os.path.realpath(directory),
+                                      os.path.basename(path)),
+                         os.path.realpath(path))
+        self.assertIn('recorded', [function for (filename, line, function)
+                                   in pstats.Stats(path).stats])
+        not_a_profile = os.path.join(directory, 'notes.txt')
+        with open(not_a_profile, 'w') as f:
+            f.write("not a profile")
+        self.assertRaises(ValueError, profiling.report, not_a_profile)
+        shutil.rmtree(directory)
+        self.assertRaises(IOError, profiling.report, not_a_profile)
+
+    def test_buffer_lines_are_counted(self):
+        before = stats.counters.vim
+        self.help_buffer[:] = ['header', 'kivy']
+        self.help_buffer[1:] = ['python']
+        self.help_buffer.append('pager')
+        self.assertEqual('python', self.help_buffer[1])
+        self.assertEqual(3, len(self.help_buffer))
+        self.assertEqual(['header', 'python', 'pager'],
+                         gotoword.vim.buffers[self.vim_wrapper.buffer_nr])
+        gotoword.vim.current.buffer
+        self.assertEqual(before + 6, stats.counters.vim)
+
+    def test_render_calls_vim_twice(self):
+        links = [gotoword.Link('kivy'), gotoword.Link('python')]
+        for i in range(2):
+            # the second render also undoes the links of the first one
+            del vimstub.calls[:]
+            self.template.template(['kivy', 'python'], ['header'], links,
+                                   syntax_group='GotowordLinks',
+                                   modifiable=False)
+            # one call opens the window, one runs the observers' commands
+            self.assertEqual(['command', 'eval'],
+                             [call[0] for call in vimstub.calls])
+        execute = vimstub.calls[1][1]
+        # with one switch to help buffer and back to user's buffer
+        self.assertTrue(execute.startswith("execute(['buffer! 2', "))
+        self.assertTrue(execute.endswith(", 'buffer! 1'])"))
+        self.assertIn("syntax clear GotowordLinks", execute)
+        # all links are highlighted by one syntax item
+        self.assertEqual(1, execute.count("syntax match"))
+        self.assertIn(r"\%(kivy\|python\)", execute)
+        self.assertEqual(['header', 'kivy', 'python'], self.help_buffer[:])
+        self.assertFalse(self.help_buffer.options['modifiable'])
+
+
+class TestHighlight(unittest.TestCase):
+    class App(object):
+        "What Highlighter uses of gotoword.App."
+
+    names = [u'canvas', u'color', u'display', u'contained', u'a/b',
+             u'функция', u'caf\xe9']
+
+    def setUp(self):
+        vimstub.reset()
+        gotoword.VimWrapper.has_execute = True
+        self.app = self.App()
+        self.app.store = KeywordsStore()
+        self.app.store.keywords = dict(
+            (name, (kw_id, ())) for kw_id, name in enumerate(self.names))
+        self.app.vim_wrapper = gotoword.VimWrapper()
+        self.app.vim_wrapper.setup_help_buffer('help')
+        self.buf = vimstub.current.buffer
+        self.highlighter = highlight.Highlighter(self.app)
+
+    def last_syntax(self):
+        "Returns the last syntax commands run, as one string."
+        return [call[1] for call in vimstub.calls
+                if 'syntax clear' in call[1]][-1]
+
+    def test_automaton_agrees_with_brute_force(self):
+        rand = random.Random(0)
+        for i in range(50):
+            words = set(u''.join(rand.choice(u'ab\xe9') for j in
+                                 range(rand.randint(1, 4)))
+                        for k in range(rand.randint(1, 8)))
+            text = u''.join(rand.choice(u'ab\xe9') for j in range(40))
+            found = sorted(highlight.Automaton(words).scan(text))
+            expected = sorted((start + len(word) - 1, word)
+                              for word in words
+                              for start in range(len(text))
+                              if text.startswith(word, start))
+            self.assertEqual(expected, found)
+
+    def test_whole_words_only(self):
+        automaton = highlight.Automaton([u'canvas', u'a/b', u'caf\xe9'])
+        self.assertEqual(set([u'canvas', u'a/b']), automaton.find_words(
+            u'self.canvas = a/b'))
+        self.assertEqual(set(), automaton.find_words(
+            u'canvases _canvas canvas2 xa/b caf\xe9s'))
+        self.assertEqual(set([u'caf\xe9']), automaton.find_words(
+            u'(caf\xe9)'))
+
+    def test_syntax_commands(self):
+        cmds = highlight.syntax_commands('Group', self.names, 'ignore')
+        self.assertEqual(['syntax clear Group', 'syntax case ignore',
+                          'syntax keyword Group caf\xc3\xa9 canvas color '
+                          'containedin=ALL'],
+                         [cmd.encode('utf-8') for cmd in cmds[:3]])
+        # names that are arguments of :syntax keyword or have chars that
+        # 'iskeyword' can't hold are matched by a pattern
+        self.assertTrue(cmds[3].startswith('syntax match Group /'))
+        for name in (u'a\\/b', u'contained', u'display',
+                     u'функция'):
+            self.assertIn(name, cmds[3])
+        # the case of the buffer's syntax file is restored
+        self.assertEqual('syntax case ignore', cmds[-1])
+        self.assertEqual(['syntax clear Group', 'syntax case ignore',
+                          'syntax case match'],
+                         highlight.syntax_commands('Group', [], 'match'))
+
+    def test_toggle(self):
+        self.buf[:] = ['with self.canvas:', '    Color(display)']
+        self.buf.syntax_case = 'ignore'
+        self.assertTrue(self.highlighter.toggle())
+        self.assertTrue(any('autocmd TextChanged' in call[1]
+                            for call in vimstub.calls))
+        syntax = self.last_syntax()
+        self.assertIn('syntax keyword GotowordKeywords canvas color '
+                      'containedin=ALL', syntax)
+        self.assertIn('display', syntax.split('syntax match')[1])
+        self.assertTrue(syntax.endswith("'syntax case ignore'])"))
+        self.assertEqual(set([1]), self.highlighter.highlighted)
+
+        # another buffer is highlighted, the current one is being scanned
+        other = vimstub.Buffer(len(vimstub.buffers) + 1)
+        vimstub.buffers[other.number] = vimstub.current.buffer = other
+        other[:] = ['canvas']
+        self.highlighter.highlight()
+        vimstub.current.buffer = self.buf
+        scanner = self.highlighter.scanner = highlight.Scanner()
+        self.buf.changedtick += 1
+        self.highlighter.highlight()
+        job = self.highlighter.buffers[1].job
+        self.assertEqual('1', self.highlighter.timer)
+
+        del vimstub.calls[:]
+        self.assertFalse(self.highlighter.toggle())
+        self.assertIn(('command', 'autocmd! gotoword_highlight'),
+                      vimstub.calls)
+        self.assertEqual("execute(['syntax clear GotowordKeywords', "
+                         "'noautocmd keepalt buffer! %(other)s', "
+                         "'syntax clear GotowordKeywords', "
+                         "'noautocmd keepalt buffer! 1'])" %
+                         {'other': other.number}, self.last_syntax())
+        self.assertEqual(set(), self.highlighter.highlighted)
+        self.assertEqual({}, self.highlighter.buffers)
+        self.assertTrue(job.cancelled)
+        self.assertIn(('eval', 'timer_stop(1)'), vimstub.calls)
+        self.assertIsNone(self.highlighter.timer)
+        self.assertIsNone(self.highlighter.scanner)
+        # the thread exits
+        scanner.jobs.get_nowait()
+        self.assertIsNone(scanner.jobs.get_nowait())
+
+    def test_scope_filters_highlighted_keywords(self):
+        self.app.store.keywords.update({u'canvas': (0, (1,)),
+                                        u'color': (1, (2,))})
+        self.buf[:] = ['canvas color']
+        self.highlighter.toggle()
+        version = self.highlighter.version
+        self.app.store.set_scope([1])
+        self.highlighter.highlight()
+        self.assertIn('syntax keyword GotowordKeywords canvas '
+                      'containedin=ALL', self.last_syntax())
+        # the automaton is kept
+        self.assertEqual(version, self.highlighter.version)
+
+    def change(self, first, last, cursor, ticks=1):
+        "Tells the highlighter that lines first to last were changed."
+        self.buf.changedtick += ticks
+        self.buf.marks = (first, last)
+        self.buf.cursor = cursor
+        self.highlighter.update()
+
+    def assert_rescanned(self):
+        "The keywords of the lines are the ones a full scan finds."
+        state = self.highlighter.buffers[self.buf.number]
+        self.assertIsNone(state.job)
+        self.assertEqual(highlight.scan_lines(
+            self.buf, self.highlighter.automaton, {}), state.lines)
+        self.assertEqual(self.highlighter.scan(self.buf), state.names())
+
+    def test_update_rescans_changed_lines(self):
+        self.buf[:] = ['canvas %s' % i for i in range(10)]
+        self.highlighter.toggle()
+        # a line is changed
+        self.buf[3] = 'color'
+        self.change(4, 4, 4)
+        self.assert_rescanned()
+        # lines are inserted
+        self.buf[5:5] = ['display', 'a/b canvas']
+        self.change(6, 7, 6)
+        self.assert_rescanned()
+        # lines are deleted; the marks are on the line after them
+        del self.buf[0:4]
+        self.change(1, 1, 1)
+        self.assert_rescanned()
+        self.assertEqual(set(['canvas', 'display', 'a/b']),
+                         self.highlighter.buffers[1].names())
+        # more than one change since the last update, a full rescan
+        self.buf[0] = 'nothing'
+        self.buf[-1] = 'color'
+        self.change(1, 1, 1, ticks=2)
+        self.assert_rescanned()
+
+    def test_update_after_insert_mode_split(self):
+        self.buf[:] = ['canvas and color', 'x', 'y', 'z', 'w']
+        self.highlighter.toggle()
+        # <CR> in Insert mode splits line 1; the marks are those of an older
+        # change, below the cursor
+        self.buf[0:1] = ['canvas and', 'color']
+        self.change(5, 5, 2)
+        self.assert_rescanned()
+        self.assertEqual(frozenset(['canvas']),
+                         self.highlighter.buffers[1].lines[0])
+
+    def test_update_merges_with_scan_in_progress(self):
+        self.buf[:] = ['canvas %s' % i for i in range(10)]
+        self.highlighter.toggle()
+        # the scans are queued for a thread which doesn't run them yet
+        self.highlighter.scanner = highlight.Scanner()
+        self.buf[5] = 'color'
+        self.change(6, 6, 6)
+        first = self.highlighter.buffers[1].job
+        self.assertEqual((4, 6), (first.start, first.stop))
+        # lines are inserted above the lines being scanned
+        self.buf[1:1] = ['display']
+        self.change(2, 2, 2)
+        state = self.highlighter.buffers[1]
+        self.assertTrue(first.cancelled)
+        # the new scan covers both changes, the first one moved by a line
+        self.assertEqual((0, 7), (state.job.start, state.job.stop))
+        state.job.run()
+        self.highlighter.finish(state.job)
+        self.assert_rescanned()
+
+    def test_scan_in_thread(self):
+        self.buf[:] = ['canvas %s' % i for i in range(3000)] + ['color']
+        self.highlighter.scanner = highlight.Scanner()
+        self.highlighter.scanner.start()
+        self.highlighter.toggle()
+        # the automaton is built first, in the thread too
+        self.assertTrue(self.highlighter.build)
+        self.assertEqual('1', self.highlighter.timer)
+        # what the Vim timer does
+        deadline = time.time() + 10
+        while self.highlighter.timer and time.time() < deadline:
+            self.highlighter.poll()
+            time.sleep(0.01)
+        self.assertIsNone(self.highlighter.build)
+        self.assertIsNone(self.highlighter.buffers[1].job)
+        self.assert_rescanned()
+        self.assertIn('syntax keyword GotowordKeywords canvas color',
+                      self.last_syntax())
+        self.assertIsNone(self.highlighter.timer)
+        self.assertIn(('eval', 'timer_stop(1)'), vimstub.calls)
+
+    def test_automaton_is_rebuilt_in_thread(self):
+        self.buf[:] = ['canvas label']
+        self.highlighter.toggle()
+        automaton = self.highlighter.automaton
+        version = self.highlighter.version
+        # removed keywords don't need a new automaton
+        self.app.store.remove_keyword(u'color')
+        self.highlighter.highlight()
+        self.assertIs(automaton, self.highlighter.automaton)
+
+        self.highlighter.scanner = highlight.Scanner()
+        self.app.store.add_keyword(Keyword(id=100, name=u'label'))
+        build = self.highlighter.build
+        self.assertEqual(build, self.highlighter.scanner.jobs.get_nowait())
+        # until the new one is built, the old one is used
+        self.buf.changedtick += 1
+        self.highlighter.highlight()
+        self.assertIs(automaton, self.highlighter.buffers[1].job.automaton)
+        self.assertNotIn('label', self.last_syntax())
+        # what the Scanner and the Vim timer do
+        build.run()
+        self.highlighter.scanner.results.put(build)
+        self.highlighter.poll()
+        self.assertEqual(version + 1, self.highlighter.version)
+        state = self.highlighter.buffers[1]
+        self.assertIs(build.automaton, state.job.automaton)
+        state.job.run()
+        self.highlighter.scanner.results.put(state.job)
+        self.highlighter.poll()
+        self.assertIn('canvas label', self.last_syntax())
+        self.assertIsNone(self.highlighter.timer)
+
+    def test_cancelled_scan(self):
+        class Cancelling(object):
+            "Automaton that cancels the job when it meets line 'stop'."
+            def find_words(self, text):
+                if text == u'stop':
+                    job.cancelled = True
+                return set()
+        job = highlight.ScanJob(1, 0, 4, ['a', 'stop', 'b', 'c'],
+                                Cancelling(), {})
+        job.chunk = 1
+        done = highlight.ScanJob(1, 0, 1, ['canvas'],
+                                 highlight.Automaton([u'canvas']), {})
+        scanner = highlight.Scanner()
+        scanner.start()
+        scanner.jobs.put(job)
+        scanner.jobs.put(done)
+        # the cancelled job stops scanning and has no result
+        self.assertIs(done, scanner.results.get(timeout=10))
+        self.assertEqual(2, len(job.found))
+        self.assertTrue(scanner.results.empty())
+
+        # a scan that finished after the buffer changed again is dropped
+        self.buf[:] = ['canvas', 'x']
+        self.highlighter.toggle()
+        self.highlighter.scanner = highlight.Scanner()
+        self.buf[1] = 'color'
+        self.change(2, 2, 2)
+        stale = self.highlighter.buffers[1].job
+        self.buf[0] = 'display'
+        self.change(1, 1, 1)
+        stale.run()
+        self.highlighter.scanner.results.put(stale)
+        self.highlighter.poll()
+        state = self.highlighter.buffers[1]
+        # the lines are left for the scan in progress
+        self.assertEqual([None, None], state.lines)
+        self.assertIsNotNone(self.highlighter.timer)
+        state.job.run()
+        self.highlighter.scanner.results.put(state.job)
+        self.highlighter.poll()
+        self.assert_rescanned()
+        self.assertIsNone(self.highlighter.timer)
+
+
 #if options.syncdb:
 #    # run a simple command - here syncdb - from the management suite
 #    call_command('syncdb')
@@ -0,0 +1,86 @@
+# -*- coding: utf8 -*-
+
+"""A stand-in for the vim module, so that the plugin can be imported and
+driven outside Vim. It records every call made to Vim.
+Usage:
+    >>> import vimstub
+    >>> sys.modules['vim'] = vimstub
+    >>> from gotoword import gotoword
+    >>> vimstub.reset()
+    >>> # ... render a template ...
+    >>> len(vimstub.calls)
+    2
+"""
+
+
+class error(Exception):
+    pass
+
+
+class Buffer(list):
+    def __init__(self, number, name=''):
+        list.__init__(self)
+        self.number = number
+        self.name = name
+        self.options = {}
+        self.changedtick = 1
+        self.marks = (0, 0)
+        # lines of marks '[ and ']
+        self.cursor = 1
+        self.syntax_case = 'match'
+
+
+class Current(object):
+    buffer = None
+
+
+calls = []
+# ('command', cmd) or ('eval', expr) tuples, in the order they were made
+buffers = {}
+current = Current()
+
+
+def reset():
+    "Forgets the calls; leaves only buffer 1, the user's buffer."
+    del calls[:]
+    buffers.clear()
+    buffers[1] = current.buffer = Buffer(1)
+
+
+def command(cmd):
+    calls.append(('command', cmd))
+
+
+def eval(expr):
+    calls.append(('eval', expr))
+    if expr.startswith('bufnr('):
+        buf = Buffer(len(buffers) + 1, expr)
+        buffers[buf.number] = buf
+        return str(buf.number)
+    if expr == 'winbufnr(0)':
+        return str(current.buffer.number)
+    if expr == "exists('*execute')":
+        return '1'
+    if expr == 'b:changedtick':
+        return str(current.buffer.changedtick)
+    if expr.startswith('[b:changedtick'):
+        # see Highlighter.update()
+        buf = current.buffer
+        return [str(value) for value in
+                (buf.changedtick, buf.marks[0], buf.marks[1], buf.cursor)]
+    if "execute('syntax case')" in expr:
+        return '\nsyntax case %s' % current.buffer.syntax_case
+    if expr.endswith(", 'bufloaded(v:val)')"):
+        # see Highlighter.clear(); buffers are loaded until they're removed
+        numbers = expr[len('filter(['):expr.index(']')].split(',')
+        return [number.strip() for number in numbers
+                if number.strip() and int(number) in buffers]
+    if expr.startswith('timer_start('):
+        return '1'
+    if expr.startswith('[&filetype'):
+        # filetype, path and buftype of the current buffer
+        return ['', current.buffer.name, '']
+    return ''
+
+
+reset()